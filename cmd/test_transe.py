@@ -1,3 +1,5 @@
+import os
+
 from rdflib import Graph
 
 import crabby.critic as critic
@@ -19,58 +21,63 @@ def main():
     # print(onto.add_triplets(triplets=[Triplet(head=0, rel=1, tail=1)]))
     # print(onto.triplets_len(), onto.get_triplet(1))
     
-    g = Graph()
-    g.parse('https://dbpedia.org/resource/High_Speed_1')
+    data_dir = os.getenv("DATA_DIR", "")
+    onto_path = os.path.join(data_dir, "transe_onto.bin")
+    checkpoint_path = os.path.join(data_dir, "transe.pt")
     
-    entities = set()
-    relations = set()
-
-    for s, p, o in g:
-        entities.add(s)
-        entities.add(o)
+    # The ontology is kept on disk so the entity ids of a resumed checkpoint stay the same.
+    if os.path.exists(onto_path):
+        onto = critic.Ontology.open(onto_path)
         
-        relations.add(p)
-
-    entities = list(entities)
-    relations = list(relations)
-    
-    ent_indices = dict()
-    rel_indices = dict()
-    
-    for i, entity in enumerate(entities):
-        ent_indices[entity] = i
-
-    for i, rel in enumerate(relations):
-        rel_indices[rel] = i
-
-    adj_list = [None] * len(entities)
-    
-    for i in range(len(entities)):
-        adj_list[i] = []
-
-    for s, p, o in g:
-        adj_list[ent_indices[s]].append(critic.Trans(rel=rel_indices[p], tail=ent_indices[o]))
+        print("loaded ontology from file")
+    else:
+        g = Graph()
+        g.parse('https://dbpedia.org/resource/High_Speed_1')
+        
+        # The graph is streamed into the ontology in a single pass.
+        onto_loader = critic.OntologyLoader(indexed=True)
+        onto = onto_loader.load_graph(g)
+        onto.save(onto_path)
+        
+        print(f"Loaded {onto_loader.stats().triplets} triplets in {onto_loader.stats().seconds:.2f}s")
 
-    onto = critic.Ontology(adj_list, relations, entities)
-    dataset = critic.TripletDataset(onto)
-    loader = torch_data.DataLoader(dataset, shuffle=True, batch_size=64)
+    dataset = critic.TripletTensorDataset(onto)
+    # The sampler yields whole minibatches so automatic batching is turned off.
+    loader = torch_data.DataLoader(dataset, sampler=critic.TripletBatchSampler(len(dataset), batch_size=64), batch_size=None)
 
-    model = critic.TranseModel(onto, k=20)
-    optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+    # Sparse gradients only touch the rows of a minibatch so a step costs the same no matter the graph size.
+    model = critic.TranseModel(onto, k=20, sparse=True)
+    optimizer = torch.optim.SparseAdam(list(model.parameters()), lr=0.01)
     
-    trainer = critic.Trainer(loader, onto, optimizer, model, margin=1)
+    sampler = critic.NegativeSampler(onto, mode=critic.NegativeSampler.BERNOULLI, filtered=True, seed=0)
+    # Minibatches and their negatives are prepared by a background thread while the model computes.
+    trainer = critic.Trainer(loader, onto, optimizer, model, margin=1, sampler=sampler, prefetch=4)
     calc = critic.Calculator(dataset, onto)
     
     metrics_bundle = calc.calculate(model)
     
-    for _ in range(100):
-        trainer.train_one_epoch()
+    checkpointer = critic.Checkpointer(checkpoint_path, every=10)
+    
+    if checkpointer.restore(trainer):
+        print(f"resumed training from epoch {trainer.epoch()}")
     
+    # Validation runs in the background and training stops once the filtered MRR stops improving.
+    # A resumed loop carries on with the early stopping state of the restored checkpoint.
+    loop = critic.TrainingLoop(trainer, calc, validate_every=10, patience=3, max_epochs=100, checkpointer=checkpointer)
+    best = loop.run()
+    
+    if best is not None:
+        print(f"Best filtered MRR {best.bundle.mrr} at epoch {best.epoch}")
     
     metrics_bundle = calc.calculate(model)
     
     print(f"Hits at 10 ---> {metrics_bundle.hits_at_10}")
     print(f"Mean rank ---> {metrics_bundle.mean_rank}")
+    
+    ranking_bundle = calc.evaluate(model)
+    
+    print(f"Filtered MRR ---> {ranking_bundle.mrr}")
+    print(f"Filtered hits at 1/3/10 ---> {ranking_bundle.hits_at_1}/{ranking_bundle.hits_at_3}/{ranking_bundle.hits_at_10}")
 
 
 if __name__ == "__main__":
@@ -4,7 +4,20 @@ from crabby.critic.data import (
     Trans,
     Ontology,
     corrupted_counterparts,
+    triplets_isin,
+    NegativeSampler,
     TripletDataset,
+    TripletTensorDataset,
+    TripletBatchSampler,
 ) # noqa
-from crabby.critic.transe import TranseModel, Trainer # noqa
-from crabby.critic.metric import Calculator, MetricsBundle # noqa
+from crabby.critic.transe import TranseModel, Trainer, HogwildTrainer, IncrementalTrainer, EpochStats, TrainingWorkerError # noqa
+from crabby.critic.pipeline import Prefetcher, StageTimings # noqa
+from crabby.critic.embedding import MmapEmbedding # noqa
+from crabby.critic.metric import Calculator, MetricsBundle, RankingBundle, RankStats # noqa
+from crabby.critic.loader import OntologyLoader, IngestionStats # noqa
+from crabby.critic.storage import StorageFormatError # noqa
+from crabby.critic.query import GraphQuery # noqa
+from crabby.critic.checkpoint import Checkpointer # noqa
+from crabby.critic.driver import TrainingLoop, ValidationResult # noqa
+from crabby.critic.scorer import TranseScorer, QuantizedTranseScorer, DriftReport, drift_report # noqa
+from crabby.critic.ann import IvfIndex, RecallReport, recall_benchmark # noqa
@@ -0,0 +1,271 @@
+import time
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+import crabby.critic.scorer as scorer_lib
+import crabby.critic.transe as transe
+
+
+class RecallReport(NamedTuple):
+    nprobe: int
+    recall: float
+    exact_seconds: float
+    ann_seconds: float
+    # speedup is exact_seconds / ann_seconds.
+    speedup: float
+
+
+# IvfIndex is an inverted-file approximate nearest-neighbour index over entity embeddings.
+# The embeddings are clustered with k-means into lists and a query only scans the nprobe lists whose centroids
+# are the closest to it, trading recall for latency.
+# With product quantization the residuals to the list centroids are stored as one byte per subspace and
+# distances are computed from per-query lookup tables instead of the float rows.
+class IvfIndex:
+    # _assign_chunk is the number of rows assigned to centroids at once.
+    _ASSIGN_CHUNK = 65536
+
+    _centroids: np.ndarray
+    # _offsets, _ids hold the inverted lists in a CSR layout: the entity ids of list l are _ids[_offsets[l]:_offsets[l + 1]].
+    _offsets: np.ndarray
+    _ids: np.ndarray
+    # _vectors holds the rows in list order when the index isn't quantized, None otherwise.
+    _vectors: Optional[np.ndarray]
+    # _codes, _codebooks hold the [E, m] PQ codes and the [m, C, d / m] codebooks when the index is quantized.
+    _codes: Optional[np.ndarray]
+    _codebooks: Optional[np.ndarray]
+    _nprobe: int
+
+    def __init__(
+            self,
+            centroids: np.ndarray,
+            offsets: np.ndarray,
+            ids: np.ndarray,
+            vectors: Optional[np.ndarray] = None,
+            codes: Optional[np.ndarray] = None,
+            codebooks: Optional[np.ndarray] = None,
+            nprobe: int = 1,
+    ) -> None:
+        if (vectors is None) == (codes is None):
+            raise ValueError("either vectors or codes must be given")
+
+        self._centroids = centroids
+        self._offsets = offsets
+        self._ids = ids
+        self._vectors = vectors
+        self._codes = codes
+        self._codebooks = codebooks
+        self.set_nprobe(nprobe)
+
+    # build clusters the [E, d] entities into lists (sqrt(E) by default) and, when pq_subspaces > 0, trains a
+    # product quantizer with pq_centroids centroids (at most 256) on each of the pq_subspaces subspaces of the residuals.
+    @classmethod
+    def build(
+            cls,
+            entities: np.ndarray,
+            lists: Optional[int] = None,
+            pq_subspaces: int = 0,
+            pq_centroids: int = 256,
+            iterations: int = 10,
+            nprobe: int = 1,
+            seed: Optional[int] = None,
+    ) -> "IvfIndex":
+        entities = np.ascontiguousarray(entities, dtype=np.float32)
+        rng = np.random.default_rng(seed)
+
+        if lists is None:
+            lists = max(1, int(np.sqrt(len(entities))))
+
+        centroids = _kmeans(entities, lists, iterations, rng)
+        assignments, _ = _nearest(entities, centroids)
+
+        ids = np.argsort(assignments, kind="stable")
+        offsets = np.zeros(len(centroids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignments, minlength=len(centroids)), out=offsets[1:])
+
+        if pq_subspaces <= 0:
+            return cls(centroids, offsets, ids, vectors=entities[ids], nprobe=nprobe)
+
+        if entities.shape[1] % pq_subspaces != 0:
+            raise ValueError(f"embedding size {entities.shape[1]} isn't divisible by {pq_subspaces} subspaces")
+
+        if not 0 < pq_centroids <= 256:
+            raise ValueError("pq_centroids must be between 1 and 256")
+
+        residuals = entities[ids] - centroids[assignments[ids]]
+        codebooks = np.stack([
+            _kmeans(subspace, pq_centroids, iterations, rng) for subspace in _subspaces(residuals, pq_subspaces)
+        ])
+        codes = np.stack([
+            _nearest(subspace, codebook)[0] for subspace, codebook in zip(_subspaces(residuals, pq_subspaces), codebooks)
+        ], axis=1).astype(np.uint8)
+
+        return cls(centroids, offsets, ids, codes=codes, codebooks=codebooks, nprobe=nprobe)
+
+    @classmethod
+    def from_scorer(cls, scorer: scorer_lib.TranseScorer, **kwargs) -> "IvfIndex":
+        return cls.build(scorer.entities(), **kwargs)
+
+    @classmethod
+    def from_model(cls, model: transe.TranseModel, **kwargs) -> "IvfIndex":
+        return cls.from_scorer(scorer_lib.TranseScorer.from_model(model), **kwargs)
+
+    def nprobe(self) -> int:
+        return self._nprobe
+
+    # set_nprobe sets the number of lists scanned by a query. The more lists, the higher the recall and latency.
+    def set_nprobe(self, nprobe: int) -> None:
+        if nprobe < 1:
+            raise ValueError("nprobe must be positive")
+
+        self._nprobe = min(nprobe, self.lists_len())
+
+    def lists_len(self) -> int:
+        return len(self._centroids)
+
+    def is_quantized(self) -> bool:
+        return self._codes is not None
+
+    # search returns the ids and distances of the approximate k nearest entities of every [n, d] query.
+    # Rows with fewer than k candidates in the probed lists are padded with -1 ids and infinite distances.
+    def search(self, queries: np.ndarray, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = self._nprobe if nprobe is None else min(max(nprobe, 1), self.lists_len())
+
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        dists = np.full((len(queries), k), np.inf, dtype=np.float32)
+
+        probed = _k_nearest(queries, self._centroids, nprobe)
+
+        for i, query in enumerate(queries):
+            candidates, sq_dists = self._scan(query, probed[i])
+            found = min(k, len(candidates))
+
+            if found == 0:
+                continue
+
+            best = np.argpartition(sq_dists, found - 1)[:found] if len(candidates) > found else np.arange(found)
+            best = best[np.argsort(sq_dists[best], kind="stable")]
+
+            ids[i, :found] = candidates[best]
+            dists[i, :found] = np.sqrt(np.maximum(sq_dists[best], 0.0))
+
+        return ids, dists
+
+    # top_k_tails answers (head, rel) tail queries on the h + r translations of the scorer's embeddings.
+    def top_k_tails(self, scorer: scorer_lib.TranseScorer, heads, rels, k: int, nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        return self.search(scorer.entity_rows(np.atleast_1d(heads)) + scorer.relations()[np.atleast_1d(rels)], k, nprobe)
+
+    def _scan(self, query: np.ndarray, lists: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        spans = [slice(self._offsets[l], self._offsets[l + 1]) for l in lists]
+        candidates = np.concatenate([self._ids[span] for span in spans])
+
+        if not self.is_quantized():
+            rows = np.concatenate([self._vectors[span] for span in spans])
+            diffs = rows - query
+
+            return candidates, np.einsum("ij,ij->i", diffs, diffs)
+
+        sq_dists = []
+
+        # Asymmetric distance: the query residual to each list centroid is compared to every codebook centroid
+        # once and the candidate distances are sums of table lookups.
+        for l, span in zip(lists, spans):
+            residual = query - self._centroids[l]
+            tables = np.stack([
+                np.sum((codebook - sub) ** 2, axis=1) for sub, codebook in zip(_subspaces(residual[None, :], len(self._codebooks)), self._codebooks)
+            ])
+            codes = self._codes[span]
+            sq_dists.append(tables[np.arange(len(self._codebooks)), codes].sum(axis=1))
+
+        return candidates, np.concatenate(sq_dists)
+
+
+# recall_benchmark measures the recall@k of the index against the exact top-k of the scorer on (head, rel) tail
+# queries for every nprobe in nprobes.
+def recall_benchmark(
+        index: IvfIndex,
+        scorer: scorer_lib.TranseScorer,
+        heads: np.ndarray,
+        rels: np.ndarray,
+        k: int = 10,
+        nprobes: Sequence[int] = (1, 2, 4, 8, 16),
+) -> List[RecallReport]:
+    heads = np.atleast_1d(heads)
+    rels = np.atleast_1d(rels)
+
+    start = time.perf_counter()
+    exact_ids, _ = scorer.top_k_tails(heads, rels, k)
+    exact_seconds = time.perf_counter() - start
+
+    reports = []
+
+    for nprobe in nprobes:
+        start = time.perf_counter()
+        ann_ids, _ = index.top_k_tails(scorer, heads, rels, k, nprobe=nprobe)
+        ann_seconds = time.perf_counter() - start
+
+        hits = sum(len(np.intersect1d(exact, ann[ann >= 0])) for exact, ann in zip(exact_ids, ann_ids))
+
+        reports.append(RecallReport(
+            nprobe=min(nprobe, index.lists_len()),
+            recall=hits / exact_ids.size,
+            exact_seconds=exact_seconds,
+            ann_seconds=ann_seconds,
+            speedup=exact_seconds / ann_seconds if ann_seconds > 0 else float("inf"),
+        ))
+
+    return reports
+
+
+# _kmeans clusters the rows of x with Lloyd's algorithm starting from distinct random rows.
+# Empty clusters are reseeded with the rows that are the farthest from their centroids.
+def _kmeans(x: np.ndarray, clusters: int, iterations: int, rng: np.random.Generator) -> np.ndarray:
+    clusters = min(clusters, len(x))
+    centroids = x[rng.choice(len(x), size=clusters, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignments, sq_dists = _nearest(x, centroids)
+        counts = np.bincount(assignments, minlength=clusters)
+
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+
+        filled = counts > 0
+        centroids[filled] = sums[filled] / counts[filled, None]
+
+        empty = np.flatnonzero(~filled)
+
+        if len(empty) > 0:
+            centroids[empty] = x[np.argsort(sq_dists)[::-1][:len(empty)]]
+
+    return centroids
+
+
+# _nearest returns the index and squared distance of the closest centroid of every row of x.
+def _nearest(x: np.ndarray, centroids: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    assignments = np.empty(len(x), dtype=np.int64)
+    sq_dists = np.empty(len(x), dtype=np.float32)
+    centroid_sq_norms = np.einsum("ij,ij->i", centroids, centroids)
+
+    for start in range(0, len(x), IvfIndex._ASSIGN_CHUNK):
+        chunk = x[start:start + IvfIndex._ASSIGN_CHUNK]
+        chunk_sq_dists = np.einsum("ij,ij->i", chunk, chunk)[:, None] - 2.0 * chunk @ centroids.T + centroid_sq_norms
+
+        assignments[start:start + len(chunk)] = np.argmin(chunk_sq_dists, axis=1)
+        sq_dists[start:start + len(chunk)] = np.maximum(chunk_sq_dists[np.arange(len(chunk)), assignments[start:start + len(chunk)]], 0.0)
+
+    return assignments, sq_dists
+
+
+def _k_nearest(x: np.ndarray, centroids: np.ndarray, k: int) -> np.ndarray:
+    sq_dists = np.einsum("ij,ij->i", x, x)[:, None] - 2.0 * x @ centroids.T + np.einsum("ij,ij->i", centroids, centroids)
+
+    if k >= len(centroids):
+        return np.argsort(sq_dists, axis=1)
+
+    return np.argpartition(sq_dists, k - 1, axis=1)[:, :k]
+
+
+def _subspaces(x: np.ndarray, count: int) -> List[np.ndarray]:
+    return np.split(x, count, axis=1)
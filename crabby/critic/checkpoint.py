@@ -0,0 +1,168 @@
+import copy
+import os
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+
+import crabby.critic.transe as transe
+
+
+# Checkpointer periodically saves the state of a Trainer so training could be resumed later.
+# The state is copied synchronously (which is a memory copy of the model and the optimizer) and
+# written to disk by a background thread so training does not stall on disk.
+# Files are written next to the target and renamed over it so a crash never leaves a partial checkpoint.
+#
+# The entity table of an mmap-backed model isn't part of its state so it is copied to a file next to the
+# checkpoint named after the epoch, synchronously as well, and the checkpoint refers to that copy. The copy
+# of the previous checkpoint is only removed once the new checkpoint is in place.
+#
+# A TrainingLoop saves its early stopping state, including the weights of its best model, along with the trainer.
+# A loop created with a Checkpointer which restored a checkpoint carries on from that state.
+class Checkpointer:
+    _path: str
+    # _every is the number of epochs between two checkpoints.
+    _every: int
+    _thread: Optional[threading.Thread]
+    _error: Optional[BaseException]
+    # _table_paths holds the paths of the entity table copies the checkpoint on disk refers to.
+    _table_paths: List[str]
+    # _restored holds the checkpoint restored last or None.
+    _restored: Optional[Dict[str, Any]]
+
+    def __init__(self, path: str, every: int = 1) -> None:
+        self._path = path
+        self._every = every
+        self._thread = None
+        self._error = None
+        self._table_paths = []
+        self._restored = None
+
+    # after_epoch saves a checkpoint whenever the trainer finished an epoch which is a multiple of every.
+    def after_epoch(
+        self,
+        trainer: transe.Trainer,
+        loop_state: Optional[Dict[str, Any]] = None,
+        best_model: Optional[transe.TranseModel] = None,
+    ) -> bool:
+        if trainer.epoch() % self._every != 0:
+            return False
+
+        self.save(trainer, loop_state, best_model)
+
+        return True
+
+    # save saves the trainer and optionally the state of the TrainingLoop driving it along with its best model.
+    def save(
+        self,
+        trainer: transe.Trainer,
+        loop_state: Optional[Dict[str, Any]] = None,
+        best_model: Optional[transe.TranseModel] = None,
+    ) -> None:
+        # Only a single checkpoint is written at a time.
+        self.wait()
+
+        snapshot = {
+            "trainer": copy.deepcopy(trainer.state_dict()),
+            "loop": copy.deepcopy(loop_state),
+            "best_model": None,
+            "tables": {},
+        }
+        table_paths = []
+        self._copy_table(trainer.model(), "entities", trainer.epoch(), snapshot, table_paths)
+
+        if best_model is not None:
+            snapshot["best_model"] = copy.deepcopy(best_model.state_dict())
+            self._copy_table(best_model, "best-entities", trainer.epoch(), snapshot, table_paths)
+
+        self._thread = threading.Thread(target=self._write, args=(snapshot, table_paths), daemon=True)
+        self._thread.start()
+
+    # wait blocks until the checkpoint being written is on disk and raises the error of the write if any.
+    def wait(self) -> None:
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    # restore loads the last checkpoint into the trainer. It returns False if there is none.
+    def restore(self, trainer: transe.Trainer) -> bool:
+        self.wait()
+
+        if not os.path.exists(self._path):
+            return False
+
+        with open(self._path, "br") as stream:
+            snapshot = torch.load(stream)
+
+        trainer.load_state_dict(snapshot["trainer"])
+        self._load_table(trainer.model(), "entities", snapshot)
+        self._table_paths = [self._sibling(name) for name in snapshot["tables"].values()]
+        self._restored = snapshot
+
+        return True
+
+    # restored_loop returns the TrainingLoop state of the checkpoint restored last and its best model made
+    # from a copy of model. Both are None when no checkpoint was restored or it was saved without a loop.
+    def restored_loop(self, model: transe.TranseModel) -> Tuple[Optional[Dict[str, Any]], Optional[transe.TranseModel]]:
+        if self._restored is None or self._restored.get("loop") is None:
+            return None, None
+
+        best_model = None
+
+        if self._restored["best_model"] is not None:
+            best_model = copy.deepcopy(model)
+            best_model.load_state_dict(self._restored["best_model"])
+            self._load_table(best_model, "best-entities", self._restored)
+
+        return self._restored["loop"], best_model
+
+    # _copy_table copies the entity table of an mmap-backed model next to the checkpoint as it is now.
+    # The copy is renamed into place by _write.
+    def _copy_table(self, model: transe.TranseModel, name: str, epoch: int, snapshot: Dict[str, Any], table_paths: List[str]) -> None:
+        table = model.entity_table()
+
+        if table is None:
+            return
+
+        table_path = f"{self._path}.{name}-{epoch}"
+        table.copy_table(f"{table_path}.tmp")
+
+        snapshot["tables"][name] = os.path.basename(table_path)
+        table_paths.append(table_path)
+
+    def _load_table(self, model: transe.TranseModel, name: str, snapshot: Dict[str, Any]) -> None:
+        if name not in snapshot["tables"]:
+            return
+
+        table = model.entity_table()
+
+        if table is None:
+            raise ValueError("the checkpoint holds an entity table but the model is not mmap-backed")
+
+        table.load_table(self._sibling(snapshot["tables"][name]))
+
+    def _write(self, snapshot: Dict[str, Any], table_paths: List[str]) -> None:
+        tmp_path = f"{self._path}.tmp"
+
+        try:
+            for table_path in table_paths:
+                os.replace(f"{table_path}.tmp", table_path)
+
+            with open(tmp_path, "bw") as stream:
+                torch.save(snapshot, stream)
+
+            os.replace(tmp_path, self._path)
+
+            for stale_path in set(self._table_paths) - set(table_paths):
+                os.remove(stale_path)
+
+            self._table_paths = table_paths
+        except BaseException as error:
+            self._error = error
+
+    def _sibling(self, name: str) -> str:
+        return os.path.join(os.path.dirname(self._path), name)
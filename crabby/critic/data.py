@@ -1,9 +1,13 @@
-import random
-from typing import List, NamedTuple
+import array
+from typing import List, NamedTuple, Optional, Tuple
 
+import numpy as np
+import scipy.sparse as sparse
 import torch
 import torch.utils.data as torch_data
 
+import crabby.critic.storage as storage
+
 
 class TripletOutOfBoundsError(Exception):
     """
@@ -23,47 +27,212 @@ class Trans(NamedTuple):
     tail: int
 
 
-# Ontology represents the graph as a store of triplets by storing it as an adjacency list.
-# This provides some faster searches...
+# _CsrIndex is a secondary view of the triplets grouped by another key than the head.
+# The triplets of key k are found at _offsets[k]:_offsets[k + 1] of the parallel first and second arrays.
+# _KeyIndex holds every compacted triplet packed into a single int64 key (see _pack_keys) in sorted order
+# along with the (entities_len, relations_len) shape they were packed with. The keys and the shape are only
+# ever replaced together by assigning a new _KeyIndex so a reader on another thread never sees one without the other.
+class _KeyIndex(NamedTuple):
+    keys: np.ndarray
+    shape: Tuple[int, int]
+
+    def contains(self, triplets: np.ndarray) -> np.ndarray:
+        return _contains_keys(self.keys, triplets, self.shape)
+
+
+class _CsrIndex(NamedTuple):
+    offsets: np.ndarray
+    first: np.ndarray
+    second: np.ndarray
+
+    def slice(self, key: int) -> torch.LongTensor:
+        start, stop = self.offsets[key], self.offsets[key + 1]
+
+        return torch.from_numpy(np.stack((self.first[start:stop], self.second[start:stop]), axis=1))
+
+
+# Ontology represents the graph as a store of triplets by storing it in a compressed sparse row (CSR) layout.
+# The neighbours of a head h are found at the positions _offsets[h]:_offsets[h + 1] of the parallel _rels and _tails arrays.
+# Those are contiguous int arrays so there is no per-triplet object overhead and ranges of triplets
+# could be sliced without looping in python.
+#
+# Added triplets go to a delta buffer first so adding them costs time proportional to their count.
+# The delta is merged into the CSR arrays by compact() which happens once the delta outgrows
+# _COMPACTION_RATIO of the compacted triplets or right before triplets are accessed by their idx.
 class Ontology:
-    # _adj_list should be of len _entities
-    _adj_list: List[List[Trans]]
-    # _triplet_counts has the number of encountered triplets in _adj_list after a head is encountered.
-    # It is cumulative.
-    # _triplet_counts has a len of len(_entities) where the last item contains the total number of triplets.
-    # It is used for faster indexing (O(log n) because of binary search) and triplet counting (O(1)).
-    _triplet_counts: List[int]
+    _COMPACTION_RATIO = 0.25
+    _MIN_COMPACTION = 4096
+
+    _STORAGE_KIND = "ontology"
+
+    # _offsets is cumulative: _offsets[h] holds the number of compacted triplets before head h is encountered.
+    # The last item contains the total number of compacted triplets.
+    # It is of len _entities + 1 unless entities were added since the last compaction. Those have no compacted triplets.
+    _offsets: np.ndarray
+    # _rels and _tails are parallel and hold the (rel, tail) pairs of all heads one after another.
+    _rels: np.ndarray
+    _tails: np.ndarray
     # _relations holds the names of the relations.
     _relations: List[str]
     # _entities holds the names of the entities.
     _entities: List[str]
+    # _path is the file the ontology was opened from. It is None for ontologies which were built
+    # in memory or changed after being opened.
+    _path: Optional[str]
+    # _key_index is an optional index used for O(log n) membership tests of whole batches of triplets.
+    # It is None until it is built.
+    _key_index: Optional[_KeyIndex]
+    # _delta_heads, _delta_rels and _delta_tails hold the triplets added since the last compaction.
+    _delta_heads: array.array
+    _delta_rels: array.array
+    _delta_tails: array.array
+    # _delta_keys is the sorted packed keys of the delta. It is built lazily and dropped on every change.
+    _delta_keys: Optional[np.ndarray]
+    # _reverse groups the (head, rel) pairs by tail. It is built lazily and dropped on every compaction.
+    _reverse: Optional[_CsrIndex]
+    # _by_relation groups the (head, tail) pairs by rel. It is built lazily and dropped on every compaction.
+    _by_relation: Optional[_CsrIndex]
 
     def __init__(
         self,
-        adj_list: List[List[Trans]], 
+        adj_list: List[List[Trans]],
         relations: List[str],
         entities: List[str],
+        indexed: bool = False,
     ) -> None:
-        self._adj_list = adj_list
-        self._relations = relations
-        self._entities = entities
+        if len(adj_list) != len(entities):
+            raise Exception(f"adj list length expected to be {len(entities)}, but was {len(adj_list)}")
+
+        offsets, rels, tails = _csr_from_adj_list(adj_list)
+        self._init_storage(offsets, rels, tails, relations, entities, indexed)
+
+    @classmethod
+    def from_csr(
+        cls,
+        offsets: np.ndarray,
+        rels: np.ndarray,
+        tails: np.ndarray,
+        relations: List[str],
+        entities: List[str],
+        indexed: bool = False,
+    ) -> "Ontology":
+        onto = cls.__new__(cls)
+        onto._init_storage(offsets, rels, tails, relations, entities, indexed)
+
+        return onto
+
+    # from_triplets builds the ontology out of parallel head, rel and tail arrays in any order.
+    # The triplets of a head keep their relative order.
+    @classmethod
+    def from_triplets(
+        cls,
+        heads: np.ndarray,
+        rels: np.ndarray,
+        tails: np.ndarray,
+        relations: List[str],
+        entities: List[str],
+        indexed: bool = False,
+    ) -> "Ontology":
+        heads = np.asarray(heads, dtype=np.int64)
+        rels = np.asarray(rels, dtype=np.int64)
+        tails = np.asarray(tails, dtype=np.int64)
+
+        offsets, rels, tails = _csr_from_triplets(heads, rels, tails, len(entities))
+
+        return cls.from_csr(offsets, rels, tails, relations, entities, indexed)
+
+    # open memory-maps an ontology written by save. Nothing but the header is read upfront,
+    # so opening is fast no matter the size and processes opening the same file share its pages.
+    @classmethod
+    def open(cls, path: str) -> "Ontology":
+        arrays, _ = storage.read_arrays(path, kind=cls._STORAGE_KIND)
+
+        onto = cls.from_csr(
+            arrays["offsets"],
+            arrays["rels"],
+            arrays["tails"],
+            relations=storage.StringTable.from_arrays(arrays, "relations"),
+            entities=storage.StringTable.from_arrays(arrays, "entities"),
+        )
+        onto._path = path
+
+        if "keys" in arrays:
+            onto._key_index = _KeyIndex(keys=arrays["keys"], shape=(onto.entities_len(), onto.relations_len()))
+
+        return onto
+
+    def save(self, path: str) -> None:
+        self.compact()
+
+        arrays = {
+            "offsets": self._offsets,
+            "rels": self._rels,
+            "tails": self._tails,
+            **storage.StringTable.encode(self._entities).arrays("entities"),
+            **storage.StringTable.encode(self._relations).arrays("relations"),
+        }
 
-        self._validate_adj_list()
-        self._triplet_counts = self._count_triplets()
+        if self._key_index is not None:
+            arrays["keys"] = self._key_index.keys
+
+        storage.write_arrays(path, kind=self._STORAGE_KIND, arrays=arrays)
 
     def exists(self, triplet: Triplet) -> bool:
-        if not self._entity_exists(triplet.head):
+        head = int(triplet.head)
+
+        if not self._entity_exists(head):
+            return False
+
+        if len(self._delta_heads) > 0 or self._key_index is not None:
+            return bool(self.exists_many(np.array([[head, int(triplet.rel), int(triplet.tail)]]))[0])
+
+        if head >= len(self._offsets) - 1:
             return False
 
-        for trans in self._adj_list[triplet.head]:
-            if trans.rel == triplet.rel and trans.tail == triplet.tail:
-                return True
+        start, stop = self._offsets[head], self._offsets[head + 1]
+        matches = (self._rels[start:stop] == int(triplet.rel)) & (self._tails[start:stop] == int(triplet.tail))
+
+        return bool(matches.any())
+
+    # exists_many checks a whole [N, 3] batch of (head, rel, tail) triplets at once.
+    # The key index gets built on the first call if the ontology was not created as indexed.
+    def exists_many(self, triplets: torch.Tensor) -> torch.BoolTensor:
+        key_index = self._key_index
+
+        if key_index is None:
+            key_index = self._build_index()
+
+        triplets = np.asarray(triplets, dtype=np.int64).reshape(-1, 3)
+        found = key_index.contains(triplets)
+
+        if len(self._delta_heads) > 0:
+            if self._delta_keys is None:
+                self._delta_keys = np.sort(_pack_keys(*self._delta_arrays(), shape=self._shape()))
+
+            found |= _contains_keys(self._delta_keys, triplets, self._shape())
 
-        return False
+        return torch.from_numpy(found)
 
-    # TODO: Remove as it should be a deadcode.
-    # Adding all triplets at once is faster because on each add we need
-    # to update the total triplet counts for correct faster searching.
+    def is_indexed(self) -> bool:
+        return self._key_index is not None
+
+    # An ontology opened from a file is pickled as its path (e.g. when sent to DataLoader workers)
+    # so every process maps the same pages instead of receiving its own copy.
+    def __getstate__(self):
+        if self._path is not None:
+            return {"_path": self._path}
+
+        return self.__dict__
+
+    def __setstate__(self, state) -> None:
+        if set(state.keys()) == {"_path"}:
+            self.__dict__ = type(self).open(state["_path"]).__dict__
+            return
+
+        self.__dict__ = state
+
+    # add_triplets appends the triplets to the delta buffer. Its cost is proportional to the number of
+    # added triplets except for the periodic compactions which are amortized over the added triplets.
     def add_triplets(self, triplets: List[Triplet]) -> None:
         for _, triplet in enumerate(triplets):
             if not self._entity_exists(triplet.head):
@@ -75,23 +244,132 @@ class Ontology:
             if not self._rel_exists(triplet.rel):
                 raise TripletOutOfBoundsError(f"expected rel to be between 0 and {len(self._relations) - 1} but was {triplet.rel}")
 
-            self._adj_list[triplet.head].append(Trans(rel=triplet.rel, tail=triplet.tail))
+        for _, triplet in enumerate(triplets):
+            self._delta_heads.append(int(triplet.head))
+            self._delta_rels.append(int(triplet.rel))
+            self._delta_tails.append(int(triplet.tail))
+
+        self._delta_keys = None
+        self._path = None
+
+        if len(self._delta_heads) > max(self._MIN_COMPACTION, self._COMPACTION_RATIO * self._compacted_len()):
+            self.compact()
+
+    # add_entities grows the entity table and returns the ids of the new entities.
+    def add_entities(self, names: List[str]) -> range:
+        self._entities = self._grown(self._entities, names)
+
+        return range(len(self._entities) - len(names), len(self._entities))
 
-        # Update the length of the graph
-        self._triplet_counts = self._count_triplets()
+    # add_relations grows the relation table and returns the ids of the new relations.
+    def add_relations(self, names: List[str]) -> range:
+        self._relations = self._grown(self._relations, names)
+
+        return range(len(self._relations) - len(names), len(self._relations))
+
+    # compact merges the delta buffer into the CSR arrays and the key index.
+    # A stable sort keeps the new triplets after the already existing ones of the same head.
+    def compact(self) -> None:
+        if len(self._delta_heads) == 0 and len(self._offsets) == len(self._entities) + 1:
+            return
+
+        delta_heads, delta_rels, delta_tails = self._delta_arrays()
+
+        heads = np.concatenate((self._expanded_heads(0, self._compacted_len()), delta_heads))
+        rels = np.concatenate((self._rels, delta_rels))
+        tails = np.concatenate((self._tails, delta_tails))
+
+        self._offsets, self._rels, self._tails = _csr_from_triplets(heads, rels, tails, len(self._entities))
+
+        if self._key_index is not None:
+            if self._key_index.shape == self._shape():
+                # The sorted delta keys are merged into the sorted index without sorting it again.
+                keys = self._key_index.keys
+                delta_keys = np.sort(_pack_keys(delta_heads, delta_rels, delta_tails, shape=self._shape()))
+                self._key_index = _KeyIndex(keys=np.insert(keys, np.searchsorted(keys, delta_keys), delta_keys), shape=self._shape())
+            else:
+                # The packing of the keys depends on the table sizes so growing them invalidates the keys.
+                self._build_index()
+
+        self._delta_heads = array.array("q")
+        self._delta_rels = array.array("q")
+        self._delta_tails = array.array("q")
+        self._delta_keys = None
+        self._reverse = None
+        self._by_relation = None
+        self._path = None
+
+    # outgoing returns the (rel, tail) pairs of a head as a [n, 2] tensor.
+    def outgoing(self, head: int) -> torch.LongTensor:
+        if not self._entity_exists(head):
+            raise TripletOutOfBoundsError(f"expected head to be between 0 and {len(self._entities) - 1} but was {head}")
+
+        self.compact()
+
+        return _CsrIndex(self._offsets, self._rels, self._tails).slice(head)
+
+    # incoming returns the (head, rel) pairs pointing at a tail as a [n, 2] tensor.
+    def incoming(self, tail: int) -> torch.LongTensor:
+        if not self._entity_exists(tail):
+            raise TripletOutOfBoundsError(f"expected tail to be between 0 and {len(self._entities) - 1} but was {tail}")
+
+        return self._reverse_index().slice(tail)
+
+    # relation_pairs returns the (head, tail) pairs of a relation as a [n, 2] tensor.
+    def relation_pairs(self, rel: int) -> torch.LongTensor:
+        if not self._rel_exists(rel):
+            raise TripletOutOfBoundsError(f"expected rel to be between 0 and {len(self._relations) - 1} but was {rel}")
+
+        return self._relation_index().slice(rel)
+
+    # adjacency exports the triplets of the given relations (all of them by default) as a sparse
+    # [entities_len, entities_len] matrix where the entry (h, t) counts the triplets from h to t.
+    def adjacency(self, rels: Optional[List[int]] = None) -> sparse.csr_matrix:
+        if rels is None:
+            rels = range(len(self._relations))
+
+        index = self._relation_index()
+        heads, tails = [], []
+
+        for rel in rels:
+            if not self._rel_exists(rel):
+                raise TripletOutOfBoundsError(f"expected rel to be between 0 and {len(self._relations) - 1} but was {rel}")
+
+            start, stop = index.offsets[rel], index.offsets[rel + 1]
+            heads.append(index.first[start:stop])
+            tails.append(index.second[start:stop])
+
+        heads = np.concatenate(heads) if heads else np.zeros(0, dtype=np.int64)
+        tails = np.concatenate(tails) if tails else np.zeros(0, dtype=np.int64)
+
+        # Duplicated (h, t) entries are summed up when converting to CSR.
+        return sparse.coo_matrix(
+            (np.ones(len(heads), dtype=np.int64), (heads, tails)),
+            shape=(len(self._entities), len(self._entities)),
+        ).tocsr()
 
     def triplets_len(self) -> int:
-        return self._triplet_counts[len(self._triplet_counts) - 1]
+        return self._compacted_len() + len(self._delta_heads)
 
     def get_triplet(self, triplet_idx: int) -> Triplet:
+        if not self._triplet_exists(triplet_idx):
+            raise TripletOutOfBoundsError(f"Expected triplet idx {triplet_idx} to be between 0 and {self.triplets_len() - 1} inclusively.")
+
+        self.compact()
         head = self._head_for_triplet_at(triplet_idx)
 
-        neigbours = self._adj_list[head]
-        trans_idx = triplet_idx - (self._triplet_counts[head] - len(neigbours))
+        return Triplet(head=head, rel=int(self._rels[triplet_idx]), tail=int(self._tails[triplet_idx]))
 
-        trans = neigbours[trans_idx]
-        
-        return Triplet(head=head, rel=trans.rel, tail=trans.tail)
+    # triplets_range returns the triplets with indices in [start, stop) as a [stop - start, 3] tensor
+    # of (head, rel, tail) rows. The rel and tail columns are plain slices of the CSR arrays.
+    def triplets_range(self, start: int, stop: int) -> torch.LongTensor:
+        if start < 0 or stop > self.triplets_len() or start > stop:
+            raise TripletOutOfBoundsError(f"Expected triplet range [{start}, {stop}) to be within [0, {self.triplets_len()}).")
+
+        self.compact()
+        heads = self._expanded_heads(start, stop)
+
+        return torch.from_numpy(np.stack((heads, self._rels[start:stop], self._tails[start:stop]), axis=1))
 
     def entities_len(self) -> int:
         return len(self._entities)
@@ -99,45 +377,108 @@ class Ontology:
     def relations_len(self) -> int:
         return len(self._relations)
 
-    def _validate_adj_list(self) -> None:
-        if len(self._adj_list) != len(self._entities):
-            raise Exception(f"adj list length expected to be {len(self._entities)}, but was {len(self._adj_list)}")
+    def _init_storage(
+        self,
+        offsets: np.ndarray,
+        rels: np.ndarray,
+        tails: np.ndarray,
+        relations: List[str],
+        entities: List[str],
+        indexed: bool,
+    ) -> None:
+        self._offsets = np.ascontiguousarray(offsets, dtype=np.int64)
+        self._rels = np.ascontiguousarray(rels, dtype=np.int64)
+        self._tails = np.ascontiguousarray(tails, dtype=np.int64)
+        self._relations = relations
+        self._entities = entities
+        self._path = None
+        self._key_index = None
+        self._delta_heads = array.array("q")
+        self._delta_rels = array.array("q")
+        self._delta_tails = array.array("q")
+        self._delta_keys = None
+        self._reverse = None
+        self._by_relation = None
+
+        self._validate_csr()
+
+        if indexed:
+            self._build_index()
+
+    # _build_index builds the key index and publishes it with a single assignment which is safe to race with
+    # exists_many on other threads such as the validation thread of TrainingLoop or the Prefetcher producer.
+    def _build_index(self) -> _KeyIndex:
+        # The packed keys of all possible triplets have to fit into an int64.
+        if len(self._entities) ** 2 * len(self._relations) > np.iinfo(np.int64).max:
+            raise Exception(f"can not index {len(self._entities)} entities and {len(self._relations)} relations into int64 keys")
+
+        keys = _pack_keys(self._expanded_heads(0, self._compacted_len()), self._rels, self._tails, shape=self._shape())
+        keys.sort()
+
+        self._key_index = _KeyIndex(keys=keys, shape=self._shape())
+
+        return self._key_index
+
+    def _reverse_index(self) -> _CsrIndex:
+        self.compact()
+
+        if self._reverse is None:
+            heads = self._expanded_heads(0, self._compacted_len())
+            self._reverse = _csr_index(self._tails, heads, self._rels, len(self._entities))
+
+        return self._reverse
+
+    def _relation_index(self) -> _CsrIndex:
+        self.compact()
+
+        if self._by_relation is None:
+            heads = self._expanded_heads(0, self._compacted_len())
+            self._by_relation = _csr_index(self._rels, heads, self._tails, len(self._relations))
+
+        return self._by_relation
 
-    def _count_triplets(self) -> List[int]:
-        total_triplets = 0
-        triplet_counts = []
+    def _shape(self) -> Tuple[int, int]:
+        return len(self._entities), len(self._relations)
 
-        for head in range(len(self._adj_list)):
-            total_triplets += len(self._adj_list[head])
-            triplet_counts.append(total_triplets)
+    def _compacted_len(self) -> int:
+        return int(self._offsets[-1])
 
-        return triplet_counts
+    def _delta_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return (
+            np.array(self._delta_heads, dtype=np.int64),
+            np.array(self._delta_rels, dtype=np.int64),
+            np.array(self._delta_tails, dtype=np.int64),
+        )
+
+    # _grown appends names to a name table. Tables opened from a file are read-only so they get copied into a list once.
+    def _grown(self, table: List[str], names: List[str]) -> List[str]:
+        if not isinstance(table, list):
+            table = list(table)
+
+        table.extend(names)
+
+        self._delta_keys = None
+        self._reverse = None
+        self._by_relation = None
+        self._path = None
+
+        return table
+
+    def _validate_csr(self) -> None:
+        if len(self._offsets) != len(self._entities) + 1:
+            raise Exception(f"offsets length expected to be {len(self._entities) + 1}, but was {len(self._offsets)}")
+
+        if len(self._rels) != self.triplets_len() or len(self._tails) != self.triplets_len():
+            raise Exception(f"rels and tails length expected to be {self.triplets_len()}, but were {len(self._rels)} and {len(self._tails)}")
 
     def _head_for_triplet_at(self, idx: int) -> int:
-        left = 0
-        right = len(self._triplet_counts) - 1
-        
-        if not self._triplet_exists(idx):
-            raise TripletOutOfBoundsError(f"Expected triplet idx {idx} to be between 0 and {self.triplets_len() - 1} inclusively.")
-        
-        # Done because every item of _triplet_counts contains the number of
-        # triplets for the given head.
-        idx += 1
-        
-        while left < right:
-            mid = left + (right - left) // 2
-
-            # TODO: Fix this ugly bugger.
-            if self._triplet_counts[mid] == idx and mid > 0 and self._triplet_counts[mid -1] < idx:
-                return mid
-            elif self._triplet_counts[mid] < idx:
-                left = mid + 1
-            else:
-                right = mid
-        
-        # left can never become greater than right and we have a sparse representation where
-        # an idx of a triplet would most probably not be found in an array but is a valid idx.
-        return left
+        # The head owning a triplet is the last one whose offset is not past the idx.
+        # Heads without triplets share their offset with the next one so searching from
+        # the right skips them.
+        return int(np.searchsorted(self._offsets, idx, side="right")) - 1
+
+    def _expanded_heads(self, start: int, stop: int) -> np.ndarray:
+        return np.searchsorted(self._offsets, np.arange(start, stop, dtype=np.int64), side="right") - 1
 
     def _entity_exists(self, entity: int) -> bool:
         return entity >= 0 and entity <= len(self._entities) - 1
@@ -149,25 +490,186 @@ class Ontology:
         return idx >= 0 and idx <= self.triplets_len() - 1
 
 
-def corrupted_counterparts(onto: Ontology, triplets: torch.IntTensor) -> List[Triplet]:
-    corrupted_triplets = torch.clone(triplets)
-        
-    for _, triplet in enumerate(corrupted_triplets):
-        _corrupt(onto, triplet)
+# _pack_keys maps (head, rel, tail) into the single key (head * relations_len + rel) * entities_len + tail
+# where shape is (entities_len, relations_len). Sorting by the keys orders triplets by head, then rel, then tail.
+def _pack_keys(heads: np.ndarray, rels: np.ndarray, tails: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    entities_len, relations_len = shape
+
+    return (heads * relations_len + rels) * entities_len + tails
+
+
+# _contains_keys tells which of the [N, 3] triplets are found in sorted_keys packed with the given shape.
+# Triplets out of the shape could not have been packed so they are never found.
+def _contains_keys(sorted_keys: np.ndarray, triplets: np.ndarray, shape: Tuple[int, int]) -> np.ndarray:
+    entities_len, relations_len = shape
+    heads, rels, tails = triplets[:, 0], triplets[:, 1], triplets[:, 2]
+
+    in_bounds = (
+        (heads >= 0) & (heads < entities_len)
+        & (rels >= 0) & (rels < relations_len)
+        & (tails >= 0) & (tails < entities_len)
+    )
+
+    keys = _pack_keys(np.where(in_bounds, heads, 0), np.where(in_bounds, rels, 0), np.where(in_bounds, tails, 0), shape)
+    positions = np.searchsorted(sorted_keys, keys)
+    found = positions < len(sorted_keys)
+    found[found] = sorted_keys[positions[found]] == keys[found]
+
+    return found & in_bounds
+
+
+def _csr_from_adj_list(adj_list: List[List[Trans]]) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    counts = np.fromiter((len(neighbours) for neighbours in adj_list), dtype=np.int64, count=len(adj_list))
+
+    offsets = np.zeros(len(adj_list) + 1, dtype=np.int64)
+    np.cumsum(counts, out=offsets[1:])
 
-    return corrupted_triplets
+    total = int(offsets[-1])
+    rels = np.fromiter((trans.rel for neighbours in adj_list for trans in neighbours), dtype=np.int64, count=total)
+    tails = np.fromiter((trans.tail for neighbours in adj_list for trans in neighbours), dtype=np.int64, count=total)
 
+    return offsets, rels, tails
 
-def _corrupt(onto: Ontology, triplet: torch.IntTensor) -> None:
-    corrupted_entity_idx = random.randint(0, onto.entities_len() - 1)
 
-    # To pick a triplet side toss the coin:
-    # ---> Heads
-    if random.randint(0, 1) == 0:
-        triplet[0] = corrupted_entity_idx
-    # ---> Tails
-    else:
-        triplet[2] = corrupted_entity_idx
+def _csr_index(keys: np.ndarray, first: np.ndarray, second: np.ndarray, keys_len: int) -> _CsrIndex:
+    order = np.argsort(keys, kind="stable")
+
+    offsets = np.zeros(keys_len + 1, dtype=np.int64)
+    np.cumsum(np.bincount(keys, minlength=keys_len), out=offsets[1:])
+
+    return _CsrIndex(offsets=offsets, first=first[order], second=second[order])
+
+
+def _csr_from_triplets(
+    heads: np.ndarray,
+    rels: np.ndarray,
+    tails: np.ndarray,
+    entities_len: int,
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    index = _csr_index(heads, rels, tails, entities_len)
+
+    return index.offsets, index.first, index.second
+
+
+def corrupted_counterparts(onto: Ontology, triplets: torch.IntTensor) -> torch.LongTensor:
+    return NegativeSampler(onto).sample(triplets)
+
+
+# triplets_isin tells which of the [N, 3] triplets are among the [M, 3] others, like np.isin does for scalars.
+# Both are packed into keys with the entity and relation counts of onto so the check is a sort and a binary
+# search. Triplets out of the bounds of onto are never found.
+def triplets_isin(onto: Ontology, triplets: torch.Tensor, others: torch.Tensor) -> torch.BoolTensor:
+    shape = (onto.entities_len(), onto.relations_len())
+    others = np.asarray(others, dtype=np.int64).reshape(-1, 3)
+    keys = np.sort(_pack_keys(others[:, 0], others[:, 1], others[:, 2], shape=shape))
+
+    return torch.from_numpy(_contains_keys(keys, np.asarray(triplets, dtype=np.int64).reshape(-1, 3), shape))
+
+
+# NegativeSampler corrupts whole batches of triplets at once by replacing either their head or their tail
+# with a random entity. The random draws are done by a single torch call per batch instead of a python loop.
+class NegativeSampler:
+    # UNIFORM picks the corrupted side with a fair coin toss.
+    UNIFORM = "unif"
+    # BERNOULLI picks the head of a triplet of relation r with probability tph / (tph + hpt) where tph is
+    # the average number of tails per head and hpt the average number of heads per tail for r.
+    # That way the tails of one-to-many relations (and the heads of many-to-one ones) are corrupted less often
+    # which produces fewer false negatives.
+    BERNOULLI = "bern"
+
+    _onto: Ontology
+    _k: int
+    # _filtered makes the sampler redraw every corruption which happens to be a known triplet.
+    _filtered: bool
+    _max_retries: int
+    # _generator is None whenever the global torch RNG should be used.
+    _generator: Optional[torch.Generator]
+    # _head_probs holds the probability of corrupting the head for every relation.
+    _head_probs: torch.FloatTensor
+
+    def __init__(
+        self,
+        onto: Ontology,
+        mode: str = UNIFORM,
+        k: int = 1,
+        filtered: bool = False,
+        seed: Optional[int] = None,
+        max_retries: int = 10,
+    ) -> None:
+        if mode not in (self.UNIFORM, self.BERNOULLI):
+            raise ValueError(f"expected mode to be one of {self.UNIFORM} or {self.BERNOULLI} but was {mode}")
+
+        if k < 1:
+            raise ValueError(f"expected k to be at least 1 but was {k}")
+
+        self._onto = onto
+        self._k = k
+        self._filtered = filtered
+        self._max_retries = max_retries
+
+        self._generator = None
+
+        if seed is not None:
+            self._generator = torch.Generator()
+            self._generator.manual_seed(seed)
+
+        if mode == self.BERNOULLI:
+            self._head_probs = self._bernoulli_head_probs()
+        else:
+            self._head_probs = torch.full((onto.relations_len(),), 0.5)
+
+    # sample returns k corruptions for each of the given triplets as a [len(triplets) * k, 3] tensor.
+    # The corruptions of the i-th triplet are found at rows i * k up to (i + 1) * k.
+    def sample(self, triplets: torch.Tensor) -> torch.LongTensor:
+        negatives = triplets.long().repeat_interleave(self._k, dim=0)
+
+        corrupt_heads = torch.rand(len(negatives), generator=self._generator) < self._head_probs[negatives[:, 1]]
+        # 0 is the position of the head and 2 the position of the tail in a triplet.
+        sides = (~corrupt_heads).long() * 2
+        rows = torch.arange(len(negatives))
+
+        negatives[rows, sides] = self._random_entities(len(negatives))
+
+        if not self._filtered:
+            return negatives
+
+        for _ in range(self._max_retries):
+            known = self._onto.exists_many(negatives)
+
+            if not known.any():
+                break
+
+            # Only the known triplets are redrawn and they keep their corrupted side.
+            negatives[rows[known], sides[known]] = self._random_entities(int(known.sum()))
+
+        return negatives
+
+    def k(self) -> int:
+        return self._k
+
+    def generator(self) -> Optional[torch.Generator]:
+        return self._generator
+
+    def _random_entities(self, n: int) -> torch.LongTensor:
+        return torch.randint(0, self._onto.entities_len(), (n,), generator=self._generator)
+
+    def _bernoulli_head_probs(self) -> torch.FloatTensor:
+        triplets = self._onto.triplets_range(0, self._onto.triplets_len()).numpy()
+        heads, rels, tails = triplets[:, 0], triplets[:, 1], triplets[:, 2]
+        relations_len = self._onto.relations_len()
+
+        triplet_counts = np.bincount(rels, minlength=relations_len)
+        # The number of distinct (rel, head) and (rel, tail) pairs of every relation.
+        distinct_heads = np.bincount(np.unique(rels * self._onto.entities_len() + heads) // self._onto.entities_len(), minlength=relations_len)
+        distinct_tails = np.bincount(np.unique(rels * self._onto.entities_len() + tails) // self._onto.entities_len(), minlength=relations_len)
+
+        # Relations without any triplets fall back to a fair coin toss.
+        with np.errstate(divide="ignore", invalid="ignore"):
+            tails_per_head = triplet_counts / distinct_heads
+            heads_per_tail = triplet_counts / distinct_tails
+            head_probs = np.where(triplet_counts > 0, tails_per_head / (tails_per_head + heads_per_tail), 0.5)
+
+        return torch.from_numpy(head_probs).float()
 
 
 class TripletDataset(torch_data.Dataset):
@@ -184,3 +686,74 @@ class TripletDataset(torch_data.Dataset):
         triplet = self._onto.get_triplet(idx)
         
         return torch.tensor([triplet.head, triplet.rel, triplet.tail])
+
+    # triplets returns all triplets of the ontology as a [N, 3] tensor in a single pass.
+    def triplets(self) -> torch.LongTensor:
+        return self._onto.triplets_range(0, self._onto.triplets_len())
+
+
+# TripletTensorDataset keeps all triplets of an ontology in a single pre-materialized [N, 3] tensor.
+# Indexing it with a batch of indices gathers the whole minibatch at once so there are no per-item tensors
+# to be collated. It should be paired with a TripletBatchSampler and a DataLoader without automatic batching:
+#
+#   DataLoader(dataset, sampler=TripletBatchSampler(len(dataset), batch_size=64), batch_size=None)
+class TripletTensorDataset(torch_data.Dataset):
+    _triplets: torch.LongTensor
+
+    def __init__(self, onto: Ontology) -> None:
+        super().__init__()
+        self._triplets = onto.triplets_range(0, onto.triplets_len())
+
+    def __len__(self) -> int:
+        return len(self._triplets)
+
+    # __getitem__ accepts either a single index or a tensor of indices.
+    def __getitem__(self, idx):
+        return self._triplets[idx]
+
+    def triplets(self) -> torch.LongTensor:
+        return self._triplets
+
+
+# TripletBatchSampler yields whole minibatches of indices instead of single ones.
+class TripletBatchSampler(torch_data.Sampler):
+    _dataset_len: int
+    _batch_size: int
+    _shuffle: bool
+    _drop_last: bool
+    _generator: Optional[torch.Generator]
+
+    def __init__(
+        self,
+        dataset_len: int,
+        batch_size: int,
+        shuffle: bool = True,
+        drop_last: bool = False,
+        generator: Optional[torch.Generator] = None,
+    ) -> None:
+        self._dataset_len = dataset_len
+        self._batch_size = batch_size
+        self._shuffle = shuffle
+        self._drop_last = drop_last
+        self._generator = generator
+
+    def __iter__(self):
+        if self._shuffle:
+            indices = torch.randperm(self._dataset_len, generator=self._generator)
+        else:
+            indices = torch.arange(self._dataset_len)
+
+        for batch in torch.split(indices, self._batch_size):
+            if self._drop_last and len(batch) < self._batch_size:
+                return
+
+            yield batch
+
+    def __len__(self) -> int:
+        if self._drop_last:
+            return self._dataset_len // self._batch_size
+
+        return (self._dataset_len + self._batch_size - 1) // self._batch_size
+
+    def generator(self) -> Optional[torch.Generator]:
+        return self._generator
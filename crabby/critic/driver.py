@@ -0,0 +1,157 @@
+import concurrent.futures as futures
+import copy
+from typing import Any, Dict, List, NamedTuple, Optional
+
+import crabby.critic.checkpoint as checkpoint
+import crabby.critic.metric as metric
+import crabby.critic.transe as transe
+
+
+class ValidationResult(NamedTuple):
+    epoch: int
+    bundle: metric.RankingBundle
+
+
+# TrainingLoop drives a Trainer epoch by epoch with early stopping.
+# Every validate_every epochs a frozen copy of the model is validated by a background thread
+# so training goes on in the meantime. When a validation is due while the previous one is still
+# running it is skipped rather than waited for. Training stops after patience validations in a row
+# without a better filtered MRR and the model gets the weights of the best validated copy.
+# With a checkpointer the early stopping state is saved along with the trainer. A loop created with a
+# checkpointer which restored a checkpoint carries on from its state, only a validation still running
+# when the checkpoint was saved is lost.
+class TrainingLoop:
+    _trainer: transe.Trainer
+    _calculator: metric.Calculator
+    _validate_every: int
+    _patience: int
+    _max_epochs: int
+    _checkpointer: Optional[checkpoint.Checkpointer]
+    _executor: futures.ThreadPoolExecutor
+    _pending: Optional[futures.Future]
+    _pending_snapshot: Optional[transe.TranseModel]
+    _pending_epoch: int
+    _best: Optional[ValidationResult]
+    _best_snapshot: Optional[transe.TranseModel]
+    # _stale_count is the number of validations since the best one.
+    _stale_count: int
+    _history: List[ValidationResult]
+
+    def __init__(
+        self,
+        trainer: transe.Trainer,
+        calculator: metric.Calculator,
+        validate_every: int = 5,
+        patience: int = 3,
+        max_epochs: int = 100,
+        checkpointer: Optional[checkpoint.Checkpointer] = None,
+    ) -> None:
+        self._trainer = trainer
+        self._calculator = calculator
+        self._validate_every = validate_every
+        self._patience = patience
+        self._max_epochs = max_epochs
+        self._checkpointer = checkpointer
+
+        self._executor = futures.ThreadPoolExecutor(max_workers=1)
+        self._pending = None
+        self._pending_snapshot = None
+        self._pending_epoch = 0
+        self._best = None
+        self._best_snapshot = None
+        self._stale_count = 0
+        self._history = []
+
+        if checkpointer is not None:
+            state, best_snapshot = checkpointer.restored_loop(trainer.model())
+
+            if state is not None:
+                self.load_state_dict(state)
+                self._best_snapshot = best_snapshot
+
+    # run trains until max_epochs or until early stopping and returns the best validation result.
+    def run(self) -> Optional[ValidationResult]:
+        while self._trainer.epoch() < self._max_epochs and not self._should_stop():
+            self._trainer.train_one_epoch()
+            # Finished validations are collected first so the checkpoint holds them.
+            self._collect(block=False)
+
+            if self._checkpointer is not None:
+                self._checkpointer.after_epoch(self._trainer, self.state_dict(), self._best_snapshot)
+
+            if self._trainer.epoch() % self._validate_every == 0:
+                self._validate()
+
+        # The last validation is waited for as it might still be the best one.
+        self._collect(block=True)
+        self._executor.shutdown()
+
+        if self._checkpointer is not None:
+            self._checkpointer.wait()
+
+        if self._best_snapshot is not None:
+            self._trainer.model().copy_from(self._best_snapshot)
+
+        return self._best
+
+    def best(self) -> Optional[ValidationResult]:
+        return self._best
+
+    def history(self) -> List[ValidationResult]:
+        return self._history
+
+    # state_dict holds the early stopping state but the best model which is saved on its own.
+    # The results are plain lists so the state could be loaded with torch.load(weights_only=True).
+    def state_dict(self) -> Dict[str, Any]:
+        return {
+            "best": _result_state(self._best) if self._best is not None else None,
+            "stale_count": self._stale_count,
+            "history": [_result_state(result) for result in self._history],
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._best = _result(state["best"]) if state["best"] is not None else None
+        self._stale_count = state["stale_count"]
+        self._history = [_result(result_state) for result_state in state["history"]]
+
+    def _validate(self) -> None:
+        if self._pending is not None:
+            print(f"[Epoch {self._trainer.epoch()}] Skipping validation as the previous one is still running")
+            return
+
+        snapshot = copy.deepcopy(self._trainer.model())
+        snapshot.eval()
+
+        self._pending = self._executor.submit(self._calculator.evaluate, snapshot)
+        self._pending_snapshot = snapshot
+        self._pending_epoch = self._trainer.epoch()
+
+    def _collect(self, block: bool) -> None:
+        if self._pending is None or (not block and not self._pending.done()):
+            return
+
+        result = ValidationResult(epoch=self._pending_epoch, bundle=self._pending.result())
+        self._history.append(result)
+
+        print(f"[Epoch {result.epoch}] Validation filtered MRR ---> {result.bundle.mrr}")
+
+        if self._best is None or result.bundle.mrr > self._best.bundle.mrr:
+            self._best = result
+            self._best_snapshot = self._pending_snapshot
+            self._stale_count = 0
+        else:
+            self._stale_count += 1
+
+        self._pending = None
+        self._pending_snapshot = None
+
+    def _should_stop(self) -> bool:
+        return self._stale_count >= self._patience
+
+
+def _result_state(result: ValidationResult) -> List[float]:
+    return [result.epoch, *result.bundle]
+
+
+def _result(result_state: List[float]) -> ValidationResult:
+    return ValidationResult(epoch=int(result_state[0]), bundle=metric.RankingBundle(*result_state[1:]))
@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+import weakref
+from typing import Optional
+
+import numpy as np
+import torch
+
+import crabby.critic.storage as storage
+
+
+# MmapEmbedding is an embedding table which lives in a memory-mapped file. Only a fixed number of rows,
+# the ones used the most recently, are held in RAM in weight and the least recently used ones are evicted
+# when new rows have to be loaded. Rows modified in RAM are written back to the file on eviction and on flush.
+#
+# weight is a cache: its rows are reassigned to different entities over time so it has to be paired with an
+# optimizer which does not keep per-row state such as SGD. For the same reason weight isn't part of the
+# state_dict: the file holds the table and copy_table and load_table take and restore a copy of it (Checkpointer
+# does that). A deep copy is a frozen snapshot of the table in a file of its own next to it which is removed once
+# the copy is garbage collected. The rows of a minibatch have to fit into the cache at once.
+class MmapEmbedding(torch.nn.Module):
+    _STORAGE_KIND = "embedding"
+
+    _path: str
+    _table: np.ndarray
+    _capacity: int
+    # _slot_of holds the slot of weight caching every row of the table or -1.
+    _slot_of: np.ndarray
+    # _owners holds the row of the table cached by every slot or -1.
+    _owners: np.ndarray
+    # _last_used holds the clock of the last access to every slot. Free slots are at -1 so they are taken first.
+    _last_used: np.ndarray
+    _dirty: np.ndarray
+    _clock: int
+
+    def __init__(self, path: str, capacity: int) -> None:
+        super(MmapEmbedding, self).__init__()
+
+        arrays, _ = storage.read_arrays(path, kind=self._STORAGE_KIND, writable=True)
+
+        self._path = path
+        self._table = arrays["rows"]
+        self._capacity = min(capacity, len(self._table))
+        self._slot_of = np.full(len(self._table), -1, dtype=np.int64)
+        self._owners = np.full(self._capacity, -1, dtype=np.int64)
+        self._last_used = np.full(self._capacity, -1, dtype=np.int64)
+        self._dirty = np.zeros(self._capacity, dtype=bool)
+        self._clock = 0
+
+        self.weight = torch.nn.Parameter(torch.zeros(self._capacity, self._table.shape[1]))
+
+    # create writes a table of [num_embeddings, embedding_dim] rows drawn uniformly from [low, high) to path
+    # chunk by chunk so the table never has to fit into memory.
+    @classmethod
+    def create(
+            cls,
+            path: str,
+            num_embeddings: int,
+            embedding_dim: int,
+            capacity: int,
+            low: float = -1.0,
+            high: float = 1.0,
+            chunk_size: int = 65536,
+    ) -> "MmapEmbedding":
+        rows = storage.allocate_arrays(path, kind=cls._STORAGE_KIND, shapes={"rows": ((num_embeddings, embedding_dim), np.float32)})["rows"]
+
+        for start in range(0, num_embeddings, chunk_size):
+            stop = min(start + chunk_size, num_embeddings)
+            rows[start:stop] = ((high - low) * torch.rand(stop - start, embedding_dim) + low).numpy()
+
+        rows.flush()
+
+        return cls(path, capacity)
+
+    def forward(self, ids: torch.Tensor) -> torch.FloatTensor:
+        slots = self.resident(ids, dirty=self.training and torch.is_grad_enabled())
+
+        return torch.nn.functional.embedding(slots, self.weight, sparse=True)
+
+    def num_embeddings(self) -> int:
+        return len(self._table)
+
+    def embedding_dim(self) -> int:
+        return self._table.shape[1]
+
+    def capacity(self) -> int:
+        return self._capacity
+
+    def path(self) -> str:
+        return self._path
+
+    # resident loads the rows of ids into the cache if needed and returns the slots of weight holding them.
+    # With dirty set the rows are written back to the file once evicted.
+    @torch.no_grad()
+    def resident(self, ids: torch.Tensor, dirty: bool = False) -> torch.LongTensor:
+        ids_array = ids.numpy() if isinstance(ids, torch.Tensor) else np.asarray(ids)
+        rows = np.unique(ids_array)
+
+        if len(rows) > self._capacity:
+            raise ValueError(f"{len(rows)} rows do not fit into a cache of {self._capacity} rows")
+
+        self._clock += 1
+        slots = self._slot_of[rows]
+        hit = slots >= 0
+        self._last_used[slots[hit]] = self._clock
+
+        misses = rows[~hit]
+
+        if len(misses) > 0:
+            self._load(misses)
+
+        slots = self._slot_of[rows]
+
+        if dirty:
+            self._dirty[slots] = True
+
+        return torch.from_numpy(self._slot_of[ids_array])
+
+    # rows returns the rows of [start, stop) as a new tensor. Rows in the cache are taken from it as they
+    # may be newer than the file. It does not touch the cache.
+    @torch.no_grad()
+    def rows(self, start: int = 0, stop: Optional[int] = None) -> torch.FloatTensor:
+        stop = self.num_embeddings() if stop is None else min(stop, self.num_embeddings())
+        rows = torch.from_numpy(np.array(self._table[start:stop]))
+
+        slots = self._slot_of[start:stop]
+        cached = np.flatnonzero(slots >= 0)
+        rows[cached] = self.weight[slots[cached]]
+
+        return rows
+
+    # lookup returns the rows of ids as a new tensor like rows does. Rows which aren't cached are read from the
+    # file without being loaded into the cache so evaluation neither evicts the training rows nor needs them to fit.
+    @torch.no_grad()
+    def lookup(self, ids: torch.Tensor) -> torch.FloatTensor:
+        ids_array = ids.numpy() if isinstance(ids, torch.Tensor) else np.asarray(ids)
+        slots = self._slot_of[ids_array]
+        cached = slots >= 0
+
+        rows = torch.empty(*ids_array.shape, self.embedding_dim())
+        rows[torch.from_numpy(cached)] = self.weight[slots[cached]]
+        rows[torch.from_numpy(~cached)] = torch.from_numpy(np.array(self._table[ids_array[~cached]]))
+
+        return rows
+
+    # flush writes the dirty rows of the cache back to the file and syncs it.
+    @torch.no_grad()
+    def flush(self) -> None:
+        dirty = np.flatnonzero(self._dirty)
+
+        self._table[self._owners[dirty]] = self.weight[dirty].numpy()
+        self._dirty[dirty] = False
+        self._table.flush()
+
+    # copy_table writes the table as of now, including the rows modified in RAM, to a new file at path.
+    def copy_table(self, path: str) -> None:
+        self.flush()
+        shutil.copyfile(self._path, path)
+
+    # load_table replaces all rows of the table, cached ones included, with the rows of the table at path
+    # such as one written by copy_table. The rows are copied chunk by chunk so they never have to fit into memory.
+    @torch.no_grad()
+    def load_table(self, path: str, chunk_size: int = 65536) -> None:
+        arrays, _ = storage.read_arrays(path, kind=self._STORAGE_KIND)
+        rows = arrays["rows"]
+
+        if rows.shape != self._table.shape:
+            raise ValueError(f"expected a table of {self._table.shape[0]}x{self._table.shape[1]} rows")
+
+        for start in range(0, len(rows), chunk_size):
+            self._table[start:start + chunk_size] = rows[start:start + chunk_size]
+
+        self._table.flush()
+
+        cached = np.flatnonzero(self._owners >= 0)
+        self.weight[cached] = torch.from_numpy(np.array(self._table[self._owners[cached]]))
+        self._dirty[:] = False
+
+    def __deepcopy__(self, memo) -> "MmapEmbedding":
+        fd, path = tempfile.mkstemp(prefix=f"{os.path.basename(self._path)}.", suffix=".snapshot", dir=os.path.dirname(self._path) or None)
+        os.close(fd)
+
+        self.copy_table(path)
+
+        snapshot = MmapEmbedding(path, self._capacity)
+        snapshot.train(self.training)
+        weakref.finalize(snapshot, _remove_file, path)
+        memo[id(self)] = snapshot
+
+        return snapshot
+
+    # A pickled table is flushed first and maps the same file once unpickled.
+    def __getstate__(self):
+        self.flush()
+
+        state = self.__dict__.copy()
+        state["_table"] = None
+
+        return state
+
+    def __setstate__(self, state) -> None:
+        super(MmapEmbedding, self).__setstate__(state)
+
+        arrays, _ = storage.read_arrays(self._path, kind=self._STORAGE_KIND, writable=True)
+        self._table = arrays["rows"]
+
+    def _load(self, misses: np.ndarray) -> None:
+        # The slots used by the current access are at the latest clock so the least recently used ones are
+        # never among them as long as the access fits into the cache.
+        if len(misses) < self._capacity:
+            victims = np.argpartition(self._last_used, len(misses) - 1)[:len(misses)]
+        else:
+            victims = np.arange(self._capacity)
+
+        evicted = self._owners[victims] >= 0
+        written = victims[evicted & self._dirty[victims]]
+
+        self._table[self._owners[written]] = self.weight[written].numpy()
+        self._slot_of[self._owners[victims[evicted]]] = -1
+
+        self.weight[victims] = torch.from_numpy(np.array(self._table[misses]))
+        self._owners[victims] = misses
+        self._slot_of[misses] = victims
+        self._last_used[victims] = self._clock
+        self._dirty[victims] = False
+
+    # The cache isn't part of the state: the table is the file.
+    def _save_to_state_dict(self, destination, prefix, keep_vars) -> None:
+        pass
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict, missing_keys, unexpected_keys, error_msgs) -> None:
+        pass
+
+
+def _remove_file(path: str) -> None:
+    if os.path.exists(path):
+        os.remove(path)
@@ -0,0 +1,170 @@
+import array
+import bz2
+import gzip
+import re
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Pattern, TextIO, Tuple
+
+import numpy as np
+
+import crabby.critic.data as data
+
+
+class IngestionStats(NamedTuple):
+    triplets: int
+    entities: int
+    relations: int
+    # skipped counts the lines which were neither triplets nor comments.
+    skipped: int
+    seconds: float
+    triplets_per_sec: float
+
+
+# OntologyLoader streams triplets into an Ontology in a single pass.
+# Entity and relation terms are interned into id tables as they are encountered
+# and the triplets are kept as three packed int64 arrays until the CSR layout is built.
+# Terms are kept in their N-Triples form (<iri>, _:blank or "literal") so both sources intern alike.
+class OntologyLoader:
+    # Matches "subject predicate object ." where the object could also be a literal with a language tag or a datatype.
+    # A comment could follow the terminating dot.
+    _NTRIPLE_PATTERN = r'^\s*(<[^>]*>|_:\S+)\s+(<[^>]*>)\s+(<[^>]*>|_:\S+|"(?:[^"\\]|\\.)*"(?:@[A-Za-z0-9-]+|\^\^<[^>]*>)?)\s*\.\s*(?:#.*)?$'
+
+    _ntriple_pattern: Pattern
+    # _report_every is the number of triplets between two throughput reports. 0 turns them off.
+    _report_every: int
+    _indexed: bool
+    _entity_ids: Dict[str, int]
+    _entities: List[str]
+    _relation_ids: Dict[str, int]
+    _relations: List[str]
+    _heads: array.array
+    _rels: array.array
+    _tails: array.array
+    _skipped: int
+    _started_at: float
+    _stats: Optional[IngestionStats]
+
+    def __init__(self, report_every: int = 1_000_000, indexed: bool = False) -> None:
+        self._ntriple_pattern = re.compile(self._NTRIPLE_PATTERN)
+        self._report_every = report_every
+        self._indexed = indexed
+
+        self._reset()
+
+    # load_ntriples streams a local N-Triples file. Files ending with .gz or .bz2 are decompressed on the fly.
+    def load_ntriples(self, path: str) -> data.Ontology:
+        self._reset()
+
+        with self._open(path) as stream:
+            for line in stream:
+                terms = self._parse_line(line)
+
+                if terms is None:
+                    continue
+
+                self._add(*terms)
+
+        return self._build()
+
+    # load_graph streams an already parsed rdflib Graph (or anything yielding (s, p, o) rdflib terms).
+    def load_graph(self, graph: Iterable) -> data.Ontology:
+        self._reset()
+
+        for s, p, o in graph:
+            self._add(s.n3(), p.n3(), o.n3())
+
+        return self._build()
+
+    def stats(self) -> IngestionStats:
+        return self._stats
+
+    def _reset(self) -> None:
+        self._entity_ids = dict()
+        self._entities = []
+        self._relation_ids = dict()
+        self._relations = []
+        self._heads = array.array("q")
+        self._rels = array.array("q")
+        self._tails = array.array("q")
+        self._skipped = 0
+        self._started_at = time.perf_counter()
+        self._stats = None
+
+    def _open(self, path: str) -> TextIO:
+        if path.endswith(".gz"):
+            return gzip.open(path, "rt", encoding="utf-8")
+
+        if path.endswith(".bz2"):
+            return bz2.open(path, "rt", encoding="utf-8")
+
+        return open(path, "r", encoding="utf-8")
+
+    def _parse_line(self, line: str) -> Optional[Tuple[str, str, str]]:
+        if not line.strip() or line.lstrip().startswith("#"):
+            return None
+
+        match = self._ntriple_pattern.match(line)
+
+        if match is None:
+            self._skipped += 1
+            return None
+
+        return match.group(1), match.group(2), match.group(3)
+
+    def _add(self, subject: str, predicate: str, obj: str) -> None:
+        self._heads.append(self._intern(subject, self._entity_ids, self._entities))
+        self._rels.append(self._intern(predicate, self._relation_ids, self._relations))
+        self._tails.append(self._intern(obj, self._entity_ids, self._entities))
+
+        if self._report_every > 0 and len(self._heads) % self._report_every == 0:
+            self._report(self._current_stats())
+
+    def _intern(self, term: str, ids: Dict[str, int], names: List[str]) -> int:
+        idx = ids.get(term)
+
+        if idx is None:
+            idx = len(names)
+            ids[term] = idx
+            names.append(term)
+
+        return idx
+
+    def _build(self) -> data.Ontology:
+        # np.frombuffer shares the memory of the arrays instead of copying them.
+        onto = data.Ontology.from_triplets(
+            np.frombuffer(self._heads, dtype=np.int64),
+            np.frombuffer(self._rels, dtype=np.int64),
+            np.frombuffer(self._tails, dtype=np.int64),
+            relations=self._relations,
+            entities=self._entities,
+            indexed=self._indexed,
+        )
+
+        self._stats = self._current_stats()
+        self._report(self._stats)
+
+        # The interning tables and the raw triplets are no longer needed once the ontology owns them.
+        self._entity_ids = dict()
+        self._relation_ids = dict()
+        self._heads = array.array("q")
+        self._rels = array.array("q")
+        self._tails = array.array("q")
+
+        return onto
+
+    def _current_stats(self) -> IngestionStats:
+        seconds = time.perf_counter() - self._started_at
+        triplets = len(self._heads)
+
+        return IngestionStats(
+            triplets=triplets,
+            entities=len(self._entities),
+            relations=len(self._relations),
+            skipped=self._skipped,
+            seconds=seconds,
+            triplets_per_sec=triplets / seconds if seconds > 0 else 0.0,
+        )
+
+    def _report(self, stats: IngestionStats) -> None:
+        if self._report_every > 0:
+            print(f"[Ingestion] {stats.triplets} triplets, {stats.entities} entities ---> {stats.triplets_per_sec:.0f} triplets/sec")
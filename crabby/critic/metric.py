@@ -1,7 +1,9 @@
-import random
-from typing import List, NamedTuple, Tuple
+import copy
+from typing import List, NamedTuple, Optional, Tuple
 
 import torch
+import torch.multiprocessing as mp
+import torch.utils.data as torch_data
 
 import crabby.critic.data as data
 import crabby.critic.transe as transe
@@ -12,107 +14,270 @@ class MetricsBundle(NamedTuple):
     hits_at_10: float
 
 
+# RankingBundle holds the filtered ranking metrics: corruptions which are known triplets
+# do not count against the rank of a triplet.
+class RankingBundle(NamedTuple):
+    mrr: float
+    mean_rank: float
+    hits_at_1: float
+    hits_at_3: float
+    hits_at_10: float
+
+
+# RankStats holds the sums the ranking metrics are made of so they could be computed
+# over parts of the dataset and merged.
+class RankStats(NamedTuple):
+    count: int
+    rank_sum: float
+    reciprocal_rank_sum: float
+    hits_at_1: int
+    hits_at_3: int
+    hits_at_10: int
+
+    @classmethod
+    def of(cls, ranks: torch.LongTensor) -> "RankStats":
+        return cls(
+            count=len(ranks),
+            rank_sum=float(ranks.sum()),
+            reciprocal_rank_sum=float((1.0 / ranks.double()).sum()),
+            hits_at_1=int((ranks <= 1).sum()),
+            hits_at_3=int((ranks <= 3).sum()),
+            hits_at_10=int((ranks <= 10).sum()),
+        )
+
+    def merged(self, other: "RankStats") -> "RankStats":
+        return RankStats(*(mine + theirs for mine, theirs in zip(self, other)))
+
+    def bundle(self) -> RankingBundle:
+        count = float(max(self.count, 1))
+
+        return RankingBundle(
+            mrr=self.reciprocal_rank_sum / count,
+            mean_rank=self.rank_sum / count,
+            hits_at_1=self.hits_at_1 / count,
+            hits_at_3=self.hits_at_3 / count,
+            hits_at_10=self.hits_at_10 / count,
+        )
+
+
+# Calculator scores every candidate head or tail of a sampled triplet with a single matrix operation
+# against the entity embeddings instead of running the model once per candidate.
 class Calculator:
     _HEADS = 0
     _TAILS = 2
-    
-    _dataset: data.TripletDataset
+    _HITS_AT = 10
+
+    _dataset: torch_data.Dataset
     _onto: data.Ontology
     _sample_size: int
-    
-    def __init__(self, dataset: data.TripletDataset, onto: data.Ontology, sample_size: int = 256) -> None:
+    # _batch_size is the number of sampled triplets scored at once.
+    # Peak memory of calculate is proportional to _batch_size * entities_len.
+    _batch_size: int
+    # _chunk_size is the number of candidate entities scored at once by evaluate.
+    # Peak memory of evaluate is proportional to _batch_size * _chunk_size no matter the number of entities.
+    _chunk_size: int
+    # _triplets holds all triplets of _dataset as a [N, 3] tensor. It is only taken from the dataset when
+    # first needed, see _dataset_triplets.
+    _triplets: Optional[torch.LongTensor]
+    # _generator is None whenever the global torch RNG should be used.
+    _generator: Optional[torch.Generator]
+    # _workers is the number of processes calculate splits its sample across. 0 calculates in-process.
+    _workers: int
+    # _shard_size is the number of sampled triplets of a shard. The sample is always split into the same
+    # shards, each drawn with its own seed, so the result does not depend on the number of workers.
+    _shard_size: int
+
+    def __init__(
+        self,
+        dataset: torch_data.Dataset,
+        onto: data.Ontology,
+        sample_size: int = 256,
+        batch_size: int = 64,
+        seed: Optional[int] = None,
+        chunk_size: int = 4096,
+        workers: int = 0,
+        shard_size: int = 64,
+    ) -> None:
         self._dataset = dataset
         self._onto = onto
         self._sample_size = sample_size
+        self._batch_size = batch_size
+        self._chunk_size = chunk_size
+        self._workers = workers
+        self._shard_size = shard_size
+        self._triplets = None
+
+        self._generator = None
+
+        if seed is not None:
+            self._generator = torch.Generator()
+            self._generator.manual_seed(seed)
 
     @torch.no_grad()
     def calculate(self, model: transe.TranseModel) -> MetricsBundle:
-        cum_hits_at_10 = 0.0
-        cum_rank = 0.0
-        
-        for _ in range(self._sample_size):
-            triplet = self._dataset[random.randint(0, len(self._dataset) - 1)]
-
-            # Corrupting heads.
-            dists, original_idx = self._corrupted_dists(triplet, model, triplet_idx=self._HEADS)
-            hits_at_10, rank = self._metrics_for_side(triplet, dists, original_idx, triplet_idx=self._HEADS)
-            
-            cum_hits_at_10 += hits_at_10
-            cum_rank += rank
-            
-            # Corrupting tails.
-            dists, original_idx = self._corrupted_dists(triplet, model, triplet_idx=self._TAILS)
-            hits_at_10, rank = self._metrics_for_side(triplet, dists, original_idx, triplet_idx=self._TAILS)
-            
-            cum_hits_at_10 += hits_at_10
-            cum_rank += rank
+        base_seed = int(torch.randint(0, 2 ** 31 - 1, (1,), generator=self._generator))
+        shards = [
+            (base_seed + i, min(self._shard_size, self._sample_size - start))
+            for i, start in enumerate(range(0, self._sample_size, self._shard_size))
+        ]
+
+        if self._workers > 0:
+            shard_metrics = self._calculate_shards_in_pool(model, shards)
+        else:
+            shard_metrics = [self._calculate_shard(model, seed, size) for seed, size in shards]
+
+        # The shards are summed up in the same order no matter which worker calculated them.
+        cum_hits_at_10 = sum(hits_at_10 for hits_at_10, _ in shard_metrics)
+        cum_rank = sum(rank for _, rank in shard_metrics)
 
         hits_at_10 = cum_hits_at_10 / float(self._sample_size * 2)
         mean_rank = cum_rank / float(self._sample_size * 2)
 
         return MetricsBundle(mean_rank=mean_rank, hits_at_10=hits_at_10)
 
-    def _corrupted_dists(self, triplet: torch.IntTensor, model: transe.TranseModel, triplet_idx: int) -> Tuple[List[float], int]:
-        corrupted_triplet = torch.clone(triplet)
+    # _calculate_shard returns the summed up hits at 10 and ranks of a shard of the sample.
+    def _calculate_shard(self, model: transe.TranseModel, seed: int, size: int) -> Tuple[float, float]:
+        cum_hits_at_10 = 0.0
+        cum_rank = 0.0
+
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        triplets = self._dataset_triplets()
+        sample = triplets[torch.randint(0, len(triplets), (size,), generator=generator)]
+
+        for triplets in torch.split(sample, self._batch_size):
+            # Corrupting heads and then tails.
+            for triplet_idx in (self._HEADS, self._TAILS):
+                dists = self._corrupted_dists(triplets, model, triplet_idx=triplet_idx)
+                hits_at_10, ranks = self._metrics_for_side(triplets, dists, triplet_idx=triplet_idx)
+
+                cum_hits_at_10 += float(hits_at_10.sum())
+                cum_rank += float(ranks.sum())
+
+        return cum_hits_at_10, cum_rank
+
+    def _calculate_shards_in_pool(self, model: transe.TranseModel, shards: List[Tuple[int, int]]) -> List[Tuple[float, float]]:
+        # The workers score against a frozen copy whose tables live in shared memory
+        # so they are neither copied per worker nor changed by training in the meantime.
+        snapshot = copy.deepcopy(model)
+        snapshot.share_memory()
+
+        with mp.get_context().Pool(self._workers, initializer=_init_shard_worker, initargs=(self, snapshot)) as pool:
+            return pool.starmap(_calculate_shard_in_worker, shards)
+
+    # The dataset and the generator are not needed by the shard workers.
+    def __getstate__(self):
+        self._dataset_triplets()
+
+        state = self.__dict__.copy()
+        state["_dataset"] = None
+        state["_generator"] = None
+
+        return state
+
+    # evaluate computes the filtered MRR and hits at 1, 3 and 10 over every triplet of the dataset
+    # by ranking both their heads and tails against all entities.
+    @torch.no_grad()
+    def evaluate(self, model: transe.TranseModel) -> RankingBundle:
+        return self._rank_stats(model, self._dataset_triplets()).bundle()
+
+    def _rank_stats(self, model: transe.TranseModel, triplets: torch.LongTensor) -> RankStats:
+        stats = RankStats(0, 0.0, 0.0, 0, 0, 0)
+
+        for batch in torch.split(triplets, self._batch_size):
+            for triplet_idx in (self._HEADS, self._TAILS):
+                stats = stats.merged(RankStats.of(self._filtered_ranks(batch, model, triplet_idx)))
+
+        return stats
+
+    # _filtered_ranks returns the 1-based filtered rank of every triplet with the side at triplet_idx corrupted.
+    # The candidates are scored chunk by chunk and only the ones closer than the original are checked
+    # against the ontology which keeps the number of lookups proportional to the ranks.
+    def _filtered_ranks(self, triplets: torch.LongTensor, model: transe.TranseModel, triplet_idx: int) -> torch.LongTensor:
+        original_dists = model.score(triplets).unsqueeze(1)
+        closer_counts = torch.zeros(len(triplets), dtype=torch.long)
+
+        for start in range(0, self._onto.entities_len(), self._chunk_size):
+            stop = min(start + self._chunk_size, self._onto.entities_len())
+
+            if triplet_idx == self._HEADS:
+                dists = model.score_heads(triplets[:, 1], triplets[:, 2], start, stop)
+            else:
+                dists = model.score_tails(triplets[:, 0], triplets[:, 1], start, stop)
+
+            closer = dists < original_dists
+            # The original entity never counts against itself.
+            own = triplets[:, triplet_idx] - start
+            in_chunk = (own >= 0) & (own < stop - start)
+            closer[in_chunk, own[in_chunk]] = False
+
+            rows, cols = closer.nonzero(as_tuple=True)
+
+            if len(rows) > 0:
+                candidates = triplets[rows].clone()
+                candidates[:, triplet_idx] = cols + start
+
+                known = self._onto.exists_many(candidates)
+                closer[rows[known], cols[known]] = False
+
+            closer_counts += closer.sum(dim=1)
+
+        return closer_counts + 1
+
+    # _corrupted_dists returns the [len(triplets), entities_len] distances of the triplets with
+    # the side at triplet_idx replaced by every entity.
+    def _corrupted_dists(self, triplets: torch.LongTensor, model: transe.TranseModel, triplet_idx: int) -> torch.FloatTensor:
+        if triplet_idx == self._HEADS:
+            return model.score_heads(triplets[:, 1], triplets[:, 2])
+
+        return model.score_tails(triplets[:, 0], triplets[:, 1])
 
-        # Corrupting heads.
-        dists = []
+    def _metrics_for_side(self, triplets: torch.LongTensor, dists: torch.FloatTensor, triplet_idx: int) -> Tuple[torch.FloatTensor, torch.LongTensor]:
+        n = min(self._HITS_AT, dists.size(1))
+        closest_indices = torch.topk(dists, k=n, dim=1, largest=False).indices
 
-        for j in range(self._onto.entities_len()):
-            if triplet[triplet_idx] == j:
-                original_idx = j
+        # All closest candidates of all triplets are checked against the ontology at once.
+        candidates = triplets.unsqueeze(1).repeat(1, n, 1)
+        candidates[:, :, triplet_idx] = closest_indices
+        existing_count = self._onto.exists_many(candidates.view(-1, 3)).view(-1, n).sum(dim=1)
 
-            corrupted_triplet[triplet_idx] = j
+        hits_at_10 = existing_count.float() / float(self._HITS_AT)
 
-            dist = model(torch.unsqueeze(corrupted_triplet, dim=0)).item()
-            dists.append(dist)
-        
-        return dists, original_idx
+        # The rank of a triplet is the number of its corruptions which are strictly closer.
+        original_dists = dists.gather(1, triplets[:, triplet_idx:triplet_idx + 1])
+        ranks = (dists < original_dists).sum(dim=1)
 
-    def _metrics_for_side(self, triplet: torch.IntTensor, dists: List[float], original_idx: int, triplet_idx: int) -> Tuple[float, float]:
-        corrupted_triplet = torch.clone(triplet)
+        return hits_at_10, ranks
 
-        closest_triplet_indices = self._closest_triplets_indices(dists, n=10)
-        existing_count = 0
+    def _dataset_triplets(self) -> torch.LongTensor:
+        if self._triplets is None:
+            self._triplets = self._materialize(self._dataset)
 
-        for j in closest_triplet_indices:
-            corrupted_triplet[triplet_idx] = j
-            
-            if self._onto.exists(data.Triplet(head=corrupted_triplet[0], rel=corrupted_triplet[1], tail=corrupted_triplet[2])):
-                existing_count += 1
+        return self._triplets
 
-        hits_at_10 = float(existing_count) / 10.0
-        rank = float(self._triplet_rank(dists, original_idx))
+    # _materialize takes the triplets of the triplet datasets in bulk. Only other datasets are read item by item.
+    def _materialize(self, dataset: torch_data.Dataset) -> torch.LongTensor:
+        if isinstance(dataset, (data.TripletDataset, data.TripletTensorDataset)):
+            return dataset.triplets()
 
-        return hits_at_10, rank
+        return torch.stack([dataset[i] for i in range(len(dataset))]).long()
 
-    def _closest_triplets_indices(self, dists: List[float], n: int) -> List[int]:
-        closest_triplets_indices = []
 
-        # Using insertion sort logic as we only need the closest n items
-        # which are usually 5, 10 or 25.
-        for i in range(n):
-            min_dist = dists[i]
-            min_idx = i
+# The state of a shard worker process set up by _init_shard_worker.
+_shard_calculator: Optional[Calculator] = None
+_shard_model: Optional[transe.TranseModel] = None
 
-            for j, dist in enumerate(dists[i:]):
-                if min_dist > dist:
-                    min_dist = dist
-                    min_idx = j
 
-            closest_triplets_indices.append(min_idx)
-            dists[i], dists[min_idx] = dists[min_idx], dists[i]
+def _init_shard_worker(calculator: Calculator, model: transe.TranseModel) -> None:
+    global _shard_calculator, _shard_model
 
-        return closest_triplets_indices
+    # Every worker scores on a single core so the workers do not fight over the cores.
+    torch.set_num_threads(1)
 
-    def _triplet_rank(self, dists: List[float], idx: int) -> int:
-        closer_count = 0
-        
-        for i, dist in enumerate(dists):
-            if i == idx:
-                continue
+    _shard_calculator = calculator
+    _shard_model = model
 
-            if dist < dists[idx]:
-                closer_count += 1
 
-        return closer_count
+@torch.no_grad()
+def _calculate_shard_in_worker(seed: int, size: int) -> Tuple[float, float]:
+    return _shard_calculator._calculate_shard(_shard_model, seed, size)
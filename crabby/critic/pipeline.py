@@ -0,0 +1,119 @@
+import queue
+import threading
+import time
+from typing import Iterable, Iterator, NamedTuple, Optional, Tuple
+
+import torch
+
+import crabby.critic.data as data
+
+
+class StageTimings(NamedTuple):
+    # load_seconds is the time spent drawing minibatches from the loader.
+    load_seconds: float
+    # sample_seconds is the time spent sampling the negatives.
+    sample_seconds: float
+    # wait_seconds is the time the consumer waited for a minibatch. Close to 0 means the consumer is the bottleneck.
+    wait_seconds: float
+
+
+# Prefetcher iterates over (positives, negatives) minibatches where the negatives are sampled for the positives
+# drawn from the loader.
+# With a depth above 0 a producer thread prepares up to depth minibatches ahead in a bounded queue while the
+# consumer computes. With a depth of 0 minibatches are prepared inline when requested.
+# Either way the minibatches and the sampled negatives are the same for the same sampler state as the loader and
+# the sampler are only ever used by one thread in order.
+class Prefetcher:
+    _SENTINEL = object()
+
+    _loader: Iterable[torch.LongTensor]
+    _sampler: data.NegativeSampler
+    _depth: int
+    _load_seconds: float
+    _sample_seconds: float
+    _wait_seconds: float
+
+    def __init__(self, loader: Iterable[torch.LongTensor], sampler: data.NegativeSampler, depth: int = 4) -> None:
+        self._loader = loader
+        self._sampler = sampler
+        self._depth = depth
+
+        self._reset_timings()
+
+    def __iter__(self) -> Iterator[Tuple[torch.LongTensor, torch.LongTensor]]:
+        self._reset_timings()
+
+        if self._depth <= 0:
+            for batch in self._batches():
+                yield batch
+
+            # Inline preparation is waited for in full.
+            self._wait_seconds = self._load_seconds + self._sample_seconds
+            return
+
+        batches = queue.Queue(maxsize=self._depth)
+        stop = threading.Event()
+        errors = []
+
+        producer = threading.Thread(target=self._produce, args=(batches, stop, errors), daemon=True)
+        producer.start()
+
+        try:
+            while True:
+                started_at = time.perf_counter()
+                batch = batches.get()
+                self._wait_seconds += time.perf_counter() - started_at
+
+                if batch is self._SENTINEL:
+                    break
+
+                yield batch
+        finally:
+            # The producer is released if the consumer stops early.
+            stop.set()
+
+            while producer.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    producer.join(timeout=0.01)
+
+        if errors:
+            raise errors[0]
+
+    def timings(self) -> StageTimings:
+        return StageTimings(load_seconds=self._load_seconds, sample_seconds=self._sample_seconds, wait_seconds=self._wait_seconds)
+
+    def _produce(self, batches: queue.Queue, stop: threading.Event, errors: list) -> None:
+        try:
+            for batch in self._batches():
+                if stop.is_set():
+                    return
+
+                batches.put(batch)
+        except BaseException as error:
+            errors.append(error)
+
+        batches.put(self._SENTINEL)
+
+    def _batches(self) -> Iterator[Tuple[torch.LongTensor, torch.LongTensor]]:
+        triplets_iter = iter(self._loader)
+
+        while True:
+            started_at = time.perf_counter()
+            triplets: Optional[torch.LongTensor] = next(triplets_iter, None)
+            sampled_at = time.perf_counter()
+            self._load_seconds += sampled_at - started_at
+
+            if triplets is None:
+                return
+
+            negatives = self._sampler.sample(triplets)
+            self._sample_seconds += time.perf_counter() - sampled_at
+
+            yield triplets, negatives
+
+    def _reset_timings(self) -> None:
+        self._load_seconds = 0.0
+        self._sample_seconds = 0.0
+        self._wait_seconds = 0.0
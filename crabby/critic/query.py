@@ -0,0 +1,94 @@
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import scipy.sparse as sparse
+import torch
+
+import crabby.critic.data as data
+
+
+# GraphQuery answers multi-hop questions over an ontology by sparse matrix products
+# instead of walking the adjacency lists one entity at a time.
+# Every query handles a whole batch of sources at once: the sources are turned into the rows of
+# a sparse [N, entities_len] frontier which is multiplied by the per-relation adjacency matrices.
+class GraphQuery:
+    _onto: data.Ontology
+    # _adjacencies caches the exported adjacency matrices by their relations (None means all of them).
+    _adjacencies: Dict[Optional[Tuple[int, ...]], sparse.csr_matrix]
+
+    def __init__(self, onto: data.Ontology) -> None:
+        self._onto = onto
+        self._adjacencies = dict()
+
+    # reachable_from returns a sparse boolean [len(sources), entities_len] matrix holding for every source
+    # the entities reachable by following between 1 and hops triplets of the given relations.
+    def reachable_from(self, sources: torch.Tensor, hops: int, rels: Optional[List[int]] = None) -> sparse.csr_matrix:
+        adjacency = self._adjacency(rels).astype(bool)
+
+        frontier = self._one_hot(sources)
+        reached = sparse.csr_matrix(frontier.shape, dtype=bool)
+
+        for _ in range(hops):
+            frontier = frontier @ adjacency
+            # Only newly reached entities have to be expanded further.
+            frontier = frontier > reached
+            reached = reached + frontier
+
+            if frontier.nnz == 0:
+                break
+
+        return reached
+
+    # reachable tells for every (sources[i], targets[i]) pair whether the target is reachable
+    # from the source within hops triplets of the given relations.
+    def reachable(
+        self,
+        sources: torch.Tensor,
+        targets: torch.Tensor,
+        hops: int,
+        rels: Optional[List[int]] = None,
+    ) -> torch.BoolTensor:
+        reached = self.reachable_from(sources, hops, rels)
+
+        return torch.from_numpy(self._pick(reached, targets).astype(bool))
+
+    # path_counts returns the sparse [entities_len, entities_len] matrix whose entry (h, t) is the number of
+    # paths from h to t following exactly the relations of rel_path in order.
+    def path_counts(self, rel_path: List[int]) -> sparse.csr_matrix:
+        counts = sparse.identity(self._onto.entities_len(), dtype=np.int64, format="csr")
+
+        for rel in rel_path:
+            counts = counts @ self._adjacency([rel])
+
+        return counts
+
+    # count_paths returns the number of paths from sources[i] to targets[i] following rel_path.
+    # Only the rows of the sources are multiplied so it is much cheaper than path_counts.
+    def count_paths(self, sources: torch.Tensor, targets: torch.Tensor, rel_path: List[int]) -> torch.LongTensor:
+        counts = self._one_hot(sources).astype(np.int64)
+
+        for rel in rel_path:
+            counts = counts @ self._adjacency([rel])
+
+        return torch.from_numpy(self._pick(counts, targets).astype(np.int64))
+
+    def _adjacency(self, rels: Optional[List[int]]) -> sparse.csr_matrix:
+        key = tuple(sorted(set(rels))) if rels is not None else None
+
+        if key not in self._adjacencies:
+            self._adjacencies[key] = self._onto.adjacency(list(key) if key is not None else None)
+
+        return self._adjacencies[key]
+
+    def _one_hot(self, entities: torch.Tensor) -> sparse.csr_matrix:
+        entities = np.asarray(entities, dtype=np.int64).reshape(-1)
+
+        return sparse.csr_matrix(
+            (np.ones(len(entities), dtype=bool), (np.arange(len(entities)), entities)),
+            shape=(len(entities), self._onto.entities_len()),
+        )
+
+    def _pick(self, matrix: sparse.csr_matrix, targets: torch.Tensor) -> np.ndarray:
+        targets = np.asarray(targets, dtype=np.int64).reshape(-1)
+
+        return np.asarray(matrix[np.arange(len(targets)), targets]).reshape(-1)
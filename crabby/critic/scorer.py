@@ -0,0 +1,315 @@
+from typing import NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+import torch
+
+import crabby.critic.storage as storage
+import crabby.critic.transe as transe
+
+
+# TranseScorer is a frozen inference engine built from a trained TranseModel.
+# It holds the embeddings as contiguous float32 arrays (entities already renormalized as the model
+# sees them) and scores whole batches without autograd or module overhead.
+# It could be saved and memory-mapped back so a serving process starts in milliseconds.
+class TranseScorer:
+    _STORAGE_KIND = "transe-scorer"
+    # _chunk_size is the number of entities compared against the queries at once by top_k_*.
+    _CHUNK_SIZE = 65536
+
+    _entities: np.ndarray
+    _relations: np.ndarray
+    # _entity_sq_norms holds the squared norm of every entity embedding so candidate distances could be
+    # computed with a single matrix product: |q - e|^2 = |q|^2 - 2 q.e + |e|^2.
+    _entity_sq_norms: np.ndarray
+    # _path is the file the scorer was opened from or None.
+    _path: Optional[str]
+
+    def __init__(self, entities: np.ndarray, relations: np.ndarray, entity_sq_norms: Optional[np.ndarray] = None) -> None:
+        self._entities = entities
+        self._relations = relations
+        self._path = None
+
+        if entity_sq_norms is None:
+            entity_sq_norms = np.einsum("ij,ij->i", entities, entities)
+
+        self._entity_sq_norms = entity_sq_norms
+
+    @classmethod
+    @torch.no_grad()
+    def from_model(cls, model: transe.TranseModel) -> "TranseScorer":
+        entities = np.ascontiguousarray(model.entity_rows().numpy(), dtype=np.float32)
+        relations = np.ascontiguousarray(model.rel_embeddings.weight.numpy(), dtype=np.float32)
+
+        return cls(entities.copy(), relations.copy())
+
+    @classmethod
+    def open(cls, path: str) -> "TranseScorer":
+        arrays, _ = storage.read_arrays(path, kind=cls._STORAGE_KIND)
+
+        scorer = cls(arrays["entities"], arrays["relations"], arrays["entity_sq_norms"])
+        scorer._path = path
+
+        return scorer
+
+    def save(self, path: str) -> None:
+        storage.write_arrays(path, kind=self._STORAGE_KIND, arrays={
+            "entities": self._entities,
+            "relations": self._relations,
+            "entity_sq_norms": self._entity_sq_norms,
+        })
+
+    # quantize returns a scorer whose entity table is stored in the given precision.
+    def quantize(self, precision: str) -> "QuantizedTranseScorer":
+        return QuantizedTranseScorer.from_entities(self.entities(), self._relations, precision)
+
+    # score returns the distance |h + r - t| of every [N, 3] triplet. The lower, the more truthful.
+    def score(self, triplets: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+        triplets = np.asarray(triplets, dtype=np.int64).reshape(-1, 3)
+
+        translated = self.entity_rows(triplets[:, 0]) + self._relations[triplets[:, 1]] - self.entity_rows(triplets[:, 2])
+
+        return np.sqrt(np.einsum("ij,ij->i", translated, translated))
+
+    # top_k_tails returns the ids and distances of the k closest tails of (head, rel).
+    # head and rel could either be single ids or equally long arrays of ids in which case a [n, k] result is returned.
+    def top_k_tails(self, head, rel, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self._top_k(self.entity_rows(head) + self._relations[np.asarray(rel)], k)
+
+    # top_k_heads returns the ids and distances of the k closest heads of (rel, tail).
+    # As h + r - t = h - (t - r) the heads are searched around t - r.
+    def top_k_heads(self, rel, tail, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        return self._top_k(self.entity_rows(tail) - self._relations[np.asarray(rel)], k)
+
+    def entities_len(self) -> int:
+        return len(self._entities)
+
+    def relations_len(self) -> int:
+        return len(self._relations)
+
+    def entities(self) -> np.ndarray:
+        return self._entities
+
+    # entity_rows returns the float32 embeddings of the given entity ids.
+    def entity_rows(self, ids) -> np.ndarray:
+        return self._entities[np.asarray(ids)]
+
+    def relations(self) -> np.ndarray:
+        return self._relations
+
+    # nbytes is the size of the entity table.
+    def nbytes(self) -> int:
+        return self._entities.nbytes
+
+    # tail_ranks returns the raw rank of the true tail of every [N, 3] triplet among all entities.
+    def tail_ranks(self, triplets: Union[np.ndarray, torch.Tensor]) -> np.ndarray:
+        triplets = np.asarray(triplets, dtype=np.int64).reshape(-1, 3)
+
+        queries = self.entity_rows(triplets[:, 0]) + self._relations[triplets[:, 1]]
+        query_sq_norms = np.einsum("ij,ij->i", queries, queries)
+        # The true distances go through the same expansion as the candidates so a tail never outranks itself.
+        true_sq_dists = query_sq_norms - 2.0 * np.einsum("ij,ij->i", queries, self.entity_rows(triplets[:, 2])) + self._entity_sq_norms[triplets[:, 2]]
+        ranks = np.ones(len(triplets), dtype=np.int64)
+
+        for start in range(0, self.entities_len(), self._CHUNK_SIZE):
+            stop = min(start + self._CHUNK_SIZE, self.entities_len())
+
+            sq_dists = query_sq_norms[:, None] - 2.0 * self._entity_dots(queries, start, stop) + self._entity_sq_norms[start:stop]
+            ranks += np.sum(sq_dists < true_sq_dists[:, None], axis=1)
+
+        return ranks
+
+    # A scorer opened from a file is pickled as its path so serving workers map the same pages.
+    def __getstate__(self):
+        if self._path is not None:
+            return {"_path": self._path}
+
+        return self.__dict__
+
+    def __setstate__(self, state) -> None:
+        if set(state.keys()) == {"_path"}:
+            self.__dict__ = type(self).open(state["_path"]).__dict__
+            return
+
+        self.__dict__ = state
+
+    def _top_k(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        single = queries.ndim == 1
+        queries = np.atleast_2d(queries).astype(np.float32)
+        k = min(k, self.entities_len())
+
+        query_sq_norms = np.einsum("ij,ij->i", queries, queries)[:, None]
+        best_ids = np.zeros((len(queries), 0), dtype=np.int64)
+        best_sq_dists = np.zeros((len(queries), 0), dtype=np.float32)
+
+        # The entities are scanned chunk by chunk keeping only the k best candidates so far.
+        for start in range(0, self.entities_len(), self._CHUNK_SIZE):
+            stop = min(start + self._CHUNK_SIZE, self.entities_len())
+
+            sq_dists = query_sq_norms - 2.0 * self._entity_dots(queries, start, stop) + self._entity_sq_norms[start:stop]
+            ids = np.broadcast_to(np.arange(start, stop), sq_dists.shape)
+
+            best_ids, best_sq_dists = _k_smallest(np.concatenate((best_ids, ids), axis=1), np.concatenate((best_sq_dists, sq_dists), axis=1), k)
+
+        dists = np.sqrt(np.maximum(best_sq_dists, 0.0))
+
+        if single:
+            return best_ids[0], dists[0]
+
+        return best_ids, dists
+
+    # _entity_dots returns the [n, stop - start] dot products of the queries with the entities in [start, stop).
+    def _entity_dots(self, queries: np.ndarray, start: int, stop: int) -> np.ndarray:
+        return queries @ self._entities[start:stop].T
+
+
+# QuantizedTranseScorer stores the entity table in int8 with a float32 scale per row or in fp16.
+# The relations stay in float32 as they are few.
+# The kernels never dequantize the whole table: the top-k scan multiplies the queries with one chunk of codes at a time
+# and applies the row scales to the dot products.
+class QuantizedTranseScorer(TranseScorer):
+    _STORAGE_KIND = "transe-scorer-quantized"
+
+    INT8 = "int8"
+    FP16 = "fp16"
+
+    _precision: str
+    _codes: np.ndarray
+    # _scales holds the scale of every int8 row and is empty for fp16.
+    _scales: np.ndarray
+
+    def __init__(self, precision: str, codes: np.ndarray, scales: np.ndarray, relations: np.ndarray, entity_sq_norms: Optional[np.ndarray] = None) -> None:
+        if precision not in (self.INT8, self.FP16):
+            raise ValueError(f"unknown precision {precision}")
+
+        self._precision = precision
+        self._codes = codes
+        self._scales = scales
+        self._relations = relations
+        self._path = None
+
+        if entity_sq_norms is None:
+            entity_sq_norms = np.concatenate([
+                np.einsum("ij,ij->i", rows, rows) for rows in self._dequantized_chunks()
+            ]) if len(codes) > 0 else np.zeros(0, dtype=np.float32)
+
+        self._entity_sq_norms = entity_sq_norms
+
+    @classmethod
+    def from_entities(cls, entities: np.ndarray, relations: np.ndarray, precision: str) -> "QuantizedTranseScorer":
+        entities = np.asarray(entities, dtype=np.float32)
+
+        if precision == cls.FP16:
+            return cls(precision, entities.astype(np.float16), np.zeros(0, dtype=np.float32), relations)
+
+        if precision != cls.INT8:
+            raise ValueError(f"unknown precision {precision}")
+
+        scales = np.max(np.abs(entities), axis=1) / 127.0
+        scales[scales == 0] = 1.0
+        codes = np.clip(np.rint(entities / scales[:, None]), -127, 127).astype(np.int8)
+
+        return cls(precision, codes, scales.astype(np.float32), relations)
+
+    @classmethod
+    def open(cls, path: str) -> "QuantizedTranseScorer":
+        arrays, meta = storage.read_arrays(path, kind=cls._STORAGE_KIND)
+
+        scorer = cls(meta["precision"], arrays["codes"], arrays["scales"], arrays["relations"], arrays["entity_sq_norms"])
+        scorer._path = path
+
+        return scorer
+
+    def save(self, path: str) -> None:
+        storage.write_arrays(path, kind=self._STORAGE_KIND, arrays={
+            "codes": self._codes,
+            "scales": self._scales,
+            "relations": self._relations,
+            "entity_sq_norms": self._entity_sq_norms,
+        }, meta={"precision": self._precision})
+
+    def precision(self) -> str:
+        return self._precision
+
+    def entities_len(self) -> int:
+        return len(self._codes)
+
+    # entities dequantizes the whole table.
+    def entities(self) -> np.ndarray:
+        return self.entity_rows(np.arange(self.entities_len()))
+
+    def entity_rows(self, ids) -> np.ndarray:
+        ids = np.asarray(ids)
+        rows = self._codes[ids].astype(np.float32)
+
+        if self._precision == self.INT8:
+            rows *= self._scales[ids][..., None]
+
+        return rows
+
+    def nbytes(self) -> int:
+        return self._codes.nbytes + self._scales.nbytes
+
+    def _entity_dots(self, queries: np.ndarray, start: int, stop: int) -> np.ndarray:
+        dots = queries @ self._codes[start:stop].T.astype(np.float32)
+
+        if self._precision == self.INT8:
+            dots *= self._scales[start:stop]
+
+        return dots
+
+    def _dequantized_chunks(self):
+        for start in range(0, self.entities_len(), self._CHUNK_SIZE):
+            yield self.entity_rows(np.arange(start, min(start + self._CHUNK_SIZE, self.entities_len())))
+
+
+class DriftReport(NamedTuple):
+    precision: str
+    nbytes: int
+    reference_nbytes: int
+    max_score_error: float
+    mean_score_error: float
+    reference_mrr: float
+    mrr: float
+    reference_hits_at_10: float
+    hits_at_10: float
+    # top_k_overlap is the average share of the reference top-k tails that the quantized scorer returns too.
+    top_k_overlap: float
+
+
+# drift_report measures how far a quantized scorer drifts from its float32 reference on the given triplets:
+# the absolute score error, the raw tail ranking metrics of both and the overlap of their top-k tails.
+def drift_report(reference: TranseScorer, quantized: QuantizedTranseScorer, triplets: Union[np.ndarray, torch.Tensor], k: int = 10) -> DriftReport:
+    triplets = np.asarray(triplets, dtype=np.int64).reshape(-1, 3)
+
+    score_errors = np.abs(quantized.score(triplets) - reference.score(triplets))
+    reference_ranks = reference.tail_ranks(triplets)
+    ranks = quantized.tail_ranks(triplets)
+
+    reference_top_k, _ = reference.top_k_tails(triplets[:, 0], triplets[:, 1], k)
+    top_k, _ = quantized.top_k_tails(triplets[:, 0], triplets[:, 1], k)
+    overlap = np.mean([len(np.intersect1d(a, b)) / a.size for a, b in zip(reference_top_k, top_k)])
+
+    return DriftReport(
+        precision=quantized.precision(),
+        nbytes=quantized.nbytes(),
+        reference_nbytes=reference.nbytes(),
+        max_score_error=float(np.max(score_errors)),
+        mean_score_error=float(np.mean(score_errors)),
+        reference_mrr=float(np.mean(1.0 / reference_ranks)),
+        mrr=float(np.mean(1.0 / ranks)),
+        reference_hits_at_10=float(np.mean(reference_ranks <= 10)),
+        hits_at_10=float(np.mean(ranks <= 10)),
+        top_k_overlap=float(overlap),
+    )
+
+
+# _k_smallest returns the k ids with the smallest values of every row sorted by value.
+def _k_smallest(ids: np.ndarray, values: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+    if values.shape[1] > k:
+        part = np.argpartition(values, k - 1, axis=1)[:, :k]
+        ids = np.take_along_axis(ids, part, axis=1)
+        values = np.take_along_axis(values, part, axis=1)
+
+    order = np.argsort(values, axis=1, kind="stable")
+
+    return np.take_along_axis(ids, order, axis=1), np.take_along_axis(values, order, axis=1)
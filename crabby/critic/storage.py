@@ -0,0 +1,181 @@
+import json
+import os
+import struct
+from typing import Any, Dict, Sequence, Tuple
+
+import numpy as np
+
+
+class StorageFormatError(Exception):
+    """
+    Thrown whenever a file does not follow the expected binary layout.
+    """
+
+
+# The binary layout is:
+#
+#   magic (8 bytes) | version (uint32) | header length (uint32) | JSON header | padding | arrays...
+#
+# The JSON header holds the kind of the stored object, its free-form metadata and the dtype, shape
+# and offset of every array within the data section. Arrays are aligned to _ALIGNMENT bytes
+# so they could be memory-mapped directly without copying.
+MAGIC = b"CRABBY\x00\x00"
+FORMAT_VERSION = 1
+
+_ALIGNMENT = 64
+_PREAMBLE = struct.Struct("<8sII")
+
+
+# write_arrays writes the arrays next to path and renames the file over it. The arrays could therefore be
+# mapped from path itself, such as the ones of an opened Ontology saved back to its file: truncating a
+# mapped file in place would crash the process on the next access to its pages.
+def write_arrays(path: str, kind: str, arrays: Dict[str, np.ndarray], meta: Dict[str, Any] = None) -> None:
+    arrays = {name: np.ascontiguousarray(arr) for name, arr in arrays.items()}
+
+    descriptors = _descriptors(arrays)
+    header = json.dumps({"kind": kind, "meta": meta or dict(), "arrays": descriptors}).encode("utf-8")
+    data_start = _aligned(_PREAMBLE.size + len(header))
+    tmp_path = f"{path}.tmp"
+
+    try:
+        with open(tmp_path, "wb") as stream:
+            stream.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+            stream.write(header)
+
+            for name, arr in arrays.items():
+                stream.write(b"\x00" * (data_start + descriptors[name]["offset"] - stream.tell()))
+                # Writing through a memoryview avoids a copy of the whole array.
+                stream.write(memoryview(arr).cast("B"))
+
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+        raise
+
+
+# allocate_arrays creates a file holding zeroed arrays of the given shapes and dtypes without materializing them
+# in memory and maps it writable. The file is extended sparsely so its size costs nothing until rows are written.
+def allocate_arrays(path: str, kind: str, shapes: Dict[str, Tuple[Tuple[int, ...], Any]], meta: Dict[str, Any] = None) -> Dict[str, np.ndarray]:
+    # Zero-strided views have the shape and nbytes of the arrays but take no memory.
+    placeholders = {
+        name: np.lib.stride_tricks.as_strided(np.zeros(1, dtype=dtype), shape=shape, strides=[0] * len(shape))
+        for name, (shape, dtype) in shapes.items()
+    }
+
+    descriptors = _descriptors(placeholders)
+    header = json.dumps({"kind": kind, "meta": meta or dict(), "arrays": descriptors}).encode("utf-8")
+    data_start = _aligned(_PREAMBLE.size + len(header))
+    data_len = max((descriptors[name]["offset"] + arr.nbytes for name, arr in placeholders.items()), default=0)
+
+    with open(path, "wb") as stream:
+        stream.write(_PREAMBLE.pack(MAGIC, FORMAT_VERSION, len(header)))
+        stream.write(header)
+        stream.truncate(data_start + data_len)
+
+    arrays, _ = read_arrays(path, kind, writable=True)
+
+    return arrays
+
+
+# read_arrays memory-maps every array of the file, read-only unless writable is set.
+# Pages are loaded lazily on access and shared between processes mapping the same file.
+def read_arrays(path: str, kind: str, writable: bool = False) -> Tuple[Dict[str, np.ndarray], Dict[str, Any]]:
+    with open(path, "rb") as stream:
+        preamble = stream.read(_PREAMBLE.size)
+
+        if len(preamble) != _PREAMBLE.size:
+            raise StorageFormatError(f"{path} is too short to be a crabby file")
+
+        magic, version, header_len = _PREAMBLE.unpack(preamble)
+
+        if magic != MAGIC:
+            raise StorageFormatError(f"{path} is not a crabby file")
+
+        if version != FORMAT_VERSION:
+            raise StorageFormatError(f"expected format version {FORMAT_VERSION} but {path} has version {version}")
+
+        header = json.loads(stream.read(header_len).decode("utf-8"))
+        data_start = _aligned(_PREAMBLE.size + header_len)
+
+    if header["kind"] != kind:
+        raise StorageFormatError(f"expected {path} to hold {kind} but it holds {header['kind']}")
+
+    arrays = dict()
+
+    for name, descriptor in header["arrays"].items():
+        shape = tuple(descriptor["shape"])
+
+        # np.memmap can not map empty arrays.
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.zeros(shape, dtype=descriptor["dtype"])
+            continue
+
+        arrays[name] = np.memmap(path, dtype=descriptor["dtype"], mode="r+" if writable else "r", offset=data_start + descriptor["offset"], shape=shape)
+
+    return arrays, header["meta"]
+
+
+# StringTable is a read-only sequence of strings stored as one utf-8 blob plus an offsets array.
+# Strings are only decoded when they are accessed so opening a table with millions of names is instant.
+class StringTable(Sequence):
+    _blob: np.ndarray
+    # _offsets has a len of len(table) + 1. The i-th string is found at _blob[_offsets[i]:_offsets[i + 1]].
+    _offsets: np.ndarray
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray) -> None:
+        self._blob = blob
+        self._offsets = offsets
+
+    @classmethod
+    def encode(cls, names: Sequence[str]) -> "StringTable":
+        if isinstance(names, StringTable):
+            return names
+
+        encoded = [name.encode("utf-8") for name in names]
+
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum(np.fromiter((len(name) for name in encoded), dtype=np.int64, count=len(encoded)), out=offsets[1:])
+
+        return cls(np.frombuffer(b"".join(encoded), dtype=np.uint8), offsets)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        if idx < 0:
+            idx += len(self)
+
+        if idx < 0 or idx >= len(self):
+            raise IndexError(f"string idx {idx} out of range")
+
+        return self._blob[self._offsets[idx]:self._offsets[idx + 1]].tobytes().decode("utf-8")
+
+    def arrays(self, prefix: str) -> Dict[str, np.ndarray]:
+        return {f"{prefix}_blob": self._blob, f"{prefix}_offsets": self._offsets}
+
+    @classmethod
+    def from_arrays(cls, arrays: Dict[str, np.ndarray], prefix: str) -> "StringTable":
+        return cls(arrays[f"{prefix}_blob"], arrays[f"{prefix}_offsets"])
+
+
+# _descriptors lays the arrays out one after another. The offsets are relative to the start of the data
+# section which is the first aligned position after the header.
+def _descriptors(arrays: Dict[str, np.ndarray]) -> Dict[str, Dict[str, Any]]:
+    descriptors = dict()
+    offset = 0
+
+    for name, arr in arrays.items():
+        offset = _aligned(offset)
+        descriptors[name] = {"dtype": arr.dtype.str, "shape": list(arr.shape), "offset": offset}
+        offset += arr.nbytes
+
+    return descriptors
+
+
+def _aligned(offset: int) -> int:
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
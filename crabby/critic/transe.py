@@ -1,19 +1,57 @@
 import math
-from typing import Tuple
+import queue
+import time
+import traceback
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
 
 import torch
+import torch.multiprocessing as mp
 import torch.utils.data as torch_data
 
 import crabby.critic.data as data
+import crabby.critic.embedding as embedding
+import crabby.critic.pipeline as pipeline
+
+
+class TrainingWorkerError(Exception):
+    """
+    Thrown whenever a training worker process fails.
+    """
 
 
 class TranseModel(torch.nn.Module):
-    def __init__(self, onto: data.Ontology, k: int):
+    # _sparse makes the embeddings produce sparse gradients which only hold the rows of a batch.
+    # They have to be paired with a sparse-capable optimizer such as SparseAdam or Adagrad.
+    # Sparse embeddings do not renormalize on lookup so the rows of a batch have to be
+    # renormalized explicitly with renormalize_entities (Trainer does that).
+    _sparse: bool
+    # _mmap is set when the entity embeddings are an embedding.MmapEmbedding given as entity_table.
+    # Such a model is always sparse.
+    _mmap: bool
+
+    def __init__(self, onto: data.Ontology, k: int, sparse: bool = False, entity_table: Optional[embedding.MmapEmbedding] = None):
         super(TranseModel, self).__init__()
 
-        self.entity_embeddings = self._entity_embeddings(onto.entities_len(), k)
+        self._mmap = entity_table is not None
+        self._sparse = sparse or self._mmap
+
+        if self._mmap:
+            if entity_table.num_embeddings() != onto.entities_len() or entity_table.embedding_dim() != k:
+                raise ValueError(f"expected an entity table of {onto.entities_len()}x{k} rows")
+
+            self.entity_embeddings = entity_table
+        else:
+            self.entity_embeddings = self._entity_embeddings(onto.entities_len(), k)
+
         self.rel_embeddings = self._rel_embeddings(onto.relations_len(), k)
 
+    # mmap_entity_table creates an entity table for the model at path initialized like the in-memory one.
+    @classmethod
+    def mmap_entity_table(cls, onto: data.Ontology, k: int, path: str, capacity: int) -> embedding.MmapEmbedding:
+        low, high = cls._initial_boundaries(k)
+
+        return embedding.MmapEmbedding.create(path, onto.entities_len(), k, capacity, low=low, high=high)
+
     def forward(self, x):
         head_emb = self.entity_embeddings(x[:, 0])
         rel_emb = self.rel_embeddings(x[:, 1])
@@ -21,32 +59,217 @@ class TranseModel(torch.nn.Module):
 
         return (head_emb + rel_emb - tail_emb).pow(2).sum(1).sqrt()
 
+    # forward_negatives returns the [B] distances of the positives and the [B, K] distances of their corruptions
+    # in one batched computation. negatives holds K corruptions per positive grouped by positive as NegativeSampler
+    # samples them. A corruption only replaces the head or the tail so the replaced entities are the only ones
+    # looked up and the head, rel and tail embeddings of the positives are reused for the rest.
+    def forward_negatives(self, triplets: torch.Tensor, negatives: torch.Tensor) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        negatives = negatives.view(len(triplets), -1, 3)
+
+        head_emb = self.entity_embeddings(triplets[:, 0])
+        rel_emb = self.rel_embeddings(triplets[:, 1])
+        tail_emb = self.entity_embeddings(triplets[:, 2])
+
+        corrupt_heads = negatives[:, :, 0] != triplets[:, 0].unsqueeze(1)
+        replaced_emb = self.entity_embeddings(torch.where(corrupt_heads, negatives[:, :, 0], negatives[:, :, 2]))
+
+        corrupt_heads = corrupt_heads.unsqueeze(2)
+        negative_heads = torch.where(corrupt_heads, replaced_emb, head_emb.unsqueeze(1))
+        negative_tails = torch.where(corrupt_heads, tail_emb.unsqueeze(1), replaced_emb)
+
+        out = (head_emb + rel_emb - tail_emb).pow(2).sum(1).sqrt()
+        negative_out = (negative_heads + rel_emb.unsqueeze(1) - negative_tails).pow(2).sum(2).sqrt()
+
+        return out, negative_out
+
+    def is_sparse(self) -> bool:
+        return self._sparse
+
+    # grow extends the embedding tables to the entities and relations the ontology gained since the model
+    # was created and returns the ids of the new entities and relations.
+    # A new relation starts at the mean translation t - h of its triplets between known entities and a new
+    # entity at the mean of the positions its known neighbours and relations point to: t - r for its outgoing
+    # triplets and h + r for its incoming ones. Rows without any known neighbour are initialized randomly.
+    # The parameters are replaced so optimizers have to be created again afterwards.
+    @torch.no_grad()
+    def grow(self, onto: data.Ontology) -> Tuple[range, range]:
+        if self._mmap:
+            raise ValueError("mmap-backed entity tables can not grow")
+
+        entities = self.entity_embeddings.weight
+        relations = self.rel_embeddings.weight
+        new_entities = range(len(entities), onto.entities_len())
+        new_relations = range(len(relations), onto.relations_len())
+
+        if len(new_entities) == 0 and len(new_relations) == 0:
+            return new_entities, new_relations
+
+        k = entities.shape[1]
+        # The neighbours are taken as forward sees them.
+        known = self._renormed(entities)
+        relations = torch.cat((relations, self._initial_rel_rows(len(new_relations), k)))
+
+        for rel in new_relations:
+            pairs = onto.relation_pairs(rel)
+            pairs = pairs[(pairs < len(entities)).all(dim=1)]
+
+            if len(pairs) > 0:
+                relations[rel] = (known[pairs[:, 1]] - known[pairs[:, 0]]).mean(dim=0)
+
+        entities = torch.cat((entities, self._initial_entity_rows(len(new_entities), k)))
+
+        for entity in new_entities:
+            outgoing = onto.outgoing(entity)
+            outgoing = outgoing[outgoing[:, 1] < new_entities.start]
+            incoming = onto.incoming(entity)
+            incoming = incoming[incoming[:, 0] < new_entities.start]
+
+            positions = torch.cat((
+                known[outgoing[:, 1]] - relations[outgoing[:, 0]],
+                known[incoming[:, 0]] + relations[incoming[:, 1]],
+            ))
+
+            if len(positions) > 0:
+                entities[entity] = self._renormed(positions.mean(dim=0, keepdim=True))[0]
+
+        self.entity_embeddings = self._embedding_like(self.entity_embeddings, entities)
+        self.rel_embeddings = self._embedding_like(self.rel_embeddings, relations)
+
+        return new_entities, new_relations
+
+    # entity_table returns the entity table of an mmap-backed model and None for an in-memory one.
+    def entity_table(self) -> Optional[embedding.MmapEmbedding]:
+        if self._mmap:
+            return self.entity_embeddings
+
+        return None
+
+    # copy_from sets the weights of the model to the ones of other, a copy of the model such as a snapshot
+    # taken with copy.deepcopy. Unlike load_state_dict it copies the entity table of an mmap-backed model too.
+    @torch.no_grad()
+    def copy_from(self, other: "TranseModel") -> None:
+        self.load_state_dict(other.state_dict())
+
+        if self._mmap:
+            other.flush()
+            self.entity_embeddings.load_table(other.entity_embeddings.path())
+
+    # flush writes the entity rows modified in RAM back to the file of an mmap-backed model.
+    def flush(self) -> None:
+        if self._mmap:
+            self.entity_embeddings.flush()
+
+    # renormalize_entities scales the given entity rows down to the max norm of 1 in-place.
+    # Only the rows are touched so its cost is proportional to the number of entities and not the table.
+    @torch.no_grad()
+    def renormalize_entities(self, entities: torch.Tensor) -> None:
+        entities = torch.unique(entities)
+        weight = self.entity_embeddings.weight
+
+        if self._mmap:
+            entities = self.entity_embeddings.resident(entities, dirty=True)
+
+        weight[entities] = self._renormed(weight[entities])
+
+    # score returns the distances of the [N, 3] triplets like forward does but without
+    # renormalizing the stored entity table in-place.
+    def score(self, triplets: torch.Tensor) -> torch.FloatTensor:
+        translated = self._entity_lookup(triplets[:, 0]) + self.rel_embeddings.weight[triplets[:, 1]]
+
+        return (translated - self._entity_lookup(triplets[:, 2])).pow(2).sum(1).sqrt()
+
+    # entity_rows returns the entity embeddings of [start, stop) as forward sees them: renormalized to
+    # the max norm of 1. Unlike a lookup it does not renormalize the stored table in-place.
+    def entity_rows(self, start: int = 0, stop: Optional[int] = None) -> torch.FloatTensor:
+        if self._mmap:
+            return self._renormed(self.entity_embeddings.rows(start, stop))
+
+        return self._renormed(self.entity_embeddings.weight[start:stop])
+
+    # score_tails returns the [len(heads), stop - start] distances of (head, rel, t) for every
+    # candidate tail t in [start, stop) computed as a single matrix operation.
+    def score_tails(self, heads: torch.Tensor, rels: torch.Tensor, start: int = 0, stop: Optional[int] = None) -> torch.FloatTensor:
+        translated = self._entity_lookup(heads) + self.rel_embeddings.weight[rels]
+
+        return torch.cdist(translated, self.entity_rows(start, stop))
+
+    # score_heads returns the [len(tails), stop - start] distances of (h, rel, tail) for every
+    # candidate head h in [start, stop). As h + r - t = h - (t - r) the heads are compared against t - r.
+    def score_heads(self, rels: torch.Tensor, tails: torch.Tensor, start: int = 0, stop: Optional[int] = None) -> torch.FloatTensor:
+        translated = self._entity_lookup(tails) - self.rel_embeddings.weight[rels]
+
+        return torch.cdist(translated, self.entity_rows(start, stop))
+
+    def _entity_lookup(self, entities: torch.Tensor) -> torch.FloatTensor:
+        if self._mmap:
+            return self._renormed(self.entity_embeddings.lookup(entities))
+
+        return self._renormed(self.entity_embeddings.weight[entities])
+
+    def _renormed(self, rows: torch.FloatTensor) -> torch.FloatTensor:
+        return torch.renorm(rows, p=2, dim=0, maxnorm=1)
+
     def _entity_embeddings(self, num_entities: int, k: int) -> torch.nn.Embedding:
-        high, low = self._initial_boundaries(k)
-        entity_tensor = (high - low) * torch.rand(num_entities, k) + low
+        entity_tensor = self._initial_entity_rows(num_entities, k)
 
         # Normalize entity embeddings to prevent a trivial optimisation of the loss function.
+        if self._sparse:
+            return torch.nn.Embedding.from_pretrained(entity_tensor, freeze=False, sparse=True)
+
         return torch.nn.Embedding.from_pretrained(entity_tensor, freeze=False, max_norm=1)
 
+    def _initial_entity_rows(self, count: int, k: int) -> torch.FloatTensor:
+        high, low = self._initial_boundaries(k)
+
+        return (high - low) * torch.rand(count, k) + low
+
+    def _embedding_like(self, embedding: torch.nn.Embedding, weight: torch.FloatTensor) -> torch.nn.Embedding:
+        return torch.nn.Embedding.from_pretrained(weight, freeze=False, max_norm=embedding.max_norm, sparse=embedding.sparse)
+
     def _rel_embeddings(self, num_rels: int, k: int) -> torch.nn.Embedding:
+        return torch.nn.Embedding.from_pretrained(self._initial_rel_rows(num_rels, k), freeze=False, sparse=self._sparse)
+
+    def _initial_rel_rows(self, count: int, k: int) -> torch.FloatTensor:
         high, low = self._initial_boundaries(k)
-        rel_tensor = (high - low) * torch.rand(num_rels, k) + low
+        rel_tensor = (high - low) * torch.rand(count, k) + low
         
         for _, rel_emb in enumerate(rel_tensor):
             rel_emb /= torch.linalg.norm(rel_emb, ord=2)
-        
-        return torch.nn.Embedding.from_pretrained(rel_tensor, freeze=False)
 
-    def _initial_boundaries(self, k: int) -> Tuple[float, float]:
+        return rel_tensor
+
+    @staticmethod
+    def _initial_boundaries(k: int) -> Tuple[float, float]:
         return -6.0 / math.sqrt(k), 6.0 / math.sqrt(k)
 
 
+class EpochStats(NamedTuple):
+    epoch: int
+    # loss is the average over the minibatches of the loss per triplet.
+    loss: float
+    triplets: int
+    seconds: float
+    triplets_per_sec: float
+    # timings holds the time spent loading minibatches, sampling negatives and waiting for them.
+    # It is None when the trainer does not measure them.
+    timings: Optional[pipeline.StageTimings] = None
+    # compute_seconds is the time spent in the optimization steps.
+    compute_seconds: float = 0.0
+
+
 class Trainer:
     _training_loader: torch_data.DataLoader
     _onto: data.Ontology
     _optimizer: torch.optim.Optimizer
     _model: TranseModel
     _margin: float
+    _sampler: data.NegativeSampler
+    # _adversarial_temperature turns on self-adversarial weighting of the negatives when set.
+    # See _train_step.
+    _adversarial_temperature: Optional[float]
+    # _prefetcher prepares the minibatches and their negatives, ahead of time in a background thread
+    # when prefetch is above 0.
+    _prefetcher: pipeline.Prefetcher
     _epoch: int
 
     def __init__(
@@ -56,42 +279,393 @@ class Trainer:
         optimizer: torch.optim.Optimizer,
         model: TranseModel,
         margin: float,
+        sampler: Optional[data.NegativeSampler] = None,
+        adversarial_temperature: Optional[float] = None,
+        prefetch: int = 0,
     ) -> None:
         self._training_loader = training_loader
         self._onto = onto
         self._optimizer = optimizer
         self._model = model
         self._margin = margin
+        self._sampler = sampler if sampler is not None else data.NegativeSampler(onto)
+        self._adversarial_temperature = adversarial_temperature
+        self._prefetcher = pipeline.Prefetcher(training_loader, self._sampler, depth=prefetch)
 
         self._epoch = 0
 
-    def train_one_epoch(self) -> None:
+    def train_one_epoch(self) -> EpochStats:
         self._epoch += 1
         minibatch_count = 0
+        triplet_count = 0
         cum_loss = 0
+        compute_seconds = 0.0
+        started_at = time.perf_counter()
+
+        # Get a minibatch of triplets and their negatives on each turn.
+        for triplets, negatives in self._prefetcher:
+            step_started_at = time.perf_counter()
+            cum_loss += _train_step(self._model, self._optimizer, triplets, negatives, self._margin, self._adversarial_temperature)
+            compute_seconds += time.perf_counter() - step_started_at
 
-        # Sample a minibatch of triplets on each turn.
-        for _, triplets in enumerate(self._training_loader):
-            self._optimizer.zero_grad()
-            
-            corrupted_triplets = data.corrupted_counterparts(self._onto, triplets)
-            
-            out = self._model(triplets)
-            corrupted_out = self._model(corrupted_triplets)
-            
-            loss = torch.nn.functional.relu(self._margin + out - corrupted_out).sum()
-            loss.backward()
-            
-            # Adjust learning weights
-            self._optimizer.step()
-
-            cum_loss += loss / len(triplets)
             minibatch_count += 1
+            triplet_count += len(triplets)
         
-        print(f"[Epoch {self._epoch}] Average loss ---> {cum_loss / minibatch_count}")
+        stats = _epoch_stats(self._epoch, cum_loss, minibatch_count, triplet_count, time.perf_counter() - started_at)._replace(
+            timings=self._prefetcher.timings(),
+            compute_seconds=compute_seconds,
+        )
+        print(f"[Epoch {self._epoch}] Average loss ---> {stats.loss} (waited {stats.timings.wait_seconds:.2f}s, computed {compute_seconds:.2f}s)")
+
+        return stats
 
     def epoch(self) -> int:
         return self._epoch
 
     def model(self) -> TranseModel:
         return self._model
+
+    # state_dict holds everything needed to resume training on the same trajectory: the model,
+    # the optimizer, the epoch and the states of all random generators involved.
+    # The tensors of the model and the optimizer are references so it has to be copied before being
+    # used after training continues.
+    def state_dict(self) -> Dict[str, Any]:
+        return {
+            "epoch": self._epoch,
+            "model": self._model.state_dict(),
+            "optimizer": self._optimizer.state_dict(),
+            "rng": {
+                "torch": torch.get_rng_state(),
+                "sampler": _generator_state(self._sampler.generator()),
+                "loader": _generator_state(self._loader_generator()),
+            },
+        }
+
+    def load_state_dict(self, state: Dict[str, Any]) -> None:
+        self._epoch = state["epoch"]
+        self._model.load_state_dict(state["model"])
+        self._optimizer.load_state_dict(state["optimizer"])
+
+        torch.set_rng_state(state["rng"]["torch"])
+        _set_generator_state(self._sampler.generator(), state["rng"]["sampler"])
+        _set_generator_state(self._loader_generator(), state["rng"]["loader"])
+
+    def _loader_generator(self) -> Optional[torch.Generator]:
+        sampler = getattr(self._training_loader, "sampler", None)
+
+        if isinstance(sampler, data.TripletBatchSampler):
+            return sampler.generator()
+
+        return None
+
+
+# HogwildTrainer trains a model from several processes at once without any locking (Hogwild).
+# The model parameters are moved to shared memory and every worker process runs plain SGD with its
+# own optimizer and negative sampler over a disjoint shard of the shuffled triplets.
+# The updates of the workers may overwrite each other now and then which is fine as they are sparse.
+class HogwildTrainer:
+    _triplets: torch.LongTensor
+    _onto: data.Ontology
+    _model: TranseModel
+    _margin: float
+    _lr: float
+    _workers: int
+    _batch_size: int
+    # The settings the negative sampler of every worker is created with.
+    _sampler_mode: str
+    _k: int
+    _filtered: bool
+    _seed: int
+    _adversarial_temperature: Optional[float]
+    _epoch: int
+
+    def __init__(
+        self,
+        triplets: torch.LongTensor,
+        onto: data.Ontology,
+        model: TranseModel,
+        margin: float,
+        lr: float = 0.01,
+        workers: int = 4,
+        batch_size: int = 64,
+        sampler_mode: str = data.NegativeSampler.UNIFORM,
+        k: int = 1,
+        filtered: bool = False,
+        seed: int = 0,
+        adversarial_temperature: Optional[float] = None,
+    ) -> None:
+        # The cache of an mmap-backed table is shared but its slot maps would be per worker so the workers
+        # would write rows into each other's slots.
+        if model.entity_table() is not None:
+            raise ValueError("mmap-backed models can not be trained by Hogwild workers")
+
+        self._triplets = triplets
+        self._onto = onto
+        self._model = model
+        self._margin = margin
+        self._lr = lr
+        self._workers = workers
+        self._batch_size = batch_size
+        self._sampler_mode = sampler_mode
+        self._k = k
+        self._filtered = filtered
+        self._seed = seed
+        self._adversarial_temperature = adversarial_temperature
+
+        self._epoch = 0
+
+        self._model.share_memory()
+
+    def train_one_epoch(self) -> EpochStats:
+        self._epoch += 1
+        started_at = time.perf_counter()
+
+        # Every epoch is shuffled and sharded differently but deterministically.
+        generator = torch.Generator()
+        generator.manual_seed(self._seed + self._epoch)
+        shards = torch.tensor_split(self._triplets[torch.randperm(len(self._triplets), generator=generator)], self._workers)
+
+        ctx = mp.get_context()
+        results = ctx.Queue()
+        processes = []
+
+        for worker, shard in enumerate(shards):
+            seed = (self._seed + self._epoch) * self._workers + worker
+            process = ctx.Process(target=self._train_shard, args=(worker, shard, seed, results))
+            process.start()
+            processes.append(process)
+
+        try:
+            worker_stats = self._collect(processes, results)
+        finally:
+            for process in processes:
+                process.join()
+
+        cum_loss = sum(loss for loss, _, _ in worker_stats)
+        minibatch_count = sum(minibatches for _, minibatches, _ in worker_stats)
+        triplet_count = sum(triplets for _, _, triplets in worker_stats)
+
+        stats = _epoch_stats(self._epoch, cum_loss, minibatch_count, triplet_count, time.perf_counter() - started_at)
+        print(f"[Epoch {self._epoch}] Average loss ---> {stats.loss} ({stats.triplets_per_sec:.0f} triplets/sec)")
+
+        return stats
+
+    def epoch(self) -> int:
+        return self._epoch
+
+    def model(self) -> TranseModel:
+        return self._model
+
+    # _collect waits for the stats of every worker. A worker which failed sends its traceback instead and
+    # a worker which died without sending anything is noticed by its exit code.
+    def _collect(self, processes: List[mp.Process], results) -> List[Tuple[float, int, int]]:
+        worker_stats = []
+
+        while len(worker_stats) < len(processes):
+            try:
+                worker, stats, error = results.get(timeout=1.0)
+            except queue.Empty:
+                for worker, process in enumerate(processes):
+                    if process.exitcode not in (None, 0):
+                        self._terminate(processes)
+                        raise TrainingWorkerError(f"worker {worker} exited with code {process.exitcode}")
+
+                continue
+
+            if error is not None:
+                self._terminate(processes)
+                raise TrainingWorkerError(f"worker {worker} failed:\n{error}")
+
+            worker_stats.append(stats)
+
+        return worker_stats
+
+    def _terminate(self, processes: List[mp.Process]) -> None:
+        for process in processes:
+            if process.is_alive():
+                process.terminate()
+
+    def _train_shard(self, worker: int, shard: torch.LongTensor, seed: int, results) -> None:
+        try:
+            # Every worker trains on a single core so the workers do not fight over the cores.
+            torch.set_num_threads(1)
+
+            optimizer = torch.optim.SGD(self._model.parameters(), lr=self._lr)
+            sampler = data.NegativeSampler(self._onto, mode=self._sampler_mode, k=self._k, filtered=self._filtered, seed=seed)
+
+            cum_loss = 0.0
+            minibatch_count = 0
+
+            for triplets in torch.split(shard, self._batch_size):
+                cum_loss += _train_step(self._model, optimizer, triplets, sampler.sample(triplets), self._margin, self._adversarial_temperature)
+                minibatch_count += 1
+        except BaseException:
+            # The traceback is sent as text as not every exception could be pickled.
+            results.put((worker, None, traceback.format_exc()))
+            return
+
+        results.put((worker, (cum_loss, minibatch_count, len(shard)), None))
+
+
+# IncrementalTrainer updates a trained model after the ontology was extended, e.g. by a new chapter, instead
+# of training it again from scratch.
+# The model grows its embedding tables for the new entities and relations (initialized from their neighbours,
+# see TranseModel.grow) and is fine-tuned for a few epochs on the new triplets. Every minibatch of new triplets
+# is mixed with replay times as many old triplets drawn at random so the model does not forget the rest of the
+# graph while most of the updates go to the new part.
+class IncrementalTrainer:
+    _onto: data.Ontology
+    _model: TranseModel
+    _margin: float
+    _lr: float
+    _epochs: int
+    _batch_size: int
+    # _replay is the number of old triplets replayed per new triplet.
+    _replay: float
+    # The settings the negative sampler is created with. It is created for every fine-tuning as the
+    # relations of the ontology may change in between.
+    _sampler_mode: str
+    _k: int
+    _filtered: bool
+    _generator: torch.Generator
+
+    def __init__(
+        self,
+        onto: data.Ontology,
+        model: TranseModel,
+        margin: float,
+        lr: float = 0.01,
+        epochs: int = 5,
+        batch_size: int = 64,
+        replay: float = 1.0,
+        sampler_mode: str = data.NegativeSampler.UNIFORM,
+        k: int = 1,
+        filtered: bool = False,
+        seed: Optional[int] = None,
+    ) -> None:
+        self._onto = onto
+        self._model = model
+        self._margin = margin
+        self._lr = lr
+        self._epochs = epochs
+        self._batch_size = batch_size
+        self._replay = replay
+        self._sampler_mode = sampler_mode
+        self._k = k
+        self._filtered = filtered
+
+        self._generator = torch.Generator()
+
+        if seed is not None:
+            self._generator.manual_seed(seed)
+
+    # fine_tune grows the model to the ontology and fine-tunes it on the [N, 3] new triplets which must already be
+    # part of the ontology. It returns the stats of every epoch.
+    def fine_tune(self, new_triplets: torch.LongTensor) -> List[EpochStats]:
+        new_triplets = new_triplets.long()
+        new_entities, new_relations = self._model.grow(self._onto)
+        old_triplets = self._old_triplets(new_triplets)
+
+        # Plain SGD does not keep any per-row state so it works with dense, sparse and freshly grown tables.
+        optimizer = torch.optim.SGD(self._model.parameters(), lr=self._lr)
+        sampler = data.NegativeSampler(
+            self._onto,
+            mode=self._sampler_mode,
+            k=self._k,
+            filtered=self._filtered,
+            seed=int(torch.randint(0, 2 ** 31, (1,), generator=self._generator)),
+        )
+
+        print(f"Fine-tuning on {len(new_triplets)} new triplets with {len(new_entities)} new entities and {len(new_relations)} new relations")
+
+        history = []
+
+        for epoch in range(1, self._epochs + 1):
+            cum_loss = 0.0
+            minibatch_count = 0
+            triplet_count = 0
+            started_at = time.perf_counter()
+
+            for batch in torch.split(new_triplets[torch.randperm(len(new_triplets), generator=self._generator)], self._batch_size):
+                replay_count = int(round(len(batch) * self._replay)) if len(old_triplets) > 0 else 0
+                replayed = old_triplets[torch.randint(0, max(len(old_triplets), 1), (replay_count,), generator=self._generator)]
+                batch = torch.cat((batch, replayed))
+
+                cum_loss += _train_step(self._model, optimizer, batch, sampler.sample(batch), self._margin)
+                minibatch_count += 1
+                triplet_count += len(batch)
+
+            stats = _epoch_stats(epoch, cum_loss, minibatch_count, triplet_count, time.perf_counter() - started_at)
+            print(f"[Fine-tuning epoch {epoch}] Average loss ---> {stats.loss}")
+
+            history.append(stats)
+
+        return history
+
+    def model(self) -> TranseModel:
+        return self._model
+
+    # _old_triplets returns the triplets of the ontology which aren't among the new ones.
+    def _old_triplets(self, new_triplets: torch.LongTensor) -> torch.LongTensor:
+        triplets = self._onto.triplets_range(0, self._onto.triplets_len())
+
+        return triplets[~data.triplets_isin(self._onto, triplets, new_triplets)]
+
+
+# _train_step runs a single optimization step over a minibatch and its negatives, K per positive grouped by
+# positive, and returns its loss per triplet.
+# With adversarial_temperature set the margin losses of the K negatives of a positive are weighted by
+# softmax(-temperature * distance) (self-adversarial negative sampling) so the hard negatives, the ones
+# close to being truthful, dominate the gradient. The weights are scaled to sum up to K to keep the loss
+# on the scale of the unweighted sum and do not receive gradients.
+def _train_step(
+    model: TranseModel,
+    optimizer: torch.optim.Optimizer,
+    triplets: torch.LongTensor,
+    corrupted_triplets: torch.LongTensor,
+    margin: float,
+    adversarial_temperature: Optional[float] = None,
+) -> float:
+    optimizer.zero_grad()
+
+    if model.is_sparse():
+        # Sparse embeddings do not renormalize on lookup so the touched rows are renormalized upfront.
+        model.renormalize_entities(torch.cat((triplets[:, [0, 2]].flatten(), corrupted_triplets[:, [0, 2]].flatten())))
+    
+    # Every positive is compared against each of its k corruptions.
+    out, corrupted_out = model.forward_negatives(triplets, corrupted_triplets)
+    losses = torch.nn.functional.relu(margin + out.unsqueeze(1) - corrupted_out)
+
+    if adversarial_temperature is not None:
+        weights = torch.softmax(-adversarial_temperature * corrupted_out.detach(), dim=1) * corrupted_out.shape[1]
+        losses = losses * weights
+
+    loss = losses.sum()
+    loss.backward()
+    
+    # Adjust learning weights
+    optimizer.step()
+
+    return loss.item() / len(triplets)
+
+
+def _generator_state(generator: Optional[torch.Generator]) -> Optional[torch.ByteTensor]:
+    if generator is None:
+        return None
+
+    return generator.get_state()
+
+
+def _set_generator_state(generator: Optional[torch.Generator], state: Optional[torch.ByteTensor]) -> None:
+    if generator is not None and state is not None:
+        generator.set_state(state)
+
+
+def _epoch_stats(epoch: int, cum_loss: float, minibatch_count: int, triplet_count: int, seconds: float) -> EpochStats:
+    return EpochStats(
+        epoch=epoch,
+        loss=cum_loss / max(minibatch_count, 1),
+        triplets=triplet_count,
+        seconds=seconds,
+        triplets_per_sec=triplet_count / seconds if seconds > 0 else 0.0,
+    )
@@ -1,5 +1,7 @@
 from crabby.rel.data import (
     SentencePairer,
+    PruningPolicy,
+    PruningStats,
     PairOutOfBoundsError,
     LabelError,
     SentenceDataset,
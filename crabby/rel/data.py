@@ -1,8 +1,8 @@
-import itertools
 import math
 import re
-from typing import Dict, List, Pattern, Tuple
+from typing import Dict, List, NamedTuple, Optional, Pattern, Set, Tuple
 
+import numpy as np
 import torch
 import torch.utils.data as torch_data
 import compress_fasttext.models as ft
@@ -21,11 +21,30 @@ class LabelError(Exception):
     """
 
 
+class PruningPolicy(NamedTuple):
+    # max_token_distance drops the pairs whose markers start more than that many whitespace separated
+    # tokens apart.
+    max_token_distance: Optional[int] = None
+    # compatible_types holds the pairs of entity types which could be related. Pairs of entities of other
+    # types are dropped. The order within a pair does not matter. It requires the entity types to be given.
+    compatible_types: Optional[Set[Tuple[str, str]]] = None
+    # max_pairs_per_sent keeps at most that many pairs per sentence, the ones closest in tokens.
+    max_pairs_per_sent: Optional[int] = None
+
+
+class PruningStats(NamedTuple):
+    # candidates is the number of pairs before pruning and kept the number of pairs left after it.
+    candidates: int
+    kept: int
+    # The number of pairs dropped by every policy. The policies are applied in the order of the fields.
+    dropped_by_distance: int
+    dropped_by_type: int
+    dropped_by_cap: int
+
+
 class SentencePairer:
-    _MARKER_REGEX = r"<e[0-9]*>[^<]*<\/e[0-9]*>"
-    _FILTER_MARKER_REGEX = r"<e[0-9]*>([^<]*)<\/e[0-9]*>"
-    _LEFT_TAG_MARKER_REGEX = r"(<e[0-9]*>)[^<]*<\/e[0-9]*>"
-    _RIGHT_TAG_MARKER_REGEX = r"<e[0-9]*>[^<]*(<\/e[0-9]*>)"
+    # The number of the tag and the content of every marker are captured.
+    _MARKER_REGEX = r"<e([0-9]*)>([^<]*)<\/e[0-9]*>"
 
     _sentences: List[str]
     # The labels should be equal in length to the number of pairs.
@@ -35,24 +54,51 @@ class SentencePairer:
     # _relations hold the class names of all relations.
     _relations: List[str]
     _rel_to_idx: Dict[str, int]
-    # _cum_pairs_per_sent is cumulative.
-    _cum_pairs_per_sent: List[int]
     _marker_regex: Pattern
-    _filter_marker_regex: Pattern
-    _left_tag_marker_regex: Pattern
-    _right_tag_marker_regex: Pattern
-
-    def __init__(self, sentences: List[str], labels: List[str] = None, relations: List[str] = None) -> None:
+    # The markers of all sentences are parsed once and kept in flat arrays: the markers of sentence i are
+    # [_span_offsets[i], _span_offsets[i + 1]) in the order of their tag numbers, so the pair (1, 2) is made of
+    # the first two of them. _span_starts, _span_ends hold the position of a whole marker in its sentence and
+    # _content_starts, _content_ends the position of the text it wraps.
+    _span_offsets: np.ndarray
+    _span_starts: np.ndarray
+    _span_ends: np.ndarray
+    _content_starts: np.ndarray
+    _content_ends: np.ndarray
+    # _token_starts holds the position in whitespace separated tokens of every marker.
+    _token_starts: np.ndarray
+    # _span_order holds the markers of every sentence in the order they appear in it: [_span_offsets[i],
+    # _span_offsets[i + 1]) of it are the markers of sentence i sorted by position.
+    _span_order: np.ndarray
+    # _entity_types holds the types of the entities of every sentence in the order of their tag numbers.
+    _entity_types: List[List[str]]
+    _pruning: PruningPolicy
+    # The pairs of sentence i are the items [_pair_offsets[i], _pair_offsets[i + 1]).
+    # Without pruning the pairs of a sentence are all the combinations of its markers and are decoded
+    # arithmetically. With pruning the pairs kept are listed in _pair_firsts, _pair_seconds at the same positions.
+    _pair_offsets: np.ndarray
+    _pair_firsts: Optional[np.ndarray]
+    _pair_seconds: Optional[np.ndarray]
+    _pruning_stats: PruningStats
+
+    def __init__(
+        self,
+        sentences: List[str],
+        labels: List[str] = None,
+        relations: List[str] = None,
+        entity_types: List[List[str]] = None,
+        pruning: PruningPolicy = None,
+    ) -> None:
         self._sentences = sentences
         self._labels = labels
         self._relations = relations
+        self._entity_types = entity_types
+        self._pruning = pruning if pruning is not None else PruningPolicy()
 
         self._marker_regex = re.compile(self._MARKER_REGEX)
-        self._filter_marker_regex = re.compile(self._FILTER_MARKER_REGEX)
-        self._left_tag_marker_regex = re.compile(self._LEFT_TAG_MARKER_REGEX)
-        self._right_tag_marker_regex = re.compile(self._RIGHT_TAG_MARKER_REGEX)
 
-        self._cum_pairs_per_sent = self._get_pairs_per_sent()
+        self._index_spans()
+        self._validate_entity_types()
+        self._index_pairs()
 
         self._validate_label_count()
         self._validate_relations()
@@ -60,18 +106,14 @@ class SentencePairer:
         self._rel_to_idx = self._get_rel_to_idx()
 
     def __len__(self) -> int:
-        if len(self._cum_pairs_per_sent) == 0:
-            return 0
-
-        return self._cum_pairs_per_sent[len(self._cum_pairs_per_sent) - 1]
+        return int(self._pair_offsets[-1])
 
     def __getitem__(self, idx):
         if not self._exists_pair(idx):
             raise PairOutOfBoundsError(f"non-existing pair at pos {idx}")
 
         sent_idx = self._sent_idx_for_pair_at(idx)
-        num_sent_pairs = self._num_pairs_for_sent(sent_idx)
-        pair_idx = idx - (self._cum_pairs_per_sent[sent_idx] - num_sent_pairs)
+        pair_idx = idx - int(self._pair_offsets[sent_idx])
 
         exc_indices = self._pair_ids_for_comb_idx(sent_idx, pair_idx)
         
@@ -89,98 +131,178 @@ class SentencePairer:
     def rel_idx(self, rel: str) -> int:
         return self._rel_to_idx[rel]
 
-    def _get_pairs_per_sent(self) -> List[int]:
-        total_pairs = 0
-        cum_pairs_per_sent = []
-        
+    def pruning_stats(self) -> PruningStats:
+        return self._pruning_stats
+
+    def _index_spans(self) -> None:
+        span_counts = []
+        spans = []
+        span_order = []
+
         for sent in self._sentences:
-            matches = re.findall(self._marker_regex, sent)
-            pairs_count = math.comb(len(matches), 2)
+            matches = []
+            tokens = 0
+            pos = 0
+
+            for match in self._marker_regex.finditer(sent):
+                tokens += len(sent[pos:match.start()].split())
+                matches.append((match, tokens))
+                tokens += len(match.group(2).split())
+                pos = match.end()
+
+            # Pairs are formed by tag numbers and not by positions. The rank of a marker in tag order is kept
+            # for every position so the sentence could be rebuilt without sorting again.
+            by_tag = np.argsort(np.array([int(match.group(1) or 0) for match, _ in matches], dtype=np.int64), kind="stable")
+            span_order.append(len(spans) + np.argsort(by_tag))
+            matches = [matches[i] for i in by_tag]
+
+            span_counts.append(len(matches))
+            spans.extend((match.start(), match.end(), match.start(2), match.end(2), tokens) for match, tokens in matches)
+
+        self._span_offsets = np.zeros(len(span_counts) + 1, dtype=np.int64)
+        np.cumsum(span_counts, out=self._span_offsets[1:])
+
+        spans = np.array(spans, dtype=np.int64).reshape(-1, 5)
+        self._span_starts, self._span_ends, self._content_starts, self._content_ends, self._token_starts = (
+            np.ascontiguousarray(spans[:, i]) for i in range(5)
+        )
+        self._span_order = np.concatenate(span_order).astype(np.int64) if span_order else np.zeros(0, dtype=np.int64)
+
+    def _index_pairs(self) -> None:
+        if self._pruning != PruningPolicy():
+            self._index_pruned_pairs()
+            return
+
+        pairs_counts = [math.comb(self._spans_count(sent_idx), 2) for sent_idx in range(len(self._sentences))]
+
+        self._pair_offsets = np.zeros(len(pairs_counts) + 1, dtype=np.int64)
+        np.cumsum(pairs_counts, out=self._pair_offsets[1:])
+        self._pair_firsts, self._pair_seconds = None, None
 
-            total_pairs += pairs_count
-            cum_pairs_per_sent.append(total_pairs)
+        total_pairs = len(self)
+        self._pruning_stats = PruningStats(candidates=total_pairs, kept=total_pairs, dropped_by_distance=0, dropped_by_type=0, dropped_by_cap=0)
 
-        return cum_pairs_per_sent
+    # _index_pruned_pairs lists the pairs of every sentence which pass the pruning policies.
+    # The candidates of a sentence are checked all at once and the pairs kept stay in lexicographic order.
+    def _index_pruned_pairs(self) -> None:
+        policy = self._pruning
+        compatible_types = None
+
+        if policy.compatible_types is not None:
+            compatible_types = set(policy.compatible_types) | {(second, first) for first, second in policy.compatible_types}
+
+        firsts, seconds = [], []
+        candidates, dropped_by_distance, dropped_by_type, dropped_by_cap = 0, 0, 0, 0
+
+        for sent_idx in range(len(self._sentences)):
+            first, second = np.triu_indices(self._spans_count(sent_idx), k=1)
+            candidates += len(first)
+
+            token_starts = self._token_starts[self._span_offsets[sent_idx]:self._span_offsets[sent_idx + 1]]
+            distances = np.abs(token_starts[second] - token_starts[first])
+
+            if policy.max_token_distance is not None:
+                kept = distances <= policy.max_token_distance
+                dropped_by_distance += int(np.count_nonzero(~kept))
+                first, second, distances = first[kept], second[kept], distances[kept]
+
+            if compatible_types is not None:
+                types = self._entity_types[sent_idx]
+                kept = np.array([(types[i], types[j]) in compatible_types for i, j in zip(first, second)], dtype=bool)
+                dropped_by_type += int(np.count_nonzero(~kept))
+                first, second, distances = first[kept], second[kept], distances[kept]
+
+            if policy.max_pairs_per_sent is not None and len(first) > policy.max_pairs_per_sent:
+                kept = np.sort(np.argsort(distances, kind="stable")[:policy.max_pairs_per_sent])
+                dropped_by_cap += len(first) - len(kept)
+                first, second = first[kept], second[kept]
+
+            firsts.append(first)
+            seconds.append(second)
+
+        self._pair_offsets = np.zeros(len(firsts) + 1, dtype=np.int64)
+        np.cumsum([len(first) for first in firsts], out=self._pair_offsets[1:])
+        self._pair_firsts = np.concatenate(firsts).astype(np.int64) if firsts else np.zeros(0, dtype=np.int64)
+        self._pair_seconds = np.concatenate(seconds).astype(np.int64) if seconds else np.zeros(0, dtype=np.int64)
+        self._pruning_stats = PruningStats(
+            candidates=candidates,
+            kept=len(self._pair_firsts),
+            dropped_by_distance=dropped_by_distance,
+            dropped_by_type=dropped_by_type,
+            dropped_by_cap=dropped_by_cap,
+        )
+
+    def _spans_count(self, sent_idx: int) -> int:
+        return int(self._span_offsets[sent_idx + 1] - self._span_offsets[sent_idx])
 
     def _exists_pair(self, idx) -> bool:
         return idx >= 0 and idx < len(self)
 
+    # _sent_idx_for_pair_at returns the sentence of the pair at idx: the last one whose pairs start at or before idx.
+    # Sentences without pairs start where the next one does so they are never returned.
     def _sent_idx_for_pair_at(self, idx: int) -> int:
-        left = 0
-        right = len(self._cum_pairs_per_sent) - 1
-
-        # Done because every item of _cum_pairs_per_sent contains the number of
-        # pairs for the given sentence.
-        idx += 1
+        return int(np.searchsorted(self._pair_offsets, idx, side="right")) - 1
 
-        while left < right:
-            mid = left + (right - left) // 2
+    # _pair_ids_for_comb_idx returns the pair at pair_idx among the pairs kept by pruning if any or else among
+    # the combinations of 2 out of the n markers of the sentence in lexicographic order (1, 2), (1, 3), ..., (n - 1, n)
+    # without enumerating them.
+    # Counted from the last pair, the pairs starting with the m-th marker from the end are preceded by
+    # m(m + 1) / 2 pairs so m is the integer root of that triangular number.
+    def _pair_ids_for_comb_idx(self, sent_idx: int, pair_idx: int) -> Tuple[int, int]:
+        if self._pair_firsts is not None:
+            pos = self._pair_offsets[sent_idx] + pair_idx
 
-            if self._cum_pairs_per_sent[mid] == idx:
-                return mid
-            elif self._cum_pairs_per_sent[mid] < idx:
-                left = mid + 1
-            else:
-                right = mid
+            return int(self._pair_firsts[pos]) + 1, int(self._pair_seconds[pos]) + 1
 
-        # left can never become greater than right and we have a sparse representation where
-        # an idx of a triplet would most probably not be found in an array but is a valid idx.
-        return left
+        n = self._spans_count(sent_idx)
+        pairs_count = math.comb(n, 2)
 
-    def _num_pairs_for_sent(self, sent_idx: int) -> int:
-        if sent_idx == 0:
-            return self._cum_pairs_per_sent[0]
-        
-        return self._cum_pairs_per_sent[sent_idx] - self._cum_pairs_per_sent[sent_idx - 1]
+        m = (math.isqrt(8 * (pairs_count - 1 - pair_idx) + 1) - 1) // 2
+        first = n - 2 - m
+        second = pair_idx + first + 1 - pairs_count + math.comb(n - first, 2)
 
-    def _pair_ids_for_comb_idx(self, sent_idx: int, pair_idx: int) -> Tuple[int, int]:
-        matches = re.findall(self._marker_regex, self._sentences[sent_idx])
-        nums = [0] * len(matches)
-        
-        for i in range(len(matches)):
-            nums[i] = i+1
-    
-        combos = list(itertools.combinations(nums, 2))
-        return combos[pair_idx]
+        return first + 1, second + 1
 
+    # _filter_markers builds the sentence in one pass over its markers: the two markers of the pair are
+    # rewritten to < 1 > ... < / 1 > and < 2 > ... < / 2 > and the other ones are replaced by their content.
     def _filter_markers(self, sent_idx: int, exc_indices: Tuple[int, int]) -> str:
         sent = self._sentences[sent_idx]
-        matches = re.findall(self._marker_regex, self._sentences[sent_idx])
-        
-        dropped_markers = []
-        
-        for match in matches:
-            if match.startswith(f"<e{exc_indices[0]}>"):
-                marker_one = match
-                continue
-
-            if match.startswith(f"<e{exc_indices[1]}>"):
-                marker_two = match
-                continue
-            
-            dropped_markers.append(match)
-        
-        # This shouldn't have a big timecomplexity.
-        # After all we don't compile new regexs all the time.
-        for marker in dropped_markers:
-            # we have a guarantee that it is going to be on len 1.
-            filtered_content = re.findall(self._filter_marker_regex, marker)[0]
-            sent = sent.replace(marker, filtered_content)
-
-        # TODO: Fix code repetition.
-        # guaranteed to be of len 1.
-        left_tag = re.findall(self._left_tag_marker_regex, marker_one)[0]
-        right_tag = re.findall(self._right_tag_marker_regex, marker_one)[0]
-        
-        new_marker_one = marker_one.replace(left_tag, "< 1 > ").replace(right_tag, " < / 1 >")
-        
-        # guaranteed to be of len 1.
-        left_tag = re.findall(self._left_tag_marker_regex, marker_two)[0]
-        right_tag = re.findall(self._right_tag_marker_regex, marker_two)[0]
-        
-        new_marker_two = marker_two.replace(left_tag, "< 2 > ").replace(right_tag, " < / 2 >")        
+        start, stop = self._span_offsets[sent_idx], self._span_offsets[sent_idx + 1]
+        pair = {start + exc_indices[0] - 1: "1", start + exc_indices[1] - 1: "2"}
+
+        parts = []
+        pos = 0
+
+        # The markers are visited in the order they appear in the sentence.
+        for span in self._span_order[start:stop].tolist():
+            content = sent[self._content_starts[span]:self._content_ends[span]]
+
+            parts.append(sent[pos:self._span_starts[span]])
+
+            if span in pair:
+                parts.append(f"< {pair[span]} > {content} < / {pair[span]} >")
+            else:
+                parts.append(content)
+
+            pos = self._span_ends[span]
+
+        parts.append(sent[pos:])
+
+        return "".join(parts)
+
+    def _validate_entity_types(self) -> None:
+        if self._pruning.compatible_types is not None and self._entity_types is None:
+            raise ValueError("missing entity types but given compatible types")
+
+        if self._entity_types is None:
+            return
+
+        if len(self._entity_types) != len(self._sentences):
+            raise ValueError(f"expected entity types for {len(self._sentences)} sentences but got {len(self._entity_types)}")
 
-        return sent.replace(marker_one, new_marker_one).replace(marker_two, new_marker_two)
+        for sent_idx, types in enumerate(self._entity_types):
+            if len(types) != self._spans_count(sent_idx):
+                raise ValueError(f"expected {self._spans_count(sent_idx)} entity types for sentence {sent_idx} but got {len(types)}")
 
     def _validate_label_count(self) -> str:
         if self.is_training() and len(self._labels) != len(self):
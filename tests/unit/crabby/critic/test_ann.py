@@ -0,0 +1,67 @@
+import unittest
+
+import numpy as np
+
+import crabby.critic as critic
+
+
+class TestIvfIndex(unittest.TestCase):
+    _entities: np.ndarray
+    _relations: np.ndarray
+    _scorer: critic.TranseScorer
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+
+        self._entities = rng.normal(size=(500, 8)).astype(np.float32)
+        self._relations = rng.normal(size=(3, 8)).astype(np.float32)
+        self._scorer = critic.TranseScorer(self._entities, self._relations)
+
+    def test_all_lists_probed_is_exact(self) -> None:
+        index = critic.IvfIndex.build(self._entities, lists=16, seed=0)
+        queries = self._entities[:5] + self._relations[1]
+
+        ids, dists = index.search(queries, k=10, nprobe=16)
+        exact_ids, exact_dists = self._scorer.top_k_tails(np.arange(5), np.full(5, 1), k=10)
+
+        np.testing.assert_array_equal(ids, exact_ids)
+        np.testing.assert_allclose(dists, exact_dists, rtol=1e-4, atol=1e-4)
+
+    def test_recall_grows_with_nprobe(self) -> None:
+        index = critic.IvfIndex.build(self._entities, lists=16, seed=0)
+        heads = np.arange(50)
+        rels = heads % 3
+
+        reports = critic.recall_benchmark(index, self._scorer, heads, rels, k=10, nprobes=(1, 4, 16))
+
+        self.assertEqual([report.nprobe for report in reports], [1, 4, 16])
+        self.assertLessEqual(reports[0].recall, reports[1].recall)
+        self.assertLessEqual(reports[1].recall, reports[2].recall)
+        self.assertEqual(reports[2].recall, 1.0)
+
+    def test_product_quantization(self) -> None:
+        index = critic.IvfIndex.build(self._entities, lists=8, pq_subspaces=4, pq_centroids=32, seed=0)
+        heads = np.arange(50)
+        rels = heads % 3
+
+        self.assertTrue(index.is_quantized())
+
+        ids, dists = index.top_k_tails(self._scorer, heads, rels, k=10, nprobe=8)
+        self.assertEqual(ids.shape, (50, 10))
+        self.assertTrue(np.all(np.diff(dists, axis=1) >= 0))
+
+        report, = critic.recall_benchmark(index, self._scorer, heads, rels, k=10, nprobes=(8,))
+        self.assertGreater(report.recall, 0.3)
+
+    def test_pads_missing_candidates(self) -> None:
+        index = critic.IvfIndex.build(self._entities[:4], lists=4, seed=0)
+
+        ids, dists = index.search(self._entities[:1], k=3, nprobe=1)
+
+        self.assertEqual(ids[0, 0], 0)
+        self.assertTrue(np.all(ids[0, 1:] == -1))
+        self.assertTrue(np.all(np.isinf(dists[0, 1:])))
+
+    def test_invalid_subspaces(self) -> None:
+        with self.assertRaises(ValueError):
+            critic.IvfIndex.build(self._entities, lists=4, pq_subspaces=3)
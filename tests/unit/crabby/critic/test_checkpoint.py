@@ -0,0 +1,61 @@
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.utils.data as torch_data
+
+import crabby.critic as critic
+
+
+class TestCheckpointer(unittest.TestCase):
+    _onto: critic.Ontology
+
+    def setUp(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=2)], [critic.Trans(rel=0, tail=0)]]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c"])
+
+    def test_restore_without_checkpoint(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            checkpointer = critic.Checkpointer(os.path.join(dir, "transe.pt"))
+
+            self.assertFalse(checkpointer.restore(self._trainer(seed=0)))
+
+    def test_resume_reproduces_trajectory(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            checkpointer = critic.Checkpointer(os.path.join(dir, "transe.pt"), every=2)
+
+            trainer = self._trainer(seed=0)
+
+            for _ in range(2):
+                trainer.train_one_epoch()
+                checkpointer.after_epoch(trainer)
+
+            checkpointer.wait()
+
+            for _ in range(2):
+                trainer.train_one_epoch()
+
+            # A trainer created from scratch with another seed catches up from the checkpoint.
+            resumed = self._trainer(seed=1)
+            self.assertTrue(checkpointer.restore(resumed))
+            self.assertEqual(resumed.epoch(), 2)
+
+            for _ in range(2):
+                resumed.train_one_epoch()
+
+            for name, param in trainer.model().state_dict().items():
+                self.assertTrue(torch.equal(param, resumed.model().state_dict()[name]))
+
+    def _trainer(self, seed: int) -> critic.Trainer:
+        torch.manual_seed(seed)
+
+        model = critic.TranseModel(self._onto, k=4)
+        optimizer = torch.optim.SGD(model.parameters(), lr=0.01, momentum=0.9)
+
+        dataset = critic.TripletTensorDataset(self._onto)
+        batch_sampler = critic.TripletBatchSampler(len(dataset), batch_size=2, generator=torch.Generator().manual_seed(seed))
+        loader = torch_data.DataLoader(dataset, sampler=batch_sampler, batch_size=None)
+        sampler = critic.NegativeSampler(self._onto, seed=seed)
+
+        return critic.Trainer(loader, self._onto, optimizer, model, margin=1, sampler=sampler)
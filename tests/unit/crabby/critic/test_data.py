@@ -1,6 +1,10 @@
+import os
+import pickle
+import tempfile
 from typing import List
 import unittest
 
+import numpy as np
 import torch
 import torch.utils.data as torch_data
 
@@ -28,6 +32,27 @@ class TestOntology(unittest.TestCase):
         self.assertFalse(onto.exists(triplet=critic.Triplet(head=0, rel=1, tail=1)))
         self.assertFalse(onto.exists(triplet=critic.Triplet(head=1, rel=0, tail=1)))
 
+    def test_exists_with_index(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities, indexed=True)
+
+        self.assertTrue(onto.is_indexed())
+        self.assertTrue(onto.exists(triplet=critic.Triplet(head=1, rel=1, tail=0)))
+        self.assertFalse(onto.exists(triplet=critic.Triplet(head=1, rel=0, tail=1)))
+
+    def test_exists_many(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        exists = onto.exists_many(torch.tensor([[0, 0, 1], [0, 1, 1], [1, 1, 1], [5, 0, 1], [0, 7, 1]]))
+
+        self.assertEqual(exists.tolist(), [True, False, True, False, False])
+
+    def test_exists_many_after_add_triplets(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities, indexed=True)
+
+        onto.add_triplets([critic.Triplet(head=0, rel=1, tail=1)])
+
+        self.assertEqual(onto.exists_many(torch.tensor([[0, 1, 1], [0, 0, 1]])).tolist(), [True, True])
+
     def test_entities_len(self) -> None:
         onto = critic.Ontology(self._adj_list, self._rels, self._entities)
         
@@ -72,6 +97,100 @@ class TestOntology(unittest.TestCase):
         self.assertEqual(onto.get_triplet(3), critic.Triplet(head=1, rel=1, tail=1))
         self.assertEqual(onto.get_triplet(4), bar_triplet)
 
+    def test_add_triplets_is_visible_before_compaction(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities, indexed=True)
+
+        onto.add_triplets([critic.Triplet(head=0, rel=1, tail=0)])
+
+        self.assertEqual(onto.triplets_len(), 4)
+        self.assertTrue(onto.exists(critic.Triplet(head=0, rel=1, tail=0)))
+        self.assertEqual(onto.exists_many(torch.tensor([[0, 1, 0], [0, 0, 0]])).tolist(), [True, False])
+
+    def test_add_entities_and_relations(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities, indexed=True)
+
+        self.assertEqual(list(onto.add_entities(["c", "d"])), [2, 3])
+        self.assertEqual(list(onto.add_relations(["z"])), [2])
+
+        onto.add_triplets([critic.Triplet(head=3, rel=2, tail=0), critic.Triplet(head=0, rel=2, tail=2)])
+
+        self.assertEqual(onto.entities_len(), 4)
+        self.assertEqual(onto.relations_len(), 3)
+        self.assertTrue(onto.exists(critic.Triplet(head=3, rel=2, tail=0)))
+
+        onto.compact()
+
+        self.assertEqual(onto.get_triplet(1), critic.Triplet(head=0, rel=2, tail=2))
+        self.assertEqual(onto.get_triplet(4), critic.Triplet(head=3, rel=2, tail=0))
+        self.assertEqual(onto.exists_many(torch.tensor([[3, 2, 0], [0, 0, 1], [2, 2, 0]])).tolist(), [True, True, False])
+
+    def test_add_triplets_compacts_periodically(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+        triplets = [critic.Triplet(head=0, rel=0, tail=0)] * 5000
+
+        onto.add_triplets(triplets)
+
+        self.assertEqual(onto.triplets_len(), 5003)
+        self.assertTrue(onto.exists(critic.Triplet(head=0, rel=0, tail=0)))
+
+        # The existing triplet of the head stays ahead of the added ones.
+        outgoing = onto.outgoing(0)
+        self.assertEqual(len(outgoing), 5001)
+        self.assertEqual(outgoing[:2].tolist(), [[0, 1], [0, 0]])
+
+        onto.compact()
+
+        self.assertEqual(onto.triplets_len(), 5003)
+        self.assertEqual(onto.outgoing(0).tolist(), outgoing.tolist())
+        self.assertEqual(onto.get_triplet(5002), critic.Triplet(head=1, rel=1, tail=1))
+
+    def test_outgoing(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        self.assertEqual(onto.outgoing(1).tolist(), [[1, 0], [1, 1]])
+
+    def test_incoming(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        self.assertEqual(onto.incoming(0).tolist(), [[1, 1]])
+        self.assertEqual(onto.incoming(1).tolist(), [[0, 0], [1, 1]])
+
+    def test_relation_pairs(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        self.assertEqual(onto.relation_pairs(0).tolist(), [[0, 1]])
+        self.assertEqual(onto.relation_pairs(1).tolist(), [[1, 0], [1, 1]])
+
+    def test_indexes_follow_added_triplets(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+        onto.incoming(0)
+        onto.relation_pairs(0)
+
+        onto.add_entities(["c"])
+        onto.add_relations(["z"])
+        onto.add_triplets([critic.Triplet(head=2, rel=2, tail=0)])
+
+        self.assertEqual(onto.incoming(0).tolist(), [[1, 1], [2, 2]])
+        self.assertEqual(onto.relation_pairs(2).tolist(), [[2, 0]])
+        self.assertEqual(onto.incoming(2).tolist(), [])
+
+    def test_adjacency(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        self.assertEqual(onto.adjacency().toarray().tolist(), [[0, 1], [1, 1]])
+        self.assertEqual(onto.adjacency([0]).toarray().tolist(), [[0, 1], [0, 0]])
+
+    def test_adjacency_counts_duplicates(self) -> None:
+        onto = critic.Ontology([[critic.Trans(rel=0, tail=1), critic.Trans(rel=1, tail=1)], []], self._rels, self._entities)
+
+        self.assertEqual(onto.adjacency().toarray().tolist(), [[0, 2], [0, 0]])
+
+    def test_incoming_of_non_existing_tail(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        with self.assertRaises(critic.TripletOutOfBoundsError):
+            onto.incoming(5)
+
     def test_add_triplet_with_non_existing_head(self) -> None:
         onto = critic.Ontology(self._adj_list, self._rels, self._entities)
         
@@ -90,6 +209,94 @@ class TestOntology(unittest.TestCase):
         with self.assertRaises(critic.TripletOutOfBoundsError):
             onto.add_triplets([critic.Triplet(head=0, rel=0, tail=30)])
 
+    def test_get_triplet_skips_heads_without_triplets(self) -> None:
+        onto = critic.Ontology([[], [critic.Trans(rel=0, tail=0)], []], self._rels, ["a", "b", "c"])
+
+        self.assertEqual(onto.get_triplet(0), critic.Triplet(head=1, rel=0, tail=0))
+
+    def test_from_csr(self) -> None:
+        onto = critic.Ontology.from_csr(
+            offsets=np.array([0, 1, 3]),
+            rels=np.array([0, 1, 1]),
+            tails=np.array([1, 0, 1]),
+            relations=self._rels,
+            entities=self._entities,
+        )
+
+        self.assertEqual(onto.triplets_len(), 3)
+        self.assertEqual(onto.get_triplet(2), critic.Triplet(head=1, rel=1, tail=1))
+        self.assertTrue(onto.exists(critic.Triplet(head=1, rel=1, tail=0)))
+
+    def test_triplets_range(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        triplets = onto.triplets_range(1, 3)
+
+        self.assertEqual(triplets.tolist(), [[1, 1, 0], [1, 1, 1]])
+
+    def test_triplets_range_out_of_bounds(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+
+        with self.assertRaises(critic.TripletOutOfBoundsError):
+            onto.triplets_range(1, 4)
+
+    def test_save_and_open(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, ["a", "é"], indexed=True)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "onto.bin")
+            onto.save(path)
+
+            opened = critic.Ontology.open(path)
+
+            self.assertTrue(opened.is_indexed())
+            self.assertEqual(opened.triplets_len(), 3)
+            self.assertEqual(opened.entities_len(), 2)
+            self.assertEqual(opened.get_triplet(2), critic.Triplet(head=1, rel=1, tail=1))
+            self.assertEqual(list(opened._entities), ["a", "é"])
+            self.assertEqual(opened.exists_many(torch.tensor([[1, 1, 0], [0, 1, 0]])).tolist(), [True, False])
+
+            unpickled = pickle.loads(pickle.dumps(opened))
+            self.assertEqual(unpickled.get_triplet(1), critic.Triplet(head=1, rel=1, tail=0))
+
+    def test_save_over_opened_file(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities, indexed=True)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "onto.bin")
+            onto.save(path)
+
+            opened = critic.Ontology.open(path)
+            opened.add_triplets([critic.Triplet(head=0, rel=1, tail=0)])
+            opened.save(path)
+
+            self.assertEqual(opened.triplets_len(), 4)
+            self.assertTrue(opened.exists(critic.Triplet(head=0, rel=1, tail=0)))
+
+            reopened = critic.Ontology.open(path)
+
+            self.assertEqual(reopened.triplets_len(), 4)
+            self.assertTrue(reopened.exists(critic.Triplet(head=0, rel=1, tail=0)))
+            self.assertEqual(os.listdir(dir), ["onto.bin"])
+
+    def test_triplets_isin(self) -> None:
+        onto = critic.Ontology(self._adj_list, self._rels, self._entities)
+        triplets = torch.tensor([[0, 0, 1], [1, 1, 0], [1, 1, 1], [5, 0, 0]])
+
+        found = critic.triplets_isin(onto, triplets, torch.tensor([[1, 1, 1], [0, 0, 1]]))
+
+        self.assertEqual(found.tolist(), [True, False, True, False])
+
+    def test_open_non_ontology_file(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "crab.bin")
+
+            with open(path, "wb") as stream:
+                stream.write(b"I am a crab, not an ontology.")
+
+            with self.assertRaises(critic.StorageFormatError):
+                critic.Ontology.open(path)
+
     def test_validation_of_adj_list(self) -> None:
         self._entities.append("crab")
         
@@ -97,6 +304,60 @@ class TestOntology(unittest.TestCase):
             critic.Ontology(self._adj_list, self._rels, self._entities)
 
 
+class TestNegativeSampler(unittest.TestCase):
+    _onto: critic.Ontology
+
+    def setUp(self) -> None:
+        # Relation 0 is one-to-many and relation 1 is many-to-one.
+        adj_list = [
+            [critic.Trans(rel=0, tail=1), critic.Trans(rel=0, tail=2), critic.Trans(rel=0, tail=3)],
+            [critic.Trans(rel=1, tail=0)],
+            [critic.Trans(rel=1, tail=0)],
+            [critic.Trans(rel=1, tail=0)],
+        ]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c", "d"])
+
+    def test_sample_corrupts_one_side(self) -> None:
+        sampler = critic.NegativeSampler(self._onto, k=3, seed=1)
+        triplets = self._onto.triplets_range(0, self._onto.triplets_len())
+
+        negatives = sampler.sample(triplets)
+        positives = triplets.repeat_interleave(3, dim=0)
+
+        self.assertEqual(negatives.shape, (len(triplets) * 3, 3))
+        self.assertTrue(torch.equal(negatives[:, 1], positives[:, 1]))
+        self.assertTrue(((negatives[:, 0] == positives[:, 0]) | (negatives[:, 2] == positives[:, 2])).all())
+
+    def test_sample_is_seedable(self) -> None:
+        triplets = self._onto.triplets_range(0, self._onto.triplets_len())
+
+        first = critic.NegativeSampler(self._onto, k=2, seed=7).sample(triplets)
+        second = critic.NegativeSampler(self._onto, k=2, seed=7).sample(triplets)
+
+        self.assertTrue(torch.equal(first, second))
+
+    def test_filtered_sample_skips_known_triplets(self) -> None:
+        sampler = critic.NegativeSampler(self._onto, k=8, filtered=True, seed=3, max_retries=100)
+
+        negatives = sampler.sample(self._onto.triplets_range(0, self._onto.triplets_len()))
+
+        self.assertFalse(self._onto.exists_many(negatives).any())
+
+    def test_bernoulli_corrupts_the_many_side_less(self) -> None:
+        sampler = critic.NegativeSampler(self._onto, mode=critic.NegativeSampler.BERNOULLI, k=1000, seed=5)
+
+        negatives = sampler.sample(torch.tensor([[0, 0, 1], [1, 1, 0]]))
+        one_to_many, many_to_one = negatives[:1000], negatives[1000:]
+
+        # tph / (tph + hpt) is 3 / 4 for the one-to-many relation and 1 / 4 for the many-to-one one.
+        self.assertGreater(float((one_to_many[:, 2] == 1).float().mean()), 0.5)
+        self.assertGreater(float((many_to_one[:, 0] == 1).float().mean()), 0.5)
+
+    def test_invalid_mode(self) -> None:
+        with self.assertRaises(ValueError):
+            critic.NegativeSampler(self._onto, mode="crab")
+
+
 class TestTripletDataset(unittest.TestCase):
     _onto: critic.Ontology
     _adj_list: List[List[critic.Trans]]
@@ -119,6 +380,11 @@ class TestTripletDataset(unittest.TestCase):
         
         self._assert_tensor_triplet_equals(dataset[1], expected_triplet=critic.Triplet(head=1, rel=1, tail=0))
 
+    def test_triplets(self) -> None:
+        dataset = critic.TripletDataset(self._onto)
+
+        self.assertTrue(torch.equal(dataset.triplets(), torch.stack([dataset[i] for i in range(len(dataset))])))
+
     # not exactly a unit test but useful...
     def test_triplet_dataloader(self) -> None:
         loader = torch_data.DataLoader(critic.TripletDataset(self._onto), batch_size=1, shuffle=False)
@@ -132,3 +398,47 @@ class TestTripletDataset(unittest.TestCase):
         
         for i in range(3):
             self.assertEqual(triplet[i].item(), expected_tensor_triplet[i])
+
+
+class TestTripletTensorDataset(unittest.TestCase):
+    _onto: critic.Ontology
+
+    def setUp(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=1)]]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b"])
+
+    def test_len(self) -> None:
+        dataset = critic.TripletTensorDataset(self._onto)
+
+        self.assertEqual(len(dataset), 3)
+
+    def test_getitem(self) -> None:
+        dataset = critic.TripletTensorDataset(self._onto)
+
+        self.assertEqual(dataset[1].tolist(), [1, 1, 0])
+        self.assertEqual(dataset[torch.tensor([2, 0])].tolist(), [[1, 1, 1], [0, 0, 1]])
+
+    def test_batch_sampler(self) -> None:
+        sampler = critic.TripletBatchSampler(5, batch_size=2, generator=torch.Generator().manual_seed(0))
+
+        batches = list(sampler)
+
+        self.assertEqual(len(sampler), 3)
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual(sorted(torch.cat(batches).tolist()), [0, 1, 2, 3, 4])
+
+    def test_batch_sampler_drop_last(self) -> None:
+        sampler = critic.TripletBatchSampler(5, batch_size=2, shuffle=False, drop_last=True)
+
+        self.assertEqual(len(sampler), 2)
+        self.assertEqual([batch.tolist() for batch in sampler], [[0, 1], [2, 3]])
+
+    # not exactly a unit test but useful...
+    def test_triplet_dataloader(self) -> None:
+        dataset = critic.TripletTensorDataset(self._onto)
+        loader = torch_data.DataLoader(dataset, sampler=critic.TripletBatchSampler(len(dataset), batch_size=2, shuffle=False), batch_size=None)
+
+        batches = list(loader)
+
+        self.assertEqual(batches[0].tolist(), [[0, 0, 1], [1, 1, 0]])
+        self.assertEqual(batches[1].tolist(), [[1, 1, 1]])
@@ -0,0 +1,111 @@
+import os
+import tempfile
+import unittest
+from typing import List
+
+import torch
+import torch.utils.data as torch_data
+
+import crabby.critic as critic
+
+
+# ScriptedCalculator answers the validations with the given MRRs in order.
+class ScriptedCalculator:
+    _mrrs: List[float]
+    _models: List[critic.TranseModel]
+
+    def __init__(self, mrrs: List[float]) -> None:
+        self._mrrs = mrrs
+        self._models = []
+
+    def evaluate(self, model: critic.TranseModel) -> critic.RankingBundle:
+        mrr = self._mrrs[min(len(self._models), len(self._mrrs) - 1)]
+        self._models.append(model)
+
+        return critic.RankingBundle(mrr=mrr, mean_rank=1.0 / mrr, hits_at_1=0.0, hits_at_3=0.0, hits_at_10=0.0)
+
+    def model_for(self, mrr: float) -> critic.TranseModel:
+        return self._models[self._mrrs.index(mrr)]
+
+
+class TestTrainingLoop(unittest.TestCase):
+    _onto: critic.Ontology
+    _trainer: critic.Trainer
+
+    def setUp(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=2)], [critic.Trans(rel=0, tail=0)]]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c"])
+
+        torch.manual_seed(0)
+        self._trainer = self._new_trainer()
+
+    def test_stops_after_patience(self) -> None:
+        calculator = ScriptedCalculator([0.1, 0.3, 0.2, 0.2, 0.2, 0.2])
+        loop = critic.TrainingLoop(self._trainer, calculator, validate_every=1, patience=2, max_epochs=50)
+
+        best = loop.run()
+
+        self.assertEqual(best.bundle.mrr, 0.3)
+        self.assertLess(self._trainer.epoch(), 50)
+        self.assertEqual([result.bundle.mrr for result in loop.history()][-2:], [0.2, 0.2])
+
+    def test_restores_best_model(self) -> None:
+        calculator = ScriptedCalculator([0.5, 0.1, 0.1])
+        loop = critic.TrainingLoop(self._trainer, calculator, validate_every=1, patience=2, max_epochs=50)
+
+        loop.run()
+
+        best_weights = calculator.model_for(0.5).entity_embeddings.weight
+        self.assertTrue(torch.equal(self._trainer.model().entity_embeddings.weight, best_weights))
+
+    def test_restores_best_mmap_model(self) -> None:
+        onto = self._onto
+
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.TranseModel.mmap_entity_table(onto, k=4, path=os.path.join(dir, "entities.bin"), capacity=3)
+            model = critic.TranseModel(onto, k=4, entity_table=table)
+            loader = torch_data.DataLoader(critic.TripletDataset(onto), batch_size=2)
+            trainer = critic.Trainer(loader, onto, torch.optim.SGD(model.parameters(), lr=0.1), model, margin=1)
+
+            calculator = ScriptedCalculator([0.5, 0.1, 0.1])
+            critic.TrainingLoop(trainer, calculator, validate_every=1, patience=2, max_epochs=50).run()
+
+            # The validated copies are frozen so the best one still holds the weights of its epoch.
+            self.assertTrue(torch.equal(model.entity_rows(), calculator.model_for(0.5).entity_rows()))
+            self.assertFalse(torch.equal(model.entity_rows(), calculator.model_for(0.1).entity_rows()))
+
+    def test_runs_until_max_epochs_while_improving(self) -> None:
+        calculator = ScriptedCalculator([0.1, 0.2, 0.3, 0.4])
+        loop = critic.TrainingLoop(self._trainer, calculator, validate_every=2, patience=1, max_epochs=4)
+
+        loop.run()
+
+        self.assertEqual(self._trainer.epoch(), 4)
+
+    def test_resumes_early_stopping_state(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            checkpointer = critic.Checkpointer(os.path.join(dir, "transe.pt"))
+            calculator = ScriptedCalculator([0.5, 0.1, 0.1])
+            loop = critic.TrainingLoop(self._trainer, calculator, validate_every=1, patience=2, max_epochs=50, checkpointer=checkpointer)
+
+            best = loop.run()
+            checkpointer.save(self._trainer, loop.state_dict(), calculator.model_for(0.5))
+            checkpointer.wait()
+
+            resumed = self._new_trainer()
+            self.assertTrue(checkpointer.restore(resumed))
+            resumed_loop = critic.TrainingLoop(resumed, ScriptedCalculator([0.9]), validate_every=1, patience=2, max_epochs=50, checkpointer=checkpointer)
+
+            self.assertEqual(resumed_loop.best(), best)
+            self.assertEqual(resumed_loop.history(), loop.history())
+
+            # The patience is already used up so the resumed loop stops right away with the best weights.
+            self.assertEqual(resumed_loop.run(), best)
+            self.assertEqual(resumed.epoch(), self._trainer.epoch())
+            self.assertTrue(torch.equal(resumed.model().entity_embeddings.weight, calculator.model_for(0.5).entity_embeddings.weight))
+
+    def _new_trainer(self) -> critic.Trainer:
+        model = critic.TranseModel(self._onto, k=4)
+        loader = torch_data.DataLoader(critic.TripletDataset(self._onto), batch_size=2)
+
+        return critic.Trainer(loader, self._onto, torch.optim.SGD(model.parameters(), lr=0.1), model, margin=1)
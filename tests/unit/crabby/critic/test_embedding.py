@@ -0,0 +1,196 @@
+import copy
+import gc
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+import torch.utils.data as torch_data
+
+import crabby.critic as critic
+
+
+class TestMmapEmbedding(unittest.TestCase):
+    def test_evicts_least_recently_used_and_writes_back(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.MmapEmbedding.create(os.path.join(dir, "entities.bin"), 6, 2, capacity=2)
+            original = table.rows()
+
+            slots = table.resident(torch.tensor([0, 1]), dirty=True)
+            with torch.no_grad():
+                table.weight[slots] += 1.0
+
+            table.resident(torch.tensor([1]))
+            # 0 is the least recently used row so it is evicted and written back.
+            table.resident(torch.tensor([2]))
+
+            self.assertTrue(torch.equal(table.rows(0, 1), original[0:1] + 1.0))
+            self.assertTrue(torch.equal(torch.from_numpy(np.array(table._table[0])), original[0] + 1.0))
+            # 1 is still cached and not written back until flush.
+            self.assertTrue(torch.equal(torch.from_numpy(np.array(table._table[1])), original[1]))
+            self.assertTrue(torch.equal(table.rows(1, 2), original[1:2] + 1.0))
+
+            table.flush()
+            reopened = critic.MmapEmbedding(table.path(), capacity=2)
+
+            self.assertTrue(torch.equal(reopened.rows(), table.rows()))
+
+    def test_access_larger_than_cache(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.MmapEmbedding.create(os.path.join(dir, "entities.bin"), 6, 2, capacity=2)
+
+            with self.assertRaises(ValueError):
+                table.resident(torch.tensor([0, 1, 2]))
+
+    def test_pickle_maps_same_file(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.MmapEmbedding.create(os.path.join(dir, "entities.bin"), 4, 2, capacity=4)
+            table.resident(torch.tensor([3]), dirty=True)
+
+            with torch.no_grad():
+                table.weight.zero_()
+
+            unpickled = pickle.loads(pickle.dumps(table))
+
+            self.assertTrue(torch.equal(unpickled.rows(3, 4), torch.zeros(1, 2)))
+
+    def test_deepcopy_is_frozen_snapshot(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.MmapEmbedding.create(os.path.join(dir, "entities.bin"), 4, 2, capacity=2)
+            slots = table.resident(torch.tensor([0, 1]), dirty=True)
+
+            with torch.no_grad():
+                table.weight[slots] += 1.0
+
+            snapshot = copy.deepcopy(table)
+            expected = table.rows()
+
+            slots = table.resident(torch.tensor([1, 2]), dirty=True)
+
+            with torch.no_grad():
+                table.weight[slots] += 1.0
+
+            table.flush()
+
+            self.assertNotEqual(snapshot.path(), table.path())
+            self.assertTrue(torch.equal(snapshot.rows(), expected))
+
+            snapshot_path = snapshot.path()
+            del snapshot
+            gc.collect()
+
+            self.assertFalse(os.path.exists(snapshot_path))
+
+    def test_load_table_replaces_cached_rows(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.MmapEmbedding.create(os.path.join(dir, "entities.bin"), 4, 2, capacity=2)
+            table.copy_table(os.path.join(dir, "copy.bin"))
+            expected = table.rows()
+
+            slots = table.resident(torch.tensor([0, 3]), dirty=True)
+
+            with torch.no_grad():
+                table.weight[slots] += 1.0
+
+            table.load_table(os.path.join(dir, "copy.bin"))
+
+            self.assertTrue(torch.equal(table.rows(), expected))
+            table.flush()
+            self.assertTrue(torch.equal(critic.MmapEmbedding(table.path(), capacity=2).rows(), expected))
+
+
+class TestMmapTranseModel(unittest.TestCase):
+    _onto: critic.Ontology
+
+    def setUp(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=2)], [critic.Trans(rel=0, tail=3)], []]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c", "d"])
+
+    def test_training_and_evaluation(self) -> None:
+        torch.manual_seed(0)
+
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.TranseModel.mmap_entity_table(self._onto, k=4, path=os.path.join(dir, "entities.bin"), capacity=3)
+            model = critic.TranseModel(self._onto, k=4, entity_table=table)
+            dataset = critic.TripletTensorDataset(self._onto)
+            loader = torch_data.DataLoader(dataset, sampler=critic.TripletBatchSampler(len(dataset), batch_size=1), batch_size=None)
+
+            trainer = critic.Trainer(loader, self._onto, torch.optim.SGD(model.parameters(), lr=0.1), model, margin=1, sampler=critic.NegativeSampler(self._onto, seed=0))
+            before = model.entity_rows()
+
+            trainer.train_one_epoch()
+
+            self.assertTrue(model.is_sparse())
+            self.assertFalse(torch.equal(before, model.entity_rows()))
+            self.assertTrue(bool((model.entity_rows().norm(dim=1) <= 1.0 + 1e-5).all()))
+
+            triplets = dataset.triplets()
+            self.assertTrue(torch.allclose(model.score(triplets), model.score_tails(triplets[:, 0], triplets[:, 1])[torch.arange(len(triplets)), triplets[:, 2]], atol=1e-5))
+
+            bundle = critic.Calculator(dataset, self._onto, seed=0).evaluate(model)
+            self.assertGreater(bundle.mrr, 0.0)
+
+    def test_checkpoint_restores_table_of_its_epoch(self) -> None:
+        torch.manual_seed(0)
+
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.TranseModel.mmap_entity_table(self._onto, k=4, path=os.path.join(dir, "entities.bin"), capacity=3)
+            trainer = self._trainer(critic.TranseModel(self._onto, k=4, entity_table=table))
+            checkpointer = critic.Checkpointer(os.path.join(dir, "transe.pt"))
+
+            trainer.train_one_epoch()
+            checkpointer.save(trainer)
+            expected = trainer.model().entity_rows()
+
+            trainer.train_one_epoch()
+            self.assertFalse(torch.equal(trainer.model().entity_rows(), expected))
+
+            # The table is brought back to the point in time of the checkpoint.
+            self.assertTrue(checkpointer.restore(trainer))
+            self.assertEqual(trainer.epoch(), 1)
+            self.assertTrue(torch.equal(trainer.model().entity_rows(), expected))
+
+            trainer.train_one_epoch()
+            checkpointer.save(trainer)
+            checkpointer.wait()
+
+            # Only the table copy of the last checkpoint is kept.
+            self.assertFalse(os.path.exists(os.path.join(dir, "transe.pt.entities-1")))
+            self.assertTrue(os.path.exists(os.path.join(dir, "transe.pt.entities-2")))
+
+    def test_copy_from_snapshot(self) -> None:
+        torch.manual_seed(0)
+
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.TranseModel.mmap_entity_table(self._onto, k=4, path=os.path.join(dir, "entities.bin"), capacity=3)
+            model = critic.TranseModel(self._onto, k=4, entity_table=table)
+            trainer = self._trainer(model)
+
+            trainer.train_one_epoch()
+            snapshot = copy.deepcopy(model)
+            expected = model.entity_rows()
+
+            trainer.train_one_epoch()
+            self.assertTrue(torch.equal(snapshot.entity_rows(), expected))
+            self.assertFalse(torch.equal(model.entity_rows(), expected))
+
+            model.copy_from(snapshot)
+
+            self.assertTrue(torch.equal(model.entity_rows(), expected))
+            self.assertTrue(torch.equal(model.rel_embeddings.weight, snapshot.rel_embeddings.weight))
+
+    def test_hogwild_rejects_mmap_model(self) -> None:
+        with tempfile.TemporaryDirectory() as dir:
+            table = critic.TranseModel.mmap_entity_table(self._onto, k=4, path=os.path.join(dir, "entities.bin"), capacity=3)
+            model = critic.TranseModel(self._onto, k=4, entity_table=table)
+
+            with self.assertRaises(ValueError):
+                critic.HogwildTrainer(self._onto.triplets_range(0, self._onto.triplets_len()), self._onto, model, margin=1)
+
+    def _trainer(self, model: critic.TranseModel) -> critic.Trainer:
+        dataset = critic.TripletTensorDataset(self._onto)
+        loader = torch_data.DataLoader(dataset, sampler=critic.TripletBatchSampler(len(dataset), batch_size=1), batch_size=None)
+
+        return critic.Trainer(loader, self._onto, torch.optim.SGD(model.parameters(), lr=0.1), model, margin=1, sampler=critic.NegativeSampler(self._onto, seed=0))
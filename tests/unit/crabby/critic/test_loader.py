@@ -0,0 +1,66 @@
+import os
+import tempfile
+import unittest
+
+import crabby.critic as critic
+
+
+class TestOntologyLoader(unittest.TestCase):
+    _path: str
+
+    def setUp(self) -> None:
+        lines = [
+            "# a comment",
+            "<http://ex.org/a> <http://ex.org/knows> <http://ex.org/b> .",
+            "<http://ex.org/b> <http://ex.org/knows> <http://ex.org/a> .",
+            "",
+            '<http://ex.org/a> <http://ex.org/name> "Alice \\"A\\""@en .',
+            "_:x <http://ex.org/knows> <http://ex.org/a> .",
+            "this is not a triplet",
+        ]
+
+        fd, self._path = tempfile.mkstemp(suffix=".nt")
+
+        with os.fdopen(fd, "w") as stream:
+            stream.write("\n".join(lines))
+
+    def tearDown(self) -> None:
+        os.remove(self._path)
+
+    def test_load_ntriples(self) -> None:
+        loader = critic.OntologyLoader(report_every=0)
+
+        onto = loader.load_ntriples(self._path)
+
+        self.assertEqual(onto.triplets_len(), 4)
+        self.assertEqual(onto.entities_len(), 4)
+        self.assertEqual(onto.relations_len(), 2)
+
+        # a, knows and b are interned first.
+        self.assertTrue(onto.exists(critic.Triplet(head=0, rel=0, tail=1)))
+        self.assertTrue(onto.exists(critic.Triplet(head=1, rel=0, tail=0)))
+        self.assertTrue(onto.exists(critic.Triplet(head=3, rel=0, tail=0)))
+        self.assertEqual(onto.get_triplet(1), critic.Triplet(head=0, rel=1, tail=2))
+
+    def test_stats(self) -> None:
+        loader = critic.OntologyLoader(report_every=0)
+
+        loader.load_ntriples(self._path)
+        stats = loader.stats()
+
+        self.assertEqual(stats.triplets, 4)
+        self.assertEqual(stats.entities, 4)
+        self.assertEqual(stats.relations, 2)
+        self.assertEqual(stats.skipped, 1)
+
+    def test_load_ntriples_with_trailing_comments(self) -> None:
+        with open(self._path, "w") as stream:
+            stream.write("<http://ex.org/a> <http://ex.org/knows> <http://ex.org/b> . # a comment\n")
+            stream.write('<http://ex.org/b> <http://ex.org/name> "B # not a comment" .#another\n')
+
+        loader = critic.OntologyLoader(report_every=0)
+        onto = loader.load_ntriples(self._path)
+
+        self.assertEqual(onto.triplets_len(), 2)
+        self.assertEqual(loader.stats().skipped, 0)
+        self.assertTrue(onto.exists(critic.Triplet(head=0, rel=0, tail=1)))
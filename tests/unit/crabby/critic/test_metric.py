@@ -0,0 +1,132 @@
+import unittest
+
+import torch
+
+import crabby.critic as critic
+
+
+class TestCalculator(unittest.TestCase):
+    _onto: critic.Ontology
+    _model: critic.TranseModel
+
+    def setUp(self) -> None:
+        adj_list = [
+            [critic.Trans(rel=0, tail=1), critic.Trans(rel=1, tail=2)],
+            [critic.Trans(rel=0, tail=2)],
+            [critic.Trans(rel=1, tail=3)],
+            [critic.Trans(rel=0, tail=0)],
+        ]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c", "d"])
+
+        torch.manual_seed(0)
+        self._model = critic.TranseModel(self._onto, k=8)
+
+    def test_score_tails_matches_forward(self) -> None:
+        triplets = self._onto.triplets_range(0, self._onto.triplets_len())
+
+        dists = self._model.score_tails(triplets[:, 0], triplets[:, 1])
+
+        for i, triplet in enumerate(triplets):
+            self.assertAlmostEqual(dists[i, triplet[2]].item(), self._model(triplet.unsqueeze(0)).item(), places=5)
+
+    def test_score_heads_matches_forward(self) -> None:
+        triplets = self._onto.triplets_range(0, self._onto.triplets_len())
+
+        dists = self._model.score_heads(triplets[:, 1], triplets[:, 2])
+
+        for i, triplet in enumerate(triplets):
+            self.assertAlmostEqual(dists[i, triplet[0]].item(), self._model(triplet.unsqueeze(0)).item(), places=5)
+
+    def test_calculate_matches_brute_force(self) -> None:
+        dataset = critic.TripletTensorDataset(self._onto)
+        calc = critic.Calculator(dataset, self._onto, sample_size=10, batch_size=4, shard_size=3, seed=0)
+
+        sample = self._expected_sample(dataset.triplets(), sample_size=10, shard_size=3, seed=0)
+        metrics = calc.calculate(self._model)
+
+        self.assertGreater(len(torch.unique(sample, dim=0)), 1)
+        self.assertAlmostEqual(metrics.mean_rank, self._brute_force_mean_rank(sample), places=5)
+        self.assertGreaterEqual(metrics.hits_at_10, 0.0)
+        self.assertLessEqual(metrics.hits_at_10, 1.0)
+
+    def test_calculate_does_not_depend_on_workers(self) -> None:
+        dataset = critic.TripletTensorDataset(self._onto)
+
+        serial = critic.Calculator(dataset, self._onto, sample_size=10, shard_size=3, seed=4).calculate(self._model)
+        parallel = critic.Calculator(dataset, self._onto, sample_size=10, shard_size=3, seed=4, workers=2).calculate(self._model)
+
+        self.assertEqual(serial, parallel)
+
+    def test_evaluate_matches_brute_force(self) -> None:
+        dataset = critic.TripletTensorDataset(self._onto)
+        calc = critic.Calculator(dataset, self._onto, batch_size=2, chunk_size=3)
+
+        bundle = calc.evaluate(self._model)
+        ranks = self._brute_force_filtered_ranks(dataset.triplets())
+
+        self.assertAlmostEqual(bundle.mrr, sum(1.0 / rank for rank in ranks) / len(ranks), places=5)
+        self.assertAlmostEqual(bundle.mean_rank, sum(ranks) / len(ranks), places=5)
+        self.assertAlmostEqual(bundle.hits_at_1, sum(rank <= 1 for rank in ranks) / len(ranks), places=5)
+        self.assertAlmostEqual(bundle.hits_at_3, sum(rank <= 3 for rank in ranks) / len(ranks), places=5)
+        self.assertAlmostEqual(bundle.hits_at_10, 1.0)
+
+    def test_rank_stats_merge(self) -> None:
+        merged = critic.RankStats.of(torch.tensor([1, 4])).merged(critic.RankStats.of(torch.tensor([2])))
+
+        self.assertEqual(merged.bundle(), critic.RankStats.of(torch.tensor([1, 4, 2])).bundle())
+
+    def _brute_force_filtered_ranks(self, triplets: torch.LongTensor) -> list:
+        ranks = []
+
+        for triplet in triplets:
+            for side in (0, 2):
+                dist = self._model.score(triplet.unsqueeze(0)).item()
+                rank = 1
+
+                for entity in range(self._onto.entities_len()):
+                    corrupted = triplet.clone()
+                    corrupted[side] = entity
+
+                    if entity == triplet[side] or self._onto.exists(critic.Triplet(*corrupted.tolist())):
+                        continue
+
+                    if self._model.score(corrupted.unsqueeze(0)).item() < dist:
+                        rank += 1
+
+                ranks.append(rank)
+
+        return ranks
+
+    # _expected_sample draws the sample of calculate the way it does: a base seed from the calculator's
+    # generator and one shard after another, the i-th drawn with the base seed + i.
+    def _expected_sample(self, triplets: torch.LongTensor, sample_size: int, shard_size: int, seed: int) -> torch.LongTensor:
+        generator = torch.Generator()
+        generator.manual_seed(seed)
+        base_seed = int(torch.randint(0, 2 ** 31 - 1, (1,), generator=generator))
+
+        shards = []
+
+        for i, start in enumerate(range(0, sample_size, shard_size)):
+            shard_generator = torch.Generator()
+            shard_generator.manual_seed(base_seed + i)
+            size = min(shard_size, sample_size - start)
+
+            shards.append(triplets[torch.randint(0, len(triplets), (size,), generator=shard_generator)])
+
+        return torch.cat(shards)
+
+    def _brute_force_mean_rank(self, sample: torch.LongTensor) -> float:
+        cum_rank = 0
+
+        for triplet in sample:
+            for side in (0, 2):
+                dist = self._model(triplet.unsqueeze(0)).item()
+
+                for entity in range(self._onto.entities_len()):
+                    corrupted = triplet.clone()
+                    corrupted[side] = entity
+
+                    if self._model(corrupted.unsqueeze(0)).item() < dist:
+                        cum_rank += 1
+
+        return cum_rank / float(len(sample) * 2)
@@ -0,0 +1,75 @@
+import unittest
+
+import torch
+import torch.utils.data as torch_data
+
+import crabby.critic as critic
+
+
+class FailingLoader:
+    def __iter__(self):
+        yield torch.tensor([[0, 0, 1]])
+        raise RuntimeError("broken loader")
+
+
+class TestPrefetcher(unittest.TestCase):
+    _onto: critic.Ontology
+
+    def setUp(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=2)], [critic.Trans(rel=0, tail=0)]]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c"])
+
+    def test_prefetched_batches_match_inline(self) -> None:
+        dataset = critic.TripletTensorDataset(self._onto)
+        loader = torch_data.DataLoader(dataset, batch_size=1)
+
+        inline = list(critic.Prefetcher(loader, critic.NegativeSampler(self._onto, k=2, seed=0), depth=0))
+        prefetched = list(critic.Prefetcher(loader, critic.NegativeSampler(self._onto, k=2, seed=0), depth=2))
+
+        self.assertEqual(len(inline), 4)
+        for (triplets, negatives), (expected_triplets, expected_negatives) in zip(prefetched, inline):
+            self.assertTrue(torch.equal(triplets, expected_triplets))
+            self.assertTrue(torch.equal(negatives, expected_negatives))
+
+    def test_timings(self) -> None:
+        prefetcher = critic.Prefetcher(torch_data.DataLoader(critic.TripletTensorDataset(self._onto), batch_size=2), critic.NegativeSampler(self._onto, seed=0), depth=1)
+
+        list(prefetcher)
+        timings = prefetcher.timings()
+
+        self.assertGreater(timings.load_seconds, 0.0)
+        self.assertGreater(timings.sample_seconds, 0.0)
+        self.assertGreaterEqual(timings.wait_seconds, 0.0)
+
+    def test_producer_error_is_raised(self) -> None:
+        prefetcher = critic.Prefetcher(FailingLoader(), critic.NegativeSampler(self._onto, seed=0), depth=2)
+
+        with self.assertRaises(RuntimeError):
+            list(prefetcher)
+
+    def test_early_stop_releases_producer(self) -> None:
+        loader = torch_data.DataLoader(critic.TripletTensorDataset(self._onto), batch_size=1)
+        prefetcher = critic.Prefetcher(loader, critic.NegativeSampler(self._onto, seed=0), depth=1)
+
+        for _ in prefetcher:
+            break
+
+        self.assertEqual(len(list(prefetcher)), 4)
+
+    def test_trainer_with_prefetch_matches_serial(self) -> None:
+        weights = []
+
+        for prefetch in (0, 3):
+            torch.manual_seed(0)
+            model = critic.TranseModel(self._onto, k=4)
+            loader = torch_data.DataLoader(critic.TripletTensorDataset(self._onto), batch_size=1)
+            sampler = critic.NegativeSampler(self._onto, k=2, seed=0)
+
+            trainer = critic.Trainer(loader, self._onto, torch.optim.SGD(model.parameters(), lr=0.1), model, margin=1, sampler=sampler, prefetch=prefetch)
+            stats = trainer.train_one_epoch()
+
+            self.assertIsNotNone(stats.timings)
+            self.assertGreater(stats.compute_seconds, 0.0)
+            weights.append(model.entity_embeddings.weight.detach().clone())
+
+        self.assertTrue(torch.equal(weights[0], weights[1]))
@@ -0,0 +1,52 @@
+import unittest
+
+import torch
+
+import crabby.critic as critic
+
+
+class TestGraphQuery(unittest.TestCase):
+    _query: critic.GraphQuery
+
+    def setUp(self) -> None:
+        # a -x-> b -x-> c -y-> d and a -y-> c
+        adj_list = [
+            [critic.Trans(rel=0, tail=1), critic.Trans(rel=1, tail=2)],
+            [critic.Trans(rel=0, tail=2)],
+            [critic.Trans(rel=1, tail=3)],
+            [],
+        ]
+        onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c", "d"])
+        self._query = critic.GraphQuery(onto)
+
+    def test_reachable(self) -> None:
+        reachable = self._query.reachable(torch.tensor([0, 0, 0, 3]), torch.tensor([2, 3, 3, 0]), hops=2)
+
+        self.assertEqual(reachable.tolist(), [True, True, True, False])
+
+    def test_reachable_within_relations(self) -> None:
+        reachable = self._query.reachable(torch.tensor([0, 0]), torch.tensor([2, 3]), hops=3, rels=[0])
+
+        self.assertEqual(reachable.tolist(), [True, False])
+
+    def test_reachable_within_hops(self) -> None:
+        reachable = self._query.reachable(torch.tensor([1, 1]), torch.tensor([2, 3]), hops=1)
+
+        self.assertEqual(reachable.tolist(), [True, False])
+
+    def test_reachable_from(self) -> None:
+        reached = self._query.reachable_from(torch.tensor([0, 2]), hops=3)
+
+        self.assertEqual(reached.toarray().tolist(), [[False, True, True, True], [False, False, False, True]])
+
+    def test_count_paths(self) -> None:
+        counts = self._query.count_paths(torch.tensor([0, 0, 1]), torch.tensor([3, 2, 3]), rel_path=[0, 0])
+
+        self.assertEqual(counts.tolist(), [0, 1, 0])
+
+    def test_path_counts(self) -> None:
+        counts = self._query.path_counts([0, 0, 1])
+
+        self.assertEqual(counts[0, 3], 1)
+        self.assertEqual(counts.nnz, 1)
+
@@ -0,0 +1,119 @@
+import os
+import pickle
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+import crabby.critic as critic
+
+
+class TestTranseScorer(unittest.TestCase):
+    _onto: critic.Ontology
+    _model: critic.TranseModel
+
+    def setUp(self) -> None:
+        torch.manual_seed(0)
+
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=2)], [critic.Trans(rel=0, tail=0)], []]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c", "d"])
+        self._model = critic.TranseModel(self._onto, k=8)
+
+    def test_score_matches_model(self) -> None:
+        scorer = critic.TranseScorer.from_model(self._model)
+        triplets = torch.tensor([[0, 0, 1], [1, 1, 2], [3, 0, 2]])
+
+        np.testing.assert_allclose(scorer.score(triplets), self._model.score(triplets).detach().numpy(), rtol=1e-5)
+
+    def test_top_k_tails(self) -> None:
+        scorer = critic.TranseScorer.from_model(self._model)
+
+        ids, dists = scorer.top_k_tails(1, 0, k=2)
+        expected = self._model.score_tails(torch.tensor([1]), torch.tensor([0]))[0].detach().numpy()
+
+        np.testing.assert_array_equal(ids, np.argsort(expected)[:2])
+        np.testing.assert_allclose(dists, np.sort(expected)[:2], rtol=1e-4, atol=1e-5)
+
+    def test_top_k_heads_batched(self) -> None:
+        scorer = critic.TranseScorer.from_model(self._model)
+
+        ids, dists = scorer.top_k_heads(np.array([0, 1]), np.array([2, 0]), k=10)
+        expected = self._model.score_heads(torch.tensor([0, 1]), torch.tensor([2, 0])).detach().numpy()
+
+        self.assertEqual(ids.shape, (2, 4))
+        np.testing.assert_array_equal(ids, np.argsort(expected, axis=1))
+        np.testing.assert_allclose(dists, np.sort(expected, axis=1), rtol=1e-4, atol=1e-5)
+
+    def test_save_open_pickle(self) -> None:
+        scorer = critic.TranseScorer.from_model(self._model)
+        triplets = np.array([[0, 0, 1], [2, 1, 3]])
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "scorer.bin")
+            scorer.save(path)
+
+            opened = critic.TranseScorer.open(path)
+            np.testing.assert_array_equal(opened.score(triplets), scorer.score(triplets))
+
+            unpickled = pickle.loads(pickle.dumps(opened))
+            np.testing.assert_array_equal(unpickled.top_k_tails(0, 0, k=3)[0], scorer.top_k_tails(0, 0, k=3)[0])
+
+
+class TestQuantizedTranseScorer(unittest.TestCase):
+    _reference: critic.TranseScorer
+    _triplets: np.ndarray
+
+    def setUp(self) -> None:
+        rng = np.random.default_rng(0)
+
+        entities = rng.normal(size=(300, 16)).astype(np.float32)
+        self._reference = critic.TranseScorer(entities / np.linalg.norm(entities, axis=1, keepdims=True), rng.normal(scale=0.1, size=(4, 16)).astype(np.float32))
+        self._triplets = np.stack([rng.integers(0, 300, 50), rng.integers(0, 4, 50), rng.integers(0, 300, 50)], axis=1)
+
+    def test_int8_close_to_float32(self) -> None:
+        quantized = self._reference.quantize(critic.QuantizedTranseScorer.INT8)
+
+        self.assertEqual(quantized.nbytes(), 300 * 16 + 300 * 4)
+        np.testing.assert_allclose(quantized.score(self._triplets), self._reference.score(self._triplets), atol=0.05)
+
+    def test_fp16_top_k_matches_dequantized(self) -> None:
+        quantized = self._reference.quantize(critic.QuantizedTranseScorer.FP16)
+        dequantized = critic.TranseScorer(quantized.entities(), self._reference.relations())
+
+        ids, dists = quantized.top_k_tails(self._triplets[:, 0], self._triplets[:, 1], k=5)
+        expected_ids, expected_dists = dequantized.top_k_tails(self._triplets[:, 0], self._triplets[:, 1], k=5)
+
+        np.testing.assert_array_equal(ids, expected_ids)
+        np.testing.assert_allclose(dists, expected_dists, rtol=1e-4, atol=1e-4)
+
+    def test_tail_ranks_match_brute_force(self) -> None:
+        quantized = self._reference.quantize(critic.QuantizedTranseScorer.INT8)
+        entities = quantized.entities()
+
+        ranks = quantized.tail_ranks(self._triplets)
+
+        for rank, (head, rel, tail) in zip(ranks, self._triplets):
+            dists = np.linalg.norm(entities[head] + quantized.relations()[rel] - entities, axis=1)
+            self.assertAlmostEqual(rank, 1 + np.sum(dists < dists[tail] - 1e-4), delta=1)
+
+    def test_drift_report(self) -> None:
+        report = critic.drift_report(self._reference, self._reference.quantize(critic.QuantizedTranseScorer.INT8), self._triplets)
+
+        self.assertEqual(report.precision, "int8")
+        self.assertLess(report.nbytes, report.reference_nbytes / 3)
+        self.assertLess(report.max_score_error, 0.05)
+        self.assertAlmostEqual(report.mrr, report.reference_mrr, delta=0.05)
+        self.assertGreater(report.top_k_overlap, 0.8)
+
+    def test_save_open(self) -> None:
+        quantized = self._reference.quantize(critic.QuantizedTranseScorer.INT8)
+
+        with tempfile.TemporaryDirectory() as dir:
+            path = os.path.join(dir, "scorer.bin")
+            quantized.save(path)
+
+            opened = pickle.loads(pickle.dumps(critic.QuantizedTranseScorer.open(path)))
+
+            self.assertEqual(opened.precision(), "int8")
+            np.testing.assert_array_equal(opened.score(self._triplets), quantized.score(self._triplets))
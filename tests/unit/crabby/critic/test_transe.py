@@ -0,0 +1,147 @@
+import unittest
+
+import torch
+import torch.utils.data as torch_data
+
+import crabby.critic as critic
+
+
+class TestTrainer(unittest.TestCase):
+    _onto: critic.Ontology
+
+    def setUp(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=2)], []]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c"])
+
+    def test_train_one_epoch_with_multiple_negatives(self) -> None:
+        torch.manual_seed(0)
+        model = critic.TranseModel(self._onto, k=4)
+        loader = torch_data.DataLoader(critic.TripletDataset(self._onto), batch_size=2)
+        sampler = critic.NegativeSampler(self._onto, k=3, seed=0)
+
+        trainer = critic.Trainer(loader, self._onto, torch.optim.SGD(model.parameters(), lr=0.01), model, margin=1, sampler=sampler)
+        before = model.entity_embeddings.weight.detach().clone()
+
+        trainer.train_one_epoch()
+
+        self.assertEqual(trainer.epoch(), 1)
+        self.assertFalse(torch.equal(before, model.entity_embeddings.weight.detach()))
+
+    def test_forward_negatives_matches_forward(self) -> None:
+        torch.manual_seed(0)
+        model = critic.TranseModel(self._onto, k=4)
+        triplets = torch.tensor([[0, 0, 1], [1, 1, 2]])
+        negatives = critic.NegativeSampler(self._onto, k=5, seed=0).sample(triplets)
+
+        out, negative_out = model.forward_negatives(triplets, negatives)
+
+        self.assertEqual(negative_out.shape, (2, 5))
+        self.assertTrue(torch.allclose(out, model(triplets)))
+        self.assertTrue(torch.allclose(negative_out.flatten(), model(negatives)))
+
+    def test_train_one_epoch_self_adversarial(self) -> None:
+        torch.manual_seed(0)
+        model = critic.TranseModel(self._onto, k=4)
+        loader = torch_data.DataLoader(critic.TripletDataset(self._onto), batch_size=2)
+        sampler = critic.NegativeSampler(self._onto, k=4, seed=0)
+
+        trainer = critic.Trainer(loader, self._onto, torch.optim.SGD(model.parameters(), lr=0.01), model, margin=1, sampler=sampler, adversarial_temperature=1.0)
+        stats = trainer.train_one_epoch()
+
+        self.assertGreater(stats.loss, 0.0)
+
+    def test_sparse_training_only_touches_batch_rows(self) -> None:
+        torch.manual_seed(0)
+        model = critic.TranseModel(self._onto, k=4, sparse=True)
+        optimizer = torch.optim.SparseAdam(list(model.parameters()), lr=0.1)
+
+        # A single triplet is trained on. A sampler with the same seed tells which entity its corruption touches.
+        onto = critic.Ontology([[critic.Trans(rel=0, tail=1)], [], []], ["x", "y"], ["a", "b", "c"])
+        loader = torch_data.DataLoader(critic.TripletDataset(onto), batch_size=1)
+
+        before = model.entity_embeddings.weight.detach().clone()
+        negatives = critic.NegativeSampler(onto, seed=0).sample(torch.tensor([[0, 0, 1]]))
+        touched = set(negatives[:, [0, 2]].flatten().tolist()) | {0, 1}
+
+        sampler = critic.NegativeSampler(onto, seed=0)
+        critic.Trainer(loader, onto, optimizer, model, margin=1, sampler=sampler).train_one_epoch()
+
+        after = model.entity_embeddings.weight.detach()
+
+        for entity in range(3):
+            if entity not in touched:
+                self.assertTrue(torch.equal(before[entity], after[entity]))
+
+        self.assertTrue(bool((after[list(touched)].norm(dim=1) <= 1.0 + 1e-5).all()))
+
+
+class TestHogwildTrainer(unittest.TestCase):
+    def test_train_one_epoch(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=0), critic.Trans(rel=1, tail=2)], [critic.Trans(rel=0, tail=0)]]
+        onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c"])
+
+        torch.manual_seed(0)
+        model = critic.TranseModel(onto, k=4)
+        before = model.entity_embeddings.weight.detach().clone()
+
+        trainer = critic.HogwildTrainer(onto.triplets_range(0, onto.triplets_len()), onto, model, margin=1, workers=2, batch_size=1)
+        stats = trainer.train_one_epoch()
+
+        self.assertEqual(stats.epoch, 1)
+        self.assertEqual(stats.triplets, 4)
+        self.assertGreater(stats.triplets_per_sec, 0.0)
+        self.assertFalse(torch.equal(before, model.entity_embeddings.weight.detach()))
+
+    def test_worker_failure_is_raised(self) -> None:
+        onto = critic.Ontology([[critic.Trans(rel=0, tail=1)], []], ["x"], ["a", "b"])
+        model = critic.TranseModel(onto, k=4)
+        # The entity 5 does not exist so the worker training on it fails.
+        triplets = torch.tensor([[0, 0, 1], [0, 0, 5]])
+
+        trainer = critic.HogwildTrainer(triplets, onto, model, margin=1, workers=2, batch_size=1)
+
+        with self.assertRaises(critic.TrainingWorkerError):
+            trainer.train_one_epoch()
+
+
+class TestIncrementalTrainer(unittest.TestCase):
+    _onto: critic.Ontology
+
+    def setUp(self) -> None:
+        adj_list = [[critic.Trans(rel=0, tail=1)], [critic.Trans(rel=1, tail=2)], [critic.Trans(rel=0, tail=0)]]
+        self._onto = critic.Ontology(adj_list, ["x", "y"], ["a", "b", "c"])
+
+    def test_grow_initializes_from_neighbours(self) -> None:
+        torch.manual_seed(0)
+        model = critic.TranseModel(self._onto, k=4)
+        entities = model.entity_rows().detach()
+        relations = model.rel_embeddings.weight.detach().clone()
+
+        new_entity, = self._onto.add_entities(["d"])
+        new_rel, = self._onto.add_relations(["z"])
+        self._onto.add_triplets([critic.Triplet(head=new_entity, rel=0, tail=1), critic.Triplet(head=0, rel=new_rel, tail=2)])
+
+        grown_entities, grown_relations = model.grow(self._onto)
+
+        self.assertEqual(list(grown_entities), [3])
+        self.assertEqual(list(grown_relations), [2])
+        self.assertEqual(model.entity_embeddings.weight.shape, (4, 4))
+        self.assertTrue(torch.allclose(model.rel_embeddings.weight[new_rel], entities[2] - entities[0]))
+        self.assertTrue(torch.allclose(model.entity_rows()[new_entity], torch.renorm((entities[1] - relations[0]).unsqueeze(0), p=2, dim=0, maxnorm=1)[0]))
+        self.assertTrue(torch.equal(model.entity_rows()[:3], entities))
+
+    def test_fine_tune_on_new_triplets(self) -> None:
+        torch.manual_seed(0)
+        model = critic.TranseModel(self._onto, k=4, sparse=True)
+
+        new_entity, = self._onto.add_entities(["d"])
+        new_triplets = [critic.Triplet(head=new_entity, rel=1, tail=0), critic.Triplet(head=2, rel=1, tail=new_entity)]
+        self._onto.add_triplets(new_triplets)
+
+        trainer = critic.IncrementalTrainer(self._onto, model, margin=1, lr=0.1, epochs=3, replay=2.0, seed=0)
+        history = trainer.fine_tune(torch.tensor([[t.head, t.rel, t.tail] for t in new_triplets]))
+
+        self.assertEqual([stats.epoch for stats in history], [1, 2, 3])
+        # Both new triplets plus twice as many replayed ones.
+        self.assertEqual(history[0].triplets, 6)
+        self.assertEqual(model.entity_embeddings.weight.shape[0], 4)
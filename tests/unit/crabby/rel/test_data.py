@@ -37,6 +37,24 @@ class TestSentencePairer(unittest.TestCase):
         # It should be a combination n=num_entities and k=2 (as we extract pairs)
         self.assertEqual(len(sentences), 6)
 
+    def test_getitem_sent_with_many_entities(self) -> None:
+        sent = " and ".join(f"<e{i}>N{i}</e{i}>" for i in range(1, 21)) + "."
+        sentences = crabby_rel.SentencePairer([self._two_ent_sent, sent])
+
+        self.assertEqual(len(sentences), 1 + 190)
+
+        # The pairs starting with 1, 2 and 3 come first (19 + 18 + 17 of them) so the 3rd one starting with 4 is (4, 7).
+        for idx, first, second in [(1, 1, 2), (1 + 56, 4, 7), (190, 19, 20)]:
+            words = [f"< 1 > N{i} < / 1 >" if i == first else f"< 2 > N{i} < / 2 >" if i == second else f"N{i}" for i in range(1, 21)]
+            self.assertEqual(sentences[idx], " and ".join(words) + ".")
+
+    def test_getitem_skips_sentences_without_pairs(self) -> None:
+        sentences = crabby_rel.SentencePairer(["<e1>A</e1> <e2>B</e2>", "<e1>only</e1>", self._zero_ent_sent, "<e1>C</e1> <e2>D</e2>"])
+
+        self.assertEqual(len(sentences), 2)
+        self.assertEqual(sentences[0], "< 1 > A < / 1 > < 2 > B < / 2 >")
+        self.assertEqual(sentences[1], "< 1 > C < / 1 > < 2 > D < / 2 >")
+
     def test_getitem_non_existing_on_empty_set(self) -> None:
         sentences = crabby_rel.SentencePairer([])
         
@@ -74,6 +92,13 @@ class TestSentencePairer(unittest.TestCase):
         self.assertEqual(len(sentences), 1)
         self.assertEqual(sentences[0], "< 2 > John < / 2 > is a father of < 1 > Gordon < / 1 >.")
 
+    def test_getitem_markers_out_of_tag_order(self) -> None:
+        sentences = crabby_rel.SentencePairer(["<e3>X</e3> a <e1>Y</e1> b <e2>Z</e2>."])
+
+        self.assertEqual(sentences[0], "X a < 1 > Y < / 1 > b < 2 > Z < / 2 >.")
+        self.assertEqual(sentences[1], "< 2 > X < / 2 > a < 1 > Y < / 1 > b Z.")
+        self.assertEqual(sentences[2], "< 2 > X < / 2 > a Y b < 1 > Z < / 1 >.")
+
     def test_labels_count_validation(self) -> None:
         with self.assertRaises(LabelError):
             crabby_rel.SentencePairer([self._rev_two_ent_sent], labels=[], relations=[])
@@ -101,6 +126,62 @@ class TestSentencePairer(unittest.TestCase):
         self.assertEqual(sentences[1], ("< 1 > Minnie < / 1 > loves Mickey but dislikes < 2 > Alberto < / 2 >!", "dislike"))
         self.assertEqual(sentences[2], ("Minnie loves < 1 > Mickey < / 1 > but dislikes < 2 > Alberto < / 2 >!", "none"))
 
+    def test_prune_by_token_distance(self) -> None:
+        pruning = crabby_rel.PruningPolicy(max_token_distance=2)
+        sentences = crabby_rel.SentencePairer([self._two_ent_sent, self._four_ent_sent], pruning=pruning)
+
+        # Oliver, Sally, Christmas eve and Heuston start at tokens 0, 2, 4 and 10.
+        self.assertEqual(len(sentences), 2)
+        self.assertEqual(sentences[0], "< 1 > Oliver < / 1 > kissed < 2 > Sally < / 2 > for Christmas eve in front of father Heuston.")
+        self.assertEqual(sentences[1], "Oliver kissed < 1 > Sally < / 1 > for < 2 > Christmas eve < / 2 > in front of father Heuston.")
+        self.assertEqual(sentences.pruning_stats(), crabby_rel.PruningStats(candidates=7, kept=2, dropped_by_distance=5, dropped_by_type=0, dropped_by_cap=0))
+
+    def test_prune_sentence_without_pairs_in_the_middle(self) -> None:
+        pruning = crabby_rel.PruningPolicy(max_token_distance=2)
+        sents = ["<e1>A</e1> x <e2>B</e2> <e3>Z</e3>.", "<e1>C</e1> y y y y y y y y <e2>D</e2>.", "<e1>E</e1> <e2>F</e2>"]
+
+        sentences = crabby_rel.SentencePairer(sents, pruning=pruning)
+
+        # A, B and Z start at tokens 0, 2 and 3 so (A, Z) is dropped and so is the only pair of the middle sentence.
+        self.assertEqual(len(sentences), 3)
+        self.assertEqual(sentences[1], "A x < 1 > B < / 1 > < 2 > Z < / 2 >.")
+        self.assertEqual(sentences[2], "< 1 > E < / 1 > < 2 > F < / 2 >")
+
+        # Without pruning the middle sentence has a pair of its own.
+        sentences = crabby_rel.SentencePairer(sents)
+
+        self.assertEqual(len(sentences), 5)
+        self.assertEqual(sentences[3], "< 1 > C < / 1 > y y y y y y y y < 2 > D < / 2 >.")
+        self.assertEqual(sentences[4], "< 1 > E < / 1 > < 2 > F < / 2 >")
+
+    def test_prune_by_entity_types(self) -> None:
+        pruning = crabby_rel.PruningPolicy(compatible_types={("PER", "DATE")})
+        sentences = crabby_rel.SentencePairer([self._four_ent_sent], entity_types=[["PER", "PER", "DATE", "PER"]], pruning=pruning)
+
+        self.assertEqual(len(sentences), 3)
+        self.assertEqual(sentences[2], "Oliver kissed Sally for < 1 > Christmas eve < / 1 > in front of father < 2 > Heuston < / 2 >.")
+        self.assertEqual(sentences.pruning_stats().dropped_by_type, 3)
+
+    def test_prune_by_pair_cap(self) -> None:
+        pruning = crabby_rel.PruningPolicy(max_pairs_per_sent=2)
+        sentences = crabby_rel.SentencePairer(
+            [self._three_ent_sent, self._four_ent_sent],
+            labels=["love", "dislike", "none", "none"],
+            relations=["love", "dislike", "none"],
+            pruning=pruning,
+        )
+
+        self.assertEqual(len(sentences), 4)
+        self.assertEqual(sentences[1], ("Minnie loves < 1 > Mickey < / 1 > but dislikes < 2 > Alberto < / 2 >!", "dislike"))
+        self.assertEqual(sentences.pruning_stats(), crabby_rel.PruningStats(candidates=9, kept=4, dropped_by_distance=0, dropped_by_type=0, dropped_by_cap=5))
+
+    def test_entity_types_validation(self) -> None:
+        with self.assertRaises(ValueError):
+            crabby_rel.SentencePairer([self._two_ent_sent], pruning=crabby_rel.PruningPolicy(compatible_types={("PER", "PER")}))
+
+        with self.assertRaises(ValueError):
+            crabby_rel.SentencePairer([self._two_ent_sent], entity_types=[["PER"]])
+
 
 class TestSentenceDataset(unittest.TestCase):
     _pairer: crabby_rel.SentencePairer